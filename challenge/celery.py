@@ -33,4 +33,20 @@ app.conf.beat_schedule = {
     #     'task': 'users.tasks.cleanup_old_users',
     #     'schedule': 3600.0,  # 1 hour
     # },
+    'refresh-spatial-index': {
+        'task': 'users.tasks.refresh_spatial_index',
+        'schedule': 900.0,  # 15 minutes, matches SPATIAL_INDEX_MAX_AGE
+    },
+    'flush-location-updates': {
+        'task': 'users.tasks.flush_location_updates',
+        'schedule': 5.0,  # matches LOCATION_UPDATE_WINDOW
+    },
+    'compact-location-history': {
+        'task': 'users.tasks.compact_location_history',
+        'schedule': 3600.0,  # 1 hour
+    },
+    'refresh-friend-recommendations': {
+        'task': 'friendships.tasks.refresh_friend_recommendations',
+        'schedule': 86400.0,  # 1 day
+    },
 }
\ No newline at end of file
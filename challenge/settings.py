@@ -180,6 +180,57 @@ CORS_ALLOWED_ORIGINS = [
 
 CORS_ALLOW_CREDENTIALS = True
 
+# Cache Configuration
+# Point CACHE_BACKEND at django.core.cache.backends.redis.RedisCache and
+# CACHE_LOCATION at REDIS_URL in production so worker processes share the cache
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default=''),
+    }
+}
+
+# Spatial Index Configuration (users.spatial)
+SPATIAL_INDEX_ENABLED = config('SPATIAL_INDEX_ENABLED', default=True, cast=bool)
+SPATIAL_INDEX_CELL_SIZE = config('SPATIAL_INDEX_CELL_SIZE', default=0.1, cast=float)  # degrees
+SPATIAL_INDEX_CHECK_INTERVAL = config('SPATIAL_INDEX_CHECK_INTERVAL', default=5, cast=float)  # seconds
+SPATIAL_INDEX_MAX_AGE = config('SPATIAL_INDEX_MAX_AGE', default=900, cast=float)  # seconds
+# Directory of the snapshots shared by the processes of a host; empty to build per process
+SPATIAL_INDEX_SNAPSHOT_DIR = config('SPATIAL_INDEX_SNAPSHOT_DIR', default='')
+
+# Nearby Result Cache Configuration (users.nearby_cache), used when the spatial index is disabled
+NEARBY_CACHE_ENABLED = config('NEARBY_CACHE_ENABLED', default=True, cast=bool)
+NEARBY_CACHE_CELL_SIZE = config('NEARBY_CACHE_CELL_SIZE', default=0.01, cast=float)  # degrees
+NEARBY_CACHE_INVALIDATION_CELL_SIZE = config('NEARBY_CACHE_INVALIDATION_CELL_SIZE', default=0.1, cast=float)  # degrees
+NEARBY_CACHE_TIMEOUT = config('NEARBY_CACHE_TIMEOUT', default=30, cast=int)  # seconds
+
+# Location Update Pipeline Configuration (users.location_updates)
+LOCATION_UPDATE_WINDOW = config('LOCATION_UPDATE_WINDOW', default=5, cast=int)  # seconds
+LOCATION_UPDATE_BATCH_SIZE = config('LOCATION_UPDATE_BATCH_SIZE', default=1000, cast=int)  # rows per UPDATE
+
+# Location History Configuration (users.history)
+LOCATION_HISTORY_ENABLED = config('LOCATION_HISTORY_ENABLED', default=True, cast=bool)
+LOCATION_HISTORY_RAW_DAYS = config('LOCATION_HISTORY_RAW_DAYS', default=7, cast=int)  # days kept at full resolution
+LOCATION_HISTORY_DOWNSAMPLE_MINUTES = config('LOCATION_HISTORY_DOWNSAMPLE_MINUTES', default=5, cast=int)  # minutes per point after that
+LOCATION_HISTORY_RETENTION_DAYS = config('LOCATION_HISTORY_RETENTION_DAYS', default=365, cast=int)  # days kept at all
+
+# Friend Proximity Alerts (friendships.proximity)
+PROXIMITY_ALERTS_ENABLED = config('PROXIMITY_ALERTS_ENABLED', default=True, cast=bool)
+PROXIMITY_ALERT_RADIUS_KM = config('PROXIMITY_ALERT_RADIUS_KM', default=10, cast=float)
+PROXIMITY_ALERT_HYSTERESIS_KM = config('PROXIMITY_ALERT_HYSTERESIS_KM', default=0.5, cast=float)  # extra distance before leaving
+
+# Friendship Adjacency Cache (friendships.adjacency)
+ADJACENCY_CACHE_ENABLED = config('ADJACENCY_CACHE_ENABLED', default=True, cast=bool)
+ADJACENCY_CACHE_LOCAL_SIZE = config('ADJACENCY_CACHE_LOCAL_SIZE', default=10000, cast=int)  # users kept per process
+
+# Friend Recommendations (friendships.recommendations)
+RECOMMENDATIONS_TOP_N = config('RECOMMENDATIONS_TOP_N', default=20, cast=int)  # candidates stored per user
+RECOMMENDATIONS_SHARDS = config('RECOMMENDATIONS_SHARDS', default=16, cast=int)  # Celery tasks per refresh
+RECOMMENDATIONS_BATCH_SIZE = config('RECOMMENDATIONS_BATCH_SIZE', default=500, cast=int)  # users scored at once
+# Boost of a candidate at distance zero, fading with distance; 0 ranks by mutual friends alone
+RECOMMENDATIONS_PROXIMITY_WEIGHT = config('RECOMMENDATIONS_PROXIMITY_WEIGHT', default=0.5, cast=float)
+RECOMMENDATIONS_PROXIMITY_SCALE_KM = config('RECOMMENDATIONS_PROXIMITY_SCALE_KM', default=25, cast=float)  # km
+
 # Celery Configuration
 CELERY_BROKER_URL = config('REDIS_URL', default='redis://localhost:6379/0')
 CELERY_RESULT_BACKEND = config('REDIS_URL', default='redis://localhost:6379/0')
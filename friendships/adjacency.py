@@ -0,0 +1,286 @@
+"""
+Adjacency cache of the friendship graph.
+
+Each user's accepted relationships are cached as three id sets: friends
+(either direction), followers (accepted friendships the user received) and
+following (accepted friendships the user sent). Entries are kept in the
+shared cache and copied into a bounded in-process LRU, both tagged with the
+user's version: a counter in the shared cache bumped on every change. A read
+costs one small round trip for the version and reuses the local sets while
+they are current.
+
+Entries never expire. Once a change to a friendship commits, the entries of
+both users are updated in place (see friendships.signals): the version is
+incremented and the pair's edge is reread with one probe of the pair index,
+so updates applied in any order converge on the database state. An entry is
+only rewritten if it was at the version just before the bump; otherwise it
+is dropped and reloaded on its next read, so concurrent writers can cost a
+reload but never leave a stale entry current. Queryset updates bypass the
+signals; call refresh_pair for the pairs they touch.
+
+Versions only reach other processes through a shared cache. With a
+process-local backend such as the default LocMemCache, a change made in one
+worker would never be seen by the others, so the cache is bypassed and every
+read goes to the database.
+"""
+
+import random
+import threading
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from users.utils import cache_is_shared
+from .models import Friendship
+
+CACHE_KEY_PREFIX = 'friendships:adjacency'
+
+Adjacency = namedtuple('Adjacency', ['version', 'friends', 'followers', 'following'])
+
+_local = OrderedDict()
+_local_lock = threading.Lock()
+
+
+def is_enabled():
+    """Whether friend lists should be read from the adjacency cache."""
+    return settings.ADJACENCY_CACHE_ENABLED and cache_is_shared()
+
+
+def get_adjacency(user_id):
+    """
+    Get the friend, follower and following ids of a user.
+
+    Args:
+        user_id: Id of the user
+
+    Returns:
+        Adjacency: Version and frozensets of friend, follower and following ids
+    """
+    if not is_enabled():
+        return _load(user_id, None)
+
+    key = _entry_key(user_id)
+    version = _current_version(user_id)
+    with _local_lock:
+        entry = _local.get(key)
+        if entry is not None and entry.version == version:
+            _local.move_to_end(key)
+            return entry
+
+    stored = cache.get(key)
+    if stored is not None and stored['version'] == version:
+        entry = Adjacency(
+            version, stored['followers'] | stored['following'],
+            stored['followers'], stored['following'],
+        )
+    else:
+        entry = _load(user_id, version)
+        _store(key, entry)
+    _remember(key, entry)
+    return entry
+
+
+def get_many(user_ids):
+    """
+    Get the adjacency of several users with batched cache reads.
+
+    Versions and entries are each read with one round trip, and the users
+    found in neither cache are loaded with a single query.
+
+    Args:
+        user_ids: Ids of the users
+
+    Returns:
+        dict: Adjacency per user id
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    if not is_enabled():
+        return _load_many(user_ids, dict.fromkeys(user_ids))
+
+    stored_versions = cache.get_many([_version_key(user_id) for user_id in user_ids])
+    versions = {
+        user_id: stored_versions.get(_version_key(user_id)) for user_id in user_ids
+    }
+    for user_id, version in versions.items():
+        if version is None:
+            versions[user_id] = _current_version(user_id)
+
+    entries = {}
+    with _local_lock:
+        for user_id in user_ids:
+            entry = _local.get(_entry_key(user_id))
+            if entry is not None and entry.version == versions[user_id]:
+                _local.move_to_end(_entry_key(user_id))
+                entries[user_id] = entry
+
+    missing = [user_id for user_id in user_ids if user_id not in entries]
+    stored = cache.get_many([_entry_key(user_id) for user_id in missing])
+    unloaded = {}
+    for user_id in missing:
+        value = stored.get(_entry_key(user_id))
+        if value is not None and value['version'] == versions[user_id]:
+            entries[user_id] = Adjacency(
+                versions[user_id], value['followers'] | value['following'],
+                value['followers'], value['following'],
+            )
+            _remember(_entry_key(user_id), entries[user_id])
+        else:
+            unloaded[user_id] = versions[user_id]
+
+    for user_id, entry in _load_many(list(unloaded), unloaded).items():
+        _store(_entry_key(user_id), entry)
+        _remember(_entry_key(user_id), entry)
+        entries[user_id] = entry
+    return entries
+
+
+def friend_ids(user_id):
+    """Ids of a user's accepted friends, in either direction."""
+    return get_adjacency(user_id).friends
+
+
+def follower_ids(user_id):
+    """Ids of the users whose friendship a user accepted."""
+    return get_adjacency(user_id).followers
+
+
+def following_ids(user_id):
+    """Ids of the users who accepted a user's friendship."""
+    return get_adjacency(user_id).following
+
+
+def refresh_pair(user_id, other_id):
+    """
+    Update the entries of two users after their friendship changed.
+
+    Args:
+        user_id: Id of one user
+        other_id: Id of the other user
+    """
+    if not is_enabled():
+        return
+
+    versions = {user_id: _next_version(user_id), other_id: _next_version(other_id)}
+    edge = Friendship.between(user_id, other_id).filter(status='accepted').values_list(
+        'from_user_id', 'to_user_id'
+    ).first()
+
+    for user, other in ((user_id, other_id), (other_id, user_id)):
+        key = _entry_key(user)
+        stored = cache.get(key)
+        if stored is None or stored['version'] != versions[user] - 1:
+            cache.delete(key)
+            continue
+
+        following = stored['following'] - {other}
+        followers = stored['followers'] - {other}
+        if edge == (user, other):
+            following |= {other}
+        elif edge == (other, user):
+            followers |= {other}
+        _store(key, Adjacency(versions[user], followers | following, followers, following))
+
+
+def clear_local():
+    """Drop every entry of the in-process cache."""
+    with _local_lock:
+        _local.clear()
+
+
+def _load(user_id, version):
+    """Read a user's adjacency from the database."""
+    rows = Friendship.objects.filter(
+        Q(from_user_id=user_id) | Q(to_user_id=user_id), status='accepted'
+    ).values_list('from_user_id', 'to_user_id')
+
+    following, followers = set(), set()
+    for from_id, to_id in rows:
+        if from_id == user_id:
+            following.add(to_id)
+        else:
+            followers.add(from_id)
+    return Adjacency(
+        version, frozenset(followers | following), frozenset(followers), frozenset(following)
+    )
+
+
+def _load_many(user_ids, versions):
+    """Read the adjacency of several users from the database with one query."""
+    if not user_ids:
+        return {}
+    rows = Friendship.objects.filter(
+        Q(from_user_id__in=user_ids) | Q(to_user_id__in=user_ids), status='accepted'
+    ).values_list('from_user_id', 'to_user_id')
+
+    following = {user_id: set() for user_id in user_ids}
+    followers = {user_id: set() for user_id in user_ids}
+    for from_id, to_id in rows:
+        if from_id in following:
+            following[from_id].add(to_id)
+        if to_id in followers:
+            followers[to_id].add(from_id)
+    return {
+        user_id: Adjacency(
+            versions[user_id], frozenset(followers[user_id] | following[user_id]),
+            frozenset(followers[user_id]), frozenset(following[user_id]),
+        )
+        for user_id in user_ids
+    }
+
+
+def _store(key, entry):
+    """Write an entry to the shared cache, without expiry."""
+    cache.set(
+        key,
+        {'version': entry.version, 'followers': entry.followers, 'following': entry.following},
+        timeout=None
+    )
+
+
+def _remember(key, entry):
+    """Keep an entry in the in-process cache, evicting the least recently used."""
+    with _local_lock:
+        _local[key] = entry
+        _local.move_to_end(key)
+        while len(_local) > settings.ADJACENCY_CACHE_LOCAL_SIZE:
+            _local.popitem(last=False)
+
+
+def _current_version(user_id):
+    """Read a user's version, starting it if it is missing."""
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _next_version(user_id):
+    """Increment a user's version."""
+    key = _version_key(user_id)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, _initial_version(), timeout=None)
+        return cache.incr(key)
+
+
+def _initial_version():
+    """
+    Pick a starting version.
+
+    Starting at random rather than zero means a version evicted from the
+    cache does not count up to the version of an entry written before.
+    """
+    return random.getrandbits(48)
+
+
+def _entry_key(user_id):
+    return f'{CACHE_KEY_PREFIX}:{user_id}'
+
+
+def _version_key(user_id):
+    return f'{CACHE_KEY_PREFIX}:version:{user_id}'
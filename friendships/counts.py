@@ -0,0 +1,84 @@
+"""
+Denormalized friendship counters on User.
+
+friends_count, followers_count and following_count count a user's accepted
+friendships: all of them, those the user received and those the user sent.
+They are adjusted with F() expressions inside the transaction of every
+change into or out of the accepted status (see friendships.signals), so
+showing them never costs a COUNT query. Queryset updates bypass the signals;
+reconcile_counts recomputes the counters of a chunk of users to repair drift.
+"""
+
+from django.db import transaction
+from django.db.models import Count, F
+
+from users.models import User
+from .models import Friendship
+
+COUNT_FIELDS = ['friends_count', 'followers_count', 'following_count']
+
+
+def adjust_counts(from_user_id, to_user_id, delta):
+    """
+    Add an accepted friendship to, or take one away from, both users' counters.
+
+    Args:
+        from_user_id: Id of the user who sent the friendship
+        to_user_id: Id of the user who received it
+        delta: 1 when the friendship became accepted, -1 when it stopped
+    """
+    User.objects.filter(pk=from_user_id).update(
+        friends_count=F('friends_count') + delta,
+        following_count=F('following_count') + delta,
+    )
+    User.objects.filter(pk=to_user_id).update(
+        friends_count=F('friends_count') + delta,
+        followers_count=F('followers_count') + delta,
+    )
+
+
+def reconcile_counts(user_ids):
+    """
+    Recompute the counters of some users and fix the ones that drifted.
+
+    The users' rows are locked while their friendships are counted, so a
+    transition committing meanwhile either is counted or waits and then
+    adjusts the corrected value.
+
+    Args:
+        user_ids: Ids of the users to check
+
+    Returns:
+        tuple: (users checked, users fixed)
+    """
+    with transaction.atomic():
+        users = list(
+            User.objects.select_for_update().filter(pk__in=user_ids).order_by('pk').values_list(
+                'pk', *COUNT_FIELDS
+            )
+        )
+        accepted = Friendship.objects.filter(status='accepted')
+        following = dict(
+            accepted.filter(from_user_id__in=user_ids).values('from_user_id').annotate(
+                count=Count('pk')
+            ).values_list('from_user_id', 'count')
+        )
+        followers = dict(
+            accepted.filter(to_user_id__in=user_ids).values('to_user_id').annotate(
+                count=Count('pk')
+            ).values_list('to_user_id', 'count')
+        )
+
+        drifted = []
+        for user_id, *stored in users:
+            # A pair has one friendship, so no friend is counted twice
+            actual = [
+                followers.get(user_id, 0) + following.get(user_id, 0),
+                followers.get(user_id, 0),
+                following.get(user_id, 0),
+            ]
+            if actual != stored:
+                drifted.append(User(pk=user_id, **dict(zip(COUNT_FIELDS, actual))))
+        User.objects.bulk_update(drifted, COUNT_FIELDS)
+
+    return len(users), len(drifted)
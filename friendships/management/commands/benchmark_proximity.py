@@ -0,0 +1,178 @@
+"""
+Load test for the friend proximity alert engine.
+
+Populates the database with synthetic users clustered around a few cities,
+each with friends mostly in the same city, inside a transaction that is
+rolled back at the end. Proximity state is primed, then every user moves
+at once and the engine evaluates all of them, reporting throughput, queries
+and transitions. For comparison, a sample of users is also evaluated the
+naive way, by loading every friend and measuring the distance to each.
+"""
+
+import math
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from friendships.models import Friendship
+from friendships.proximity import evaluate_proximity
+from users.location_updates import apply_location_updates
+from users.models import User
+from users.utils import EARTH_RADIUS_KM, haversine_distances
+
+
+class QueryCounter:
+    """Database execute wrapper counting the statements it sees."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    """Measure the cost of evaluating friend proximity when many users move."""
+
+    help = 'Load test the friend proximity engine with synthetic users moving at once'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10_000, help='Synthetic users, all moving')
+        parser.add_argument('--friends', type=int, default=50, help='Friends per user on average')
+        parser.add_argument('--cities', type=int, default=20, help='Clusters users live in')
+        parser.add_argument('--city-radius', type=float, default=25.0, help='Cluster radius in km')
+        parser.add_argument('--step', type=float, default=3.0, help='Largest move in km')
+        parser.add_argument(
+            '--local-share', type=float, default=0.8,
+            help='Share of friends living in the same city'
+        )
+        parser.add_argument(
+            '--baseline-users', type=int, default=500,
+            help='Users to evaluate by scanning their whole friend list (0 to skip)'
+        )
+        parser.add_argument('--seed', type=int, default=42, help='Random seed')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        self.stdout.write(
+            f"{'phase':>14} {'users':>8} {'queries':>9} {'entered':>9} {'left':>8} "
+            f"{'seconds':>9} {'users/s':>9}"
+        )
+        with transaction.atomic():
+            users = self._populate(rng, options)
+            user_ids = [user.id for user in users]
+
+            self._report('prime', len(user_ids), *self._evaluate(user_ids))
+
+            moves = []
+            for user in users:
+                distance = options['step'] * rng.random()
+                moves.append((user.id, *self._offset(
+                    rng, user.latitude, user.longitude, distance
+                )))
+            apply_location_updates(moves)
+
+            self._report('all moved', len(user_ids), *self._evaluate(user_ids))
+            self._report('none moved', len(user_ids), *self._evaluate(user_ids))
+
+            if options['baseline_users']:
+                sample = user_ids[:options['baseline_users']]
+                self._report('friend scan', len(sample), *self._scan(sample))
+
+            transaction.set_rollback(True)
+
+    def _populate(self, rng, options):
+        """Create clustered users and accepted friendships between them."""
+        cities = [
+            (rng.uniform(-50, 60), rng.uniform(-180, 180)) for _ in range(options['cities'])
+        ]
+
+        users = []
+        by_city = [[] for _ in cities]
+        for i in range(options['users']):
+            city = rng.randrange(len(cities))
+            latitude, longitude = self._offset(
+                rng, *cities[city], options['city_radius'] * math.sqrt(rng.random())
+            )
+            user = User(
+                id=uuid.uuid4(),
+                email=f'proximity-{i}@example.com',
+                name=f'Proximity User {i}',
+                password='!',
+                latitude=latitude,
+                longitude=longitude,
+            )
+            user.refresh_location_fields()
+            users.append(user)
+            by_city[city].append(user.id)
+        User.objects.bulk_create(users, batch_size=5000)
+
+        # Each pair is created once, so every user gets about --friends friends
+        pairs = set()
+        for members in by_city:
+            for user in members:
+                for _ in range(options['friends'] // 2):
+                    if rng.random() < options['local_share']:
+                        friend = rng.choice(members)
+                    else:
+                        friend = rng.choice(users).id
+                    if friend != user:
+                        pairs.add((user, friend) if user < friend else (friend, user))
+
+        Friendship.objects.bulk_create(
+            [
+                Friendship(
+                    from_user_id=low, to_user_id=high, user_low_id=low, user_high_id=high,
+                    status='accepted'
+                )
+                for low, high in pairs
+            ],
+            batch_size=5000
+        )
+        return users
+
+    @staticmethod
+    def _offset(rng, latitude, longitude, distance_km):
+        """Move a point a distance in a random direction."""
+        bearing = rng.uniform(0, 2 * math.pi)
+        latitude += math.degrees(distance_km * math.cos(bearing) / EARTH_RADIUS_KM)
+        longitude += math.degrees(
+            distance_km * math.sin(bearing) / (EARTH_RADIUS_KM * math.cos(math.radians(latitude)))
+        )
+        return latitude, (longitude + 180) % 360 - 180
+
+    @staticmethod
+    def _evaluate(user_ids):
+        """Run the engine over every user."""
+        queries = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            result = evaluate_proximity(user_ids)
+        return queries.count, result['entered'], result['left'], time.perf_counter() - start
+
+    @staticmethod
+    def _scan(user_ids):
+        """Measure every friend of each user, as a per-friend scan would."""
+        queries = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            for user in User.objects.filter(id__in=user_ids):
+                friends = list(
+                    Friendship.get_friends(user).values_list('latitude', 'longitude')
+                )
+                if friends:
+                    latitudes, longitudes = zip(*friends)
+                    haversine_distances(user.latitude, user.longitude, latitudes, longitudes)
+        return queries.count, 0, 0, time.perf_counter() - start
+
+    def _report(self, phase, users, queries, entered, left, elapsed):
+        """Write one result row."""
+        self.stdout.write(
+            f"{phase:>14} {users:>8} {queries:>9} {entered:>9} {left:>8} "
+            f"{elapsed:>9.2f} {users / elapsed:>9.0f}"
+        )
@@ -0,0 +1,205 @@
+"""
+Benchmark for the friend-of-friend recommendation engine.
+
+Populates the database with a synthetic power-law friendship graph, grown by
+preferential attachment (Barabási-Albert) so a few users gather thousands of
+friends, inside a transaction that is rolled back at the end. Users are
+clustered around a few cities so the proximity boost has an effect. The
+engine then loads the graph and scores every user, and stored
+recommendations are read back the way the endpoint reads them. For
+comparison, a sample of users is also scored on the fly, with friends of
+friends read from the database for each user.
+"""
+
+import math
+import random
+import time
+import uuid
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+
+from friendships.management.commands.benchmark_proximity import QueryCounter
+from friendships.models import Friendship
+from friendships.recommendations import FriendGraph, compute_recommendations, recommendations_for
+from users.models import User
+from users.utils import EARTH_RADIUS_KM
+
+
+class Command(BaseCommand):
+    """Measure precomputing and reading friend recommendations on a power-law graph."""
+
+    help = 'Benchmark friend recommendations on a synthetic power-law friendship graph'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100_000, help='Synthetic users')
+        parser.add_argument('--edges', type=int, default=1_000_000, help='Accepted friendships, about')
+        parser.add_argument('--cities', type=int, default=20, help='Clusters users live in')
+        parser.add_argument('--city-radius', type=float, default=25.0, help='Cluster radius in km')
+        parser.add_argument('--batch-size', type=int, default=500, help='Users scored at once')
+        parser.add_argument('--top-n', type=int, default=20, help='Recommendations kept per user')
+        parser.add_argument('--reads', type=int, default=1000, help='Recommendation lists read back')
+        parser.add_argument(
+            '--baseline-users', type=int, default=200,
+            help='Users to score on the fly from the database (0 to skip)'
+        )
+        parser.add_argument('--seed', type=int, default=42, help='Random seed')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        with transaction.atomic():
+            start = time.perf_counter()
+            user_ids, edges = self._populate(rng, options)
+            self.stdout.write(
+                f"Populated {len(user_ids)} users and {edges} friendships "
+                f"in {time.perf_counter() - start:.1f}s"
+            )
+
+            queries = QueryCounter()
+            start = time.perf_counter()
+            with connection.execute_wrapper(queries):
+                graph = FriendGraph.load()
+            degrees = graph.offsets[1:] - graph.offsets[:-1]
+            self.stdout.write(
+                f"Loaded the graph in {time.perf_counter() - start:.2f}s ({queries.count} queries): "
+                f"mean degree {degrees.mean():.1f}, max degree {degrees.max()}, "
+                f"{int((degrees ** 2).sum())} two-hop paths"
+            )
+
+            self.stdout.write(
+                f"{'phase':>12} {'users':>8} {'queries':>9} {'seconds':>9} {'ms/user':>9} {'stored':>9}"
+            )
+            self._report('precompute', len(user_ids), *self._precompute(user_ids, graph, options))
+
+            sample = rng.sample(user_ids, min(options['reads'], len(user_ids)))
+            self._report('read', len(sample), *self._read(sample, options['top_n']))
+
+            if options['baseline_users']:
+                sample = user_ids[:options['baseline_users']]
+                self._report('on the fly', len(sample), *self._on_the_fly(sample, options['top_n']))
+
+            transaction.set_rollback(True)
+
+    def _populate(self, rng, options):
+        """Create clustered users and a preferential attachment graph between them."""
+        cities = [
+            (rng.uniform(-50, 60), rng.uniform(-180, 180)) for _ in range(options['cities'])
+        ]
+
+        users = []
+        for i in range(options['users']):
+            city = cities[rng.randrange(len(cities))]
+            latitude, longitude = self._offset(
+                rng, *city, options['city_radius'] * math.sqrt(rng.random())
+            )
+            user = User(
+                id=uuid.uuid4(),
+                email=f'recommendation-{i}@example.com',
+                name=f'Recommendation User {i}',
+                password='!',
+                latitude=latitude,
+                longitude=longitude,
+            )
+            user.refresh_location_fields()
+            users.append(user)
+        User.objects.bulk_create(users, batch_size=5000)
+        user_ids = [user.id for user in users]
+
+        # Each new user befriends m earlier users, picked in proportion to
+        # their degree by drawing from the list of every friendship endpoint
+        m = max(1, options['edges'] // len(user_ids))
+        endpoints = list(range(m))
+        pairs = []
+        for new in range(m, len(user_ids)):
+            targets = set()
+            while len(targets) < m:
+                targets.add(rng.choice(endpoints))
+            for target in targets:
+                pairs.append((new, target))
+                endpoints += (new, target)
+
+        batch = []
+        for new, target in pairs:
+            from_id, to_id = user_ids[new], user_ids[target]
+            low, high = (from_id, to_id) if from_id < to_id else (to_id, from_id)
+            batch.append(Friendship(
+                from_user_id=from_id, to_user_id=to_id, user_low_id=low, user_high_id=high,
+                status='accepted'
+            ))
+            if len(batch) == 50_000:
+                Friendship.objects.bulk_create(batch, batch_size=5000)
+                batch = []
+        Friendship.objects.bulk_create(batch, batch_size=5000)
+        return sorted(user_ids), len(pairs)
+
+    @staticmethod
+    def _offset(rng, latitude, longitude, distance_km):
+        """Move a point a distance in a random direction."""
+        bearing = rng.uniform(0, 2 * math.pi)
+        latitude += math.degrees(distance_km * math.cos(bearing) / EARTH_RADIUS_KM)
+        longitude += math.degrees(
+            distance_km * math.sin(bearing) / (EARTH_RADIUS_KM * math.cos(math.radians(latitude)))
+        )
+        return latitude, (longitude + 180) % 360 - 180
+
+    @staticmethod
+    def _precompute(user_ids, graph, options):
+        """Score and store the recommendations of every user, a batch at a time."""
+        queries = QueryCounter()
+        stored = 0
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            for first in range(0, len(user_ids), options['batch_size']):
+                stored += compute_recommendations(
+                    user_ids[first:first + options['batch_size']], graph, options['top_n']
+                )
+        return queries.count, time.perf_counter() - start, stored
+
+    @staticmethod
+    def _read(user_ids, top_n):
+        """Read stored recommendations the way the endpoint does."""
+        queries = QueryCounter()
+        read = 0
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            for user_id in user_ids:
+                read += len(list(recommendations_for(User(id=user_id))[:top_n]))
+        return queries.count, time.perf_counter() - start, read
+
+    @staticmethod
+    def _on_the_fly(user_ids, top_n):
+        """Score users from their friends' friendships, read for each user."""
+        queries = QueryCounter()
+        found = 0
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            for user_id in user_ids:
+                related = set()
+                friends = set()
+                for from_id, to_id, friendship_status in Friendship.objects.filter(
+                    Q(from_user_id=user_id) | Q(to_user_id=user_id)
+                ).values_list('from_user_id', 'to_user_id', 'status'):
+                    other = to_id if from_id == user_id else from_id
+                    related.add(other)
+                    if friendship_status == 'accepted':
+                        friends.add(other)
+
+                mutual = Counter()
+                for from_id, to_id in Friendship.objects.filter(
+                    Q(from_user_id__in=friends) | Q(to_user_id__in=friends), status='accepted'
+                ).values_list('from_user_id', 'to_user_id'):
+                    for friend, candidate in ((from_id, to_id), (to_id, from_id)):
+                        if friend in friends and candidate != user_id and candidate not in related:
+                            mutual[candidate] += 1
+                found += len(mutual.most_common(top_n))
+        return queries.count, time.perf_counter() - start, found
+
+    def _report(self, phase, users, queries, elapsed, stored):
+        """Write one result row."""
+        self.stdout.write(
+            f"{phase:>12} {users:>8} {queries:>9} {elapsed:>9.2f} "
+            f"{1000 * elapsed / users:>9.3f} {stored:>9}"
+        )
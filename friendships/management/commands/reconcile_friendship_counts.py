@@ -0,0 +1,84 @@
+"""
+Reconcile the friendship counters stored on users.
+
+Users are read in primary key order, a chunk at a time, and every chunk is
+recounted and repaired by a pool of worker threads, each with its own
+database connection. Counters are only ever adjusted by signals, so drift
+comes from queryset updates or deletes that bypass them, or from writes made
+outside the application.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from friendships.counts import reconcile_counts
+from users.models import User
+
+
+def _reconcile_chunk(user_ids):
+    """Reconcile one chunk on a worker thread, then release its connection."""
+    try:
+        return reconcile_counts(user_ids)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    """Recount every user's friends, followers and following and fix the counters that drifted."""
+
+    help = 'Recompute the friendship counters of every user in parallel chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Users per chunk')
+        parser.add_argument('--workers', type=int, default=4, help='Chunks reconciled at once; 1 runs them in this thread')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        checked = fixed = 0
+
+        # SQLite allows a single writer, so its chunks run in this thread
+        if options['workers'] <= 1 or connection.vendor == 'sqlite':
+            for user_ids in self._chunks(options['chunk_size']):
+                chunk_checked, chunk_fixed = reconcile_counts(user_ids)
+                checked += chunk_checked
+                fixed += chunk_fixed
+            self._report(start, checked, fixed)
+            return
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            pending = []
+            for user_ids in self._chunks(options['chunk_size']):
+                pending.append(pool.submit(_reconcile_chunk, user_ids))
+                # Bound the chunks waiting in the pool
+                if len(pending) >= 2 * options['workers']:
+                    chunk_checked, chunk_fixed = pending.pop(0).result()
+                    checked += chunk_checked
+                    fixed += chunk_fixed
+            for future in pending:
+                chunk_checked, chunk_fixed = future.result()
+                checked += chunk_checked
+                fixed += chunk_fixed
+
+        self._report(start, checked, fixed)
+
+    def _report(self, start, checked, fixed):
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked the friendship counters of {checked} users in "
+            f"{time.perf_counter() - start:.3f}s: {fixed} fixed"
+        ))
+
+    @staticmethod
+    def _chunks(chunk_size):
+        """Yield lists of user ids in primary key order."""
+        users = User.objects.order_by('pk').values_list('pk', flat=True)
+        last_pk = None
+        while True:
+            batch = users if last_pk is None else users.filter(pk__gt=last_pk)
+            user_ids = list(batch[:chunk_size])
+            if not user_ids:
+                return
+            yield user_ids
+            last_pk = user_ids[-1]
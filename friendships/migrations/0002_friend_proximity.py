@@ -0,0 +1,32 @@
+# Generated by Django 5.2.3 on 2026-10-17 06:51
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('friendships', '0001_initial'),
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FriendProximity',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('near_since', models.DateTimeField(auto_now_add=True, verbose_name='Near Since')),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='users.user', verbose_name='User (higher id)')),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='users.user', verbose_name='User (lower id)')),
+            ],
+            options={
+                'verbose_name': 'Friend Proximity',
+                'verbose_name_plural': 'Friend Proximities',
+                'db_table': 'friend_proximity',
+                'indexes': [models.Index(fields=['user_high'], name='friend_prox_user_hi_e78655_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user_low', 'user_high'), name='unique_friend_proximity_pair')],
+            },
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Backfills the canonical pair of existing friendships and removes duplicates.
+
+from django.db import migrations, transaction
+from django.db.models import Count
+
+BATCH_SIZE = 1000
+
+# When both directions of a pair exist, the row kept is the first by status,
+# then the oldest
+STATUS_PRIORITY = ['blocked', 'accepted', 'pending', 'declined']
+
+
+def backfill_friendship_pair(apps, schema_editor):
+    """
+    Store the ordered pair of every friendship and keep one row per pair.
+
+    Rows are walked in primary key order and each batch is written in its own
+    transaction, so the friendships table is never locked for the whole
+    backfill. Duplicates could only come from requests racing past the old
+    lookup before save; they are deleted so the unique pair constraint can be
+    added.
+    """
+    Friendship = apps.get_model('friendships', 'Friendship')
+    db_alias = schema_editor.connection.alias
+    friendships = Friendship.objects.using(db_alias)
+    pending = friendships.filter(user_low__isnull=True).order_by('pk')
+
+    last_pk = None
+    while True:
+        batch = pending if last_pk is None else pending.filter(pk__gt=last_pk)
+        rows = list(batch.only('pk', 'from_user', 'to_user')[:BATCH_SIZE])
+        if not rows:
+            break
+
+        for row in rows:
+            low, high = sorted([row.from_user_id, row.to_user_id])
+            row.user_low_id, row.user_high_id = low, high
+
+        with transaction.atomic(using=db_alias):
+            friendships.bulk_update(rows, ['user_low', 'user_high'])
+
+        last_pk = rows[-1].pk
+
+    # Duplicates are rare, so only their pairs are loaded
+    duplicate_pairs = list(
+        friendships.values('user_low', 'user_high').annotate(rows=Count('pk')).filter(
+            rows__gt=1
+        ).values_list('user_low', 'user_high')
+    )
+    for low, high in duplicate_pairs:
+        rows = sorted(
+            friendships.filter(user_low=low, user_high=high).values_list('pk', 'status', 'created_at'),
+            key=lambda row: (_priority(row[1]), row[2])
+        )
+        friendships.filter(pk__in=[pk for pk, _, _ in rows[1:]]).delete()
+
+
+def _priority(status):
+    """Rank of a status when choosing the row kept for a pair."""
+    return STATUS_PRIORITY.index(status) if status in STATUS_PRIORITY else len(STATUS_PRIORITY)
+
+
+class Migration(migrations.Migration):
+
+    # Commit every batch separately instead of wrapping the backfill in one transaction
+    atomic = False
+
+    dependencies = [
+        ('friendships', '0003_friendship_pair'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_friendship_pair, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.3 on 2026-10-17 10:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('friendships', '0005_friendship_pair_constraint'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FriendRecommendation',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('rank', models.PositiveSmallIntegerField(verbose_name='Rank')),
+                ('mutual_count', models.PositiveIntegerField(verbose_name='Mutual Friends')),
+                ('score', models.FloatField(verbose_name='Score')),
+                ('computed_at', models.DateTimeField(verbose_name='Computed At')),
+                ('candidate', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Candidate')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='friend_recommendations', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Friend Recommendation',
+                'verbose_name_plural': 'Friend Recommendations',
+                'db_table': 'friend_recommendation',
+                'constraints': [models.UniqueConstraint(fields=('user', 'rank'), name='unique_friend_recommendation_rank')],
+            },
+        ),
+    ]
@@ -5,7 +5,7 @@ This module defines the Friendship model to handle user relationships
 including following/followers functionality.
 """
 
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 import uuid
@@ -19,6 +19,11 @@ class Friendship(models.Model):
     - Following/followers relationships
     - Friendship status (pending, accepted, blocked)
     - Timestamps for relationship events
+
+    A pair of users has at most one friendship, whichever of them sent it.
+    Every row also stores its pair with the lower user id first, and a unique
+    constraint on that pair enforces this, so the relationship between two
+    users is found with a single index probe.
     """
 
     STATUS_CHOICES = [
@@ -44,6 +49,24 @@ class Friendship(models.Model):
         verbose_name="To User"
     )
 
+    # Canonical pair, set from the participants on save
+    user_low = models.ForeignKey(
+        'users.User',
+        on_delete=models.CASCADE,
+        related_name='+',
+        editable=False,
+        # Served by the unique pair constraint, which starts with this column
+        db_index=False,
+        verbose_name="User (lower id)"
+    )
+    user_high = models.ForeignKey(
+        'users.User',
+        on_delete=models.CASCADE,
+        related_name='+',
+        editable=False,
+        verbose_name="User (higher id)"
+    )
+
     # Relationship status
     status = models.CharField(
         max_length=10,
@@ -62,7 +85,12 @@ class Friendship(models.Model):
         verbose_name = "Friendship"
         verbose_name_plural = "Friendships"
         db_table = 'friendships'
-        unique_together = ['from_user', 'to_user']
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high'], name='unique_friendship_pair'),
+            models.CheckConstraint(
+                condition=~models.Q(from_user=models.F('to_user')), name='friendship_not_self'
+            ),
+        ]
         indexes = [
             models.Index(fields=['from_user', 'status']),
             models.Index(fields=['to_user', 'status']),
@@ -70,33 +98,84 @@ class Friendship(models.Model):
             models.Index(fields=['created_at']),
         ]
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Status as last loaded or saved, compared on save by friendships.signals;
+        # None when deferred
+        self._saved_status = self.__dict__.get('status')
+
     def __str__(self):
         """String representation of the Friendship model."""
         return f"{self.from_user.name} -> {self.to_user.name} ({self.status})"
 
     def clean(self):
         """Validate friendship data."""
-        if self.from_user == self.to_user:
+        if self.from_user_id == self.to_user_id:
             raise ValidationError("Users cannot be friends with themselves.")
 
-        # Check for existing friendship in either direction
-        existing_friendship = Friendship.objects.filter(
-            models.Q(from_user=self.from_user, to_user=self.to_user) |
-            models.Q(from_user=self.to_user, to_user=self.from_user)
-        ).exclude(id=self.id)
+    def save(self, *args, **kwargs):
+        """
+        Save the friendship and handle status changes.
 
-        if existing_friendship.exists():
-            raise ValidationError("A friendship relationship already exists between these users.")
+        Duplicates are rejected by the unique pair constraint rather than
+        looked up first, so two concurrent requests between the same users
+        cannot both succeed.
 
-    def save(self, *args, **kwargs):
-        """Save the friendship and handle status changes."""
+        Raises:
+            ValidationError: If the users are the same or already have a
+                friendship
+        """
         self.clean()
+        self.user_low_id, self.user_high_id = self.pair(self.from_user_id, self.to_user_id)
+        if self._saved_status is None and not self._state.adding:
+            # The signals need the stored status to tell which transition this is
+            self._saved_status = Friendship.objects.filter(pk=self.pk).values_list(
+                'status', flat=True
+            ).first()
 
         # Set accepted_at timestamp when status changes to accepted
         if self.status == 'accepted' and not self.accepted_at:
             self.accepted_at = timezone.now()
 
-        super().save(*args, **kwargs)
+        try:
+            # The savepoint keeps an enclosing transaction usable after a conflict
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+        except IntegrityError:
+            if Friendship.between(self.user_low_id, self.user_high_id).exclude(id=self.id).exists():
+                raise ValidationError(
+                    "A friendship relationship already exists between these users."
+                ) from None
+            raise
+
+    @staticmethod
+    def pair(user_id, other_id):
+        """
+        Order the ids of two users the way pairs are stored.
+
+        Args:
+            user_id: Id of one user
+            other_id: Id of the other user
+
+        Returns:
+            tuple: (lower id, higher id)
+        """
+        return (user_id, other_id) if user_id < other_id else (other_id, user_id)
+
+    @classmethod
+    def between(cls, user1, user2):
+        """
+        Get the friendship between two users, in either direction.
+
+        Args:
+            user1: First user instance or id
+            user2: Second user instance or id
+
+        Returns:
+            QuerySet: The friendship between the users, if any
+        """
+        user_low, user_high = cls.pair(getattr(user1, 'pk', user1), getattr(user2, 'pk', user2))
+        return cls.objects.filter(user_low=user_low, user_high=user_high)
 
     @property
     def is_accepted(self):
@@ -139,6 +218,8 @@ class Friendship(models.Model):
         """
         Get all accepted friends for a user.
 
+        Friend ids come from the adjacency cache (friendships.adjacency).
+
         Args:
             user: User instance
 
@@ -146,27 +227,40 @@ class Friendship(models.Model):
             QuerySet: Friends of the user
         """
         from users.models import User
+        from .adjacency import friend_ids
 
-        friend_id_tuples = cls.objects.filter(
-            models.Q(from_user=user, status='accepted') |
-            models.Q(to_user=user, status='accepted')
-        ).values_list('from_user_id', 'to_user_id')
+        return User.objects.filter(id__in=friend_ids(user.id))
 
-        # Extract friend IDs (excluding the user themselves)
-        friend_id_set = set()
-        for from_id, to_id in friend_id_tuples:
-            if from_id == user.id:
-                friend_id_set.add(to_id)
-            else:
-                friend_id_set.add(from_id)
+    @classmethod
+    def friends_of(cls, user):
+        """
+        Get all accepted friends for a user without materializing their ids.
+
+        Friendship is tested with correlated EXISTS subqueries, so combining
+        the result with other filters (e.g. a location filter) still runs as
+        a single query that only probes the friendships of matching users.
 
-        return User.objects.filter(id__in=friend_id_set)
+        Args:
+            user: User instance
+
+        Returns:
+            QuerySet: Friends of the user
+        """
+        from users.models import User
+
+        accepted = cls.objects.filter(status='accepted')
+        return User.objects.filter(
+            models.Exists(accepted.filter(from_user=user, to_user=models.OuterRef('pk'))) |
+            models.Exists(accepted.filter(to_user=user, from_user=models.OuterRef('pk')))
+        )
 
     @classmethod
     def get_followers(cls, user):
         """
         Get all followers for a user.
 
+        Follower ids come from the adjacency cache (friendships.adjacency).
+
         Args:
             user: User instance
 
@@ -174,19 +268,17 @@ class Friendship(models.Model):
             QuerySet: Followers of the user
         """
         from users.models import User
+        from .adjacency import follower_ids
 
-        follower_ids = cls.objects.filter(
-            to_user=user,
-            status='accepted'
-        ).values_list('from_user_id', flat=True)
-
-        return User.objects.filter(id__in=follower_ids)
+        return User.objects.filter(id__in=follower_ids(user.id))
 
     @classmethod
     def get_following(cls, user):
         """
         Get all users that a user is following.
 
+        Following ids come from the adjacency cache (friendships.adjacency).
+
         Args:
             user: User instance
 
@@ -194,13 +286,9 @@ class Friendship(models.Model):
             QuerySet: Users that the user is following
         """
         from users.models import User
+        from .adjacency import following_ids
 
-        following_ids = cls.objects.filter(
-            from_user=user,
-            status='accepted'
-        ).values_list('to_user_id', flat=True)
-
-        return User.objects.filter(id__in=following_ids)
+        return User.objects.filter(id__in=following_ids(user.id))
 
     @classmethod
     def are_friends(cls, user1, user2):
@@ -214,7 +302,112 @@ class Friendship(models.Model):
         Returns:
             bool: True if users are friends, False otherwise
         """
-        return cls.objects.filter(
-            models.Q(from_user=user1, to_user=user2, status='accepted') |
-            models.Q(from_user=user2, to_user=user1, status='accepted')
-        ).exists()
+        return cls.between(user1, user2).filter(status='accepted').exists()
+
+
+class FriendProximity(models.Model):
+    """
+    Proximity state of a pair of friends.
+
+    A row exists while two friends are within the proximity alert radius of
+    each other, so the proximity engine (friendships.proximity) only has to
+    compare a user's current neighbourhood with the user's rows to know
+    which friends entered or left. Each pair is stored once, with the lower
+    user id first.
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+
+    user_low = models.ForeignKey(
+        'users.User',
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name="User (lower id)"
+    )
+    user_high = models.ForeignKey(
+        'users.User',
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name="User (higher id)"
+    )
+
+    near_since = models.DateTimeField(auto_now_add=True, verbose_name="Near Since")
+
+    class Meta:
+        """Meta options for the FriendProximity model."""
+        verbose_name = "Friend Proximity"
+        verbose_name_plural = "Friend Proximities"
+        db_table = 'friend_proximity'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user_low', 'user_high'], name='unique_friend_proximity_pair'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['user_high']),
+        ]
+
+    def __str__(self):
+        """String representation of the FriendProximity model."""
+        return f"{self.user_low_id} <-> {self.user_high_id}"
+
+    @staticmethod
+    def pair(user_id, other_id):
+        """
+        Order the ids of two users the way pairs are stored.
+
+        Args:
+            user_id: Id of one user
+            other_id: Id of the other user
+
+        Returns:
+            tuple: (lower id, higher id)
+        """
+        return Friendship.pair(user_id, other_id)
+
+
+class FriendRecommendation(models.Model):
+    """
+    A precomputed "people you may know" recommendation.
+
+    The recommendation engine (friendships.recommendations) periodically
+    replaces each user's rows with their top candidates, ranked from 0, so
+    reading a user's recommendations is a single range scan of the
+    (user, rank) index. Rows for two users who have since connected are
+    deleted as the friendship is created (see friendships.signals).
+    """
+
+    id = models.BigAutoField(primary_key=True)
+
+    user = models.ForeignKey(
+        'users.User',
+        on_delete=models.CASCADE,
+        related_name='friend_recommendations',
+        # Served by the unique rank constraint, which starts with this column
+        db_index=False,
+        verbose_name="User"
+    )
+    candidate = models.ForeignKey(
+        'users.User',
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name="Candidate"
+    )
+
+    rank = models.PositiveSmallIntegerField(verbose_name="Rank")
+    mutual_count = models.PositiveIntegerField(verbose_name="Mutual Friends")
+    score = models.FloatField(verbose_name="Score")
+    computed_at = models.DateTimeField(verbose_name="Computed At")
+
+    class Meta:
+        """Meta options for the FriendRecommendation model."""
+        verbose_name = "Friend Recommendation"
+        verbose_name_plural = "Friend Recommendations"
+        db_table = 'friend_recommendation'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'rank'], name='unique_friend_recommendation_rank'),
+        ]
+
+    def __str__(self):
+        """String representation of the FriendRecommendation model."""
+        return f"{self.user_id} -> {self.candidate_id} (#{self.rank})"
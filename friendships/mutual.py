@@ -0,0 +1,73 @@
+"""
+Mutual friends of two users.
+
+With the adjacency cache enabled, mutual friends are the intersection of the
+two users' cached friend id sets, and mutual counts for a batch of targets
+cost two cache round trips (see adjacency.get_many). Without it, mutual
+friends are found with one query testing both friendships of every user
+through the pair indexes, and mutual counts with two grouped queries. Users
+are only loaded for the page of mutual friends a response returns.
+"""
+
+from django.db.models import Count
+
+from . import adjacency
+from .models import Friendship
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+# Most targets whose mutual counts are requested at once
+MAX_COUNT_TARGETS = 100
+
+
+def mutual_friend_ids(user_id, other_id):
+    """
+    Get the ids of the mutual friends of two users.
+
+    Args:
+        user_id: Id of one user
+        other_id: Id of the other user
+
+    Returns:
+        list: Ids of the users who are friends with both, in id order
+    """
+    if adjacency.is_enabled():
+        entries = adjacency.get_many([user_id, other_id])
+        return sorted(entries[user_id].friends & entries[other_id].friends)
+
+    return list(
+        (Friendship.friends_of(user_id) & Friendship.friends_of(other_id))
+        .order_by('id').values_list('id', flat=True)
+    )
+
+
+def mutual_counts(user_id, target_ids):
+    """
+    Count the mutual friends of a user and each of several targets.
+
+    Args:
+        user_id: Id of the user
+        target_ids: Ids of the targets
+
+    Returns:
+        dict: Number of mutual friends per target id
+    """
+    if adjacency.is_enabled():
+        entries = adjacency.get_many([user_id, *target_ids])
+        friends = entries[user_id].friends
+        return {
+            target_id: len(friends & entries[target_id].friends) for target_id in target_ids
+        }
+
+    accepted = Friendship.objects.filter(status='accepted')
+    friends = Friendship.friends_of(user_id).values('id')
+    counts = dict.fromkeys(target_ids, 0)
+    # Each friendship of a target with one of the user's friends is one mutual friend
+    for target_field, friend_field in (('from_user_id', 'to_user_id'), ('to_user_id', 'from_user_id')):
+        rows = accepted.filter(
+            **{f'{target_field}__in': target_ids, f'{friend_field}__in': friends}
+        ).values(target_field).annotate(count=Count('pk')).values_list(target_field, 'count')
+        for target_id, count in rows:
+            counts[target_id] += count
+    return counts
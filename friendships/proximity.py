@@ -0,0 +1,205 @@
+"""
+Proximity alert engine for friends.
+
+When users move, the engine works out which of their accepted friends came
+within the alert radius and which moved away since the last evaluation.
+Pair state lives in FriendProximity rows, one per pair of friends currently
+near each other, so only transitions are emitted.
+
+Each moved user costs one query that finds the user's neighbours with the
+bounding box and unit vector chord test the nearby endpoints use (see
+UserQuerySet.within_radius) and probes the friendship of each neighbour, so
+the work grows with the user's neighbourhood rather than with the size of
+the friend list. A pair leaves only once it is farther apart than the radius
+plus a hysteresis margin, so GPS jitter around the boundary does not produce
+a stream of enter and leave alerts.
+"""
+
+import logging
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import Q
+
+from users.models import User
+from users.utils import bounding_box, chord_distances, chord_threshold, unit_vector
+from .models import Friendship, FriendProximity
+from .signals import friend_proximity_changed
+
+logger = logging.getLogger(__name__)
+
+# Users evaluated per batch of state reads and writes
+BATCH_SIZE = 500
+
+
+def evaluate_proximity(user_ids, radius_km=None, hysteresis_km=None):
+    """
+    Update the proximity state of some users and emit the transitions.
+
+    Pair state does not record the radius it was computed with, so every
+    evaluation should use the same radius.
+
+    Args:
+        user_ids: Ids of the users who moved
+        radius_km: Alert radius, PROXIMITY_ALERT_RADIUS_KM by default
+        hysteresis_km: Extra distance before a near pair leaves,
+            PROXIMITY_ALERT_HYSTERESIS_KM by default
+
+    Returns:
+        dict: Numbers of users evaluated and of pairs that entered and left
+    """
+    radius_km = settings.PROXIMITY_ALERT_RADIUS_KM if radius_km is None else radius_km
+    if hysteresis_km is None:
+        hysteresis_km = settings.PROXIMITY_ALERT_HYSTERESIS_KM
+
+    user_ids = list(dict.fromkeys(user_ids))
+    totals = {'evaluated': 0, 'entered': 0, 'left': 0}
+    for start in range(0, len(user_ids), BATCH_SIZE):
+        evaluated, entered, left = _evaluate_batch(
+            user_ids[start:start + BATCH_SIZE], radius_km, radius_km + hysteresis_km
+        )
+        totals['evaluated'] += evaluated
+        totals['entered'] += len(entered)
+        totals['left'] += len(left)
+
+    logger.info(
+        f"Evaluated proximity of {totals['evaluated']} users: "
+        f"{totals['entered']} pairs entered, {totals['left']} left"
+    )
+    return totals
+
+
+def _evaluate_batch(user_ids, radius_km, exit_radius_km):
+    """
+    Evaluate one batch of moved users.
+
+    A pair of friends who both moved in the batch is decided by whichever of
+    them is evaluated first; both see the same current positions.
+
+    Returns:
+        tuple: (users evaluated, entered pairs, left pairs), where entered
+        pairs are (low id, high id, distance_km) and left pairs (low id, high id)
+    """
+    users = User.objects.filter(id__in=user_ids).only(
+        'id', 'latitude', 'longitude', 'is_active'
+    )
+
+    # Pairs currently near, keyed by pair, holding the row id
+    previous = {
+        (low, high): row_id
+        for row_id, low, high in FriendProximity.objects.filter(
+            Q(user_low__in=user_ids) | Q(user_high__in=user_ids)
+        ).values_list('id', 'user_low_id', 'user_high_id')
+    }
+    near_friends = {}
+    for low, high in previous:
+        near_friends.setdefault(low, set()).add(high)
+        near_friends.setdefault(high, set()).add(low)
+
+    connection = connections[router.db_for_read(User)]
+    sql = _neighbourhood_sql(connection)
+
+    decided = set()
+    entered = []
+    left = []
+    evaluated = 0
+    with connection.cursor() as cursor:
+        for user in users:
+            evaluated += 1
+            if user.is_active and user.has_location:
+                neighbours = _friends_within(cursor, sql, user, exit_radius_km)
+            else:
+                neighbours = {}
+
+            for friend_id, distance in neighbours.items():
+                pair = FriendProximity.pair(user.id, friend_id)
+                if pair in decided:
+                    continue
+                decided.add(pair)
+                if pair not in previous and distance <= radius_km:
+                    entered.append((*pair, distance))
+
+            for friend_id in near_friends.get(user.id, ()):
+                pair = FriendProximity.pair(user.id, friend_id)
+                if pair not in decided:
+                    decided.add(pair)
+                    left.append(pair)
+
+    FriendProximity.objects.bulk_create(
+        [FriendProximity(user_low_id=low, user_high_id=high) for low, high, _ in entered],
+        ignore_conflicts=True
+    )
+    if left:
+        FriendProximity.objects.filter(id__in=[previous[pair] for pair in left]).delete()
+
+    if entered or left:
+        friend_proximity_changed.send(sender=FriendProximity, entered=entered, left=left)
+
+    return evaluated, entered, left
+
+
+def _neighbourhood_sql(connection):
+    """
+    Build the query selecting the active friends of a user within a circle.
+
+    The statement is built once per batch and run once per user: compiling
+    the equivalent queryset costs several times more than running it.
+    Parameters are listed by _neighbourhood_params.
+    """
+    quote = connection.ops.quote_name
+
+    def column(model, name):
+        return f'{quote(model._meta.db_table)}.{quote(model._meta.get_field(name).column)}'
+
+    users = quote(User._meta.db_table)
+    friendships = quote(Friendship._meta.db_table)
+    user_id = column(User, 'id')
+    longitude = column(User, 'longitude')
+    chord = ' + '.join(
+        f'({column(User, name)} - %s) * ({column(User, name)} - %s)'
+        for name in ('loc_x', 'loc_y', 'loc_z')
+    )
+    friendship = (
+        f'EXISTS (SELECT 1 FROM {friendships} WHERE {column(Friendship, "status")} = %s '
+        f'AND {column(Friendship, "from_user")} = {{from_user}} '
+        f'AND {column(Friendship, "to_user")} = {{to_user}})'
+    )
+
+    return (
+        f'SELECT {user_id}, {chord} FROM {users} '
+        f'WHERE {column(User, "is_active")} = %s '
+        f'AND {column(User, "latitude")} BETWEEN %s AND %s '
+        f'AND ({longitude} BETWEEN %s AND %s OR {longitude} BETWEEN %s AND %s) '
+        f'AND {chord} <= %s '
+        f'AND ({friendship.format(from_user="%s", to_user=user_id)} '
+        f'OR {friendship.format(from_user=user_id, to_user="%s")})'
+    )
+
+
+def _neighbourhood_params(connection, user, radius_km):
+    """Parameters of the _neighbourhood_sql query for a user and radius."""
+    latitude, longitude = user.get_location_tuple()
+    min_lat, max_lat, lon_ranges = bounding_box(latitude, longitude, radius_km)
+    # Circles crossing the antimeridian need two longitude ranges; others repeat one
+    (west_min, west_max), (east_min, east_max) = (lon_ranges * 2)[:2]
+    # Every coordinate of the center appears twice in each chord expression
+    center = [value for value in unit_vector(latitude, longitude) for _ in range(2)]
+    user_id = User._meta.pk.get_db_prep_value(user.pk, connection)
+
+    return [
+        *center, True, min_lat, max_lat, west_min, west_max, east_min, east_max,
+        *center, chord_threshold(radius_km),
+        'accepted', user_id, 'accepted', user_id,
+    ]
+
+
+def _friends_within(cursor, sql, user, radius_km):
+    """Map the active friends within a radius of a user to their distances."""
+    cursor.execute(sql, _neighbourhood_params(cursor.db, user, radius_km))
+    rows = cursor.fetchall()
+    if not rows:
+        return {}
+
+    to_python = User._meta.pk.to_python
+    ids, chords = zip(*rows)
+    return dict(zip(map(to_python, ids), chord_distances(chords).tolist()))
@@ -0,0 +1,352 @@
+"""
+Friend-of-friend ("people you may know") recommendations.
+
+A user's candidates are the users two accepted friendships away, scored by
+the number of mutual friends they share. When RECOMMENDATIONS_PROXIMITY_WEIGHT
+is positive and both users are located, the score is multiplied by
+1 + weight * exp(-distance / RECOMMENDATIONS_PROXIMITY_SCALE_KM), so among
+candidates with as many mutual friends the nearer ones rank first. Users with
+any friendship with the user, accepted, pending, blocked or declined, and
+inactive users are never candidates.
+
+Scores are precomputed and the top RECOMMENDATIONS_TOP_N candidates of each
+user replace their FriendRecommendation rows, so reading them is a single
+range scan of the (user, rank) index. Users are split into
+RECOMMENDATIONS_SHARDS ranges of their primary key, evenly filled since ids
+are random UUIDs, and each shard is computed by one Celery task
+(friendships.tasks). A task loads the accepted friendship graph once as
+compressed sparse rows of integer user indexes, then scores its users a
+batch at a time, expanding and counting their two-hop paths with numpy.
+Friendships that are not accepted, or changed since the graph was loaded,
+are read per batch to be excluded, so requests sent while a shard runs are
+not recommended.
+"""
+
+import logging
+import time
+import uuid
+
+import numpy as np
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from users.models import User
+from users.utils import haversine_distances
+from .models import Friendship, FriendRecommendation
+
+logger = logging.getLogger(__name__)
+
+# Rows read per round trip when loading the graph, and written per executemany
+LOAD_CHUNK_SIZE = 20_000
+INSERT_BATCH_SIZE = 5000
+
+
+class FriendGraph:
+    """
+    Accepted friendships as compressed sparse rows.
+
+    Users are numbered in the order they were first seen. The friends of user
+    i are neighbors[offsets[i]:offsets[i + 1]], and latitudes, longitudes
+    (NaN when not located) and active are aligned with the numbering.
+    loaded_at is when the friendships started being read.
+    """
+
+    def __init__(self, ids, sources, targets, locations, loaded_at):
+        self.ids = ids
+        self.loaded_at = loaded_at
+        self.index = {user_id: i for i, user_id in enumerate(ids)}
+        self._db_ids = {}
+
+        # Every friendship is a neighbor of both of its users
+        sources, targets = np.concatenate([sources, targets]), np.concatenate([targets, sources])
+        order = np.argsort(sources, kind='stable')
+        self.neighbors = targets[order]
+        self.offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(ids)), out=self.offsets[1:])
+
+        self.latitudes = np.full(len(ids), np.nan)
+        self.longitudes = np.full(len(ids), np.nan)
+        self.active = np.zeros(len(ids), dtype=bool)
+        for user_id, is_active, latitude, longitude in locations:
+            i = self.index.get(user_id)
+            if i is not None:
+                self.active[i] = is_active
+                if latitude is not None and longitude is not None:
+                    self.latitudes[i], self.longitudes[i] = latitude, longitude
+
+    @classmethod
+    def load(cls):
+        """
+        Read the accepted friendships and the users they connect.
+
+        Returns:
+            FriendGraph: Graph of every accepted friendship
+        """
+        loaded_at = timezone.now()
+        ids, index = [], {}
+        sources, targets = [], []
+        rows = Friendship.objects.filter(status='accepted').values_list(
+            'from_user_id', 'to_user_id'
+        ).iterator(chunk_size=LOAD_CHUNK_SIZE)
+        for from_id, to_id in rows:
+            for user_id, side in ((from_id, sources), (to_id, targets)):
+                i = index.get(user_id)
+                if i is None:
+                    i = index[user_id] = len(ids)
+                    ids.append(user_id)
+                side.append(i)
+
+        locations = User.objects.values_list(
+            'id', 'is_active', 'latitude', 'longitude'
+        ).iterator(chunk_size=LOAD_CHUNK_SIZE)
+        return cls(
+            ids, np.array(sources, dtype=np.int64), np.array(targets, dtype=np.int64), locations,
+            loaded_at
+        )
+
+    def db_ids(self, connection):
+        """User ids prepared for queries on a connection, computed once."""
+        if connection.alias not in self._db_ids:
+            pk = User._meta.pk
+            self._db_ids[connection.alias] = [
+                pk.get_db_prep_value(user_id, connection) for user_id in self.ids
+            ]
+        return self._db_ids[connection.alias]
+
+    def neighbors_of(self, nodes):
+        """
+        Expand nodes into their neighbors.
+
+        Args:
+            nodes: Numpy array of node indexes
+
+        Returns:
+            tuple: (position in nodes, neighbor) numpy arrays of every edge
+        """
+        starts = self.offsets[nodes]
+        lengths = self.offsets[nodes + 1] - starts
+        positions = np.repeat(np.arange(len(nodes)), lengths)
+        # Concatenated ranges starts[k]:starts[k] + lengths[k]
+        steps = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return positions, self.neighbors[np.repeat(starts, lengths) + steps]
+
+
+def shard_bounds(shard, shards):
+    """
+    Get the primary key range of a shard of users.
+
+    Args:
+        shard: Shard number, from 0
+        shards: Number of shards
+
+    Returns:
+        tuple: (first id, id past the last or None for the last shard)
+
+    Raises:
+        ValueError: If the shard number is out of range
+    """
+    if not 0 <= shard < shards:
+        raise ValueError(f'shard must be between 0 and {shards - 1}')
+    low = uuid.UUID(int=shard * 2 ** 128 // shards)
+    high = uuid.UUID(int=(shard + 1) * 2 ** 128 // shards) if shard + 1 < shards else None
+    return low, high
+
+
+def compute_shard(shard, shards=None, batch_size=None):
+    """
+    Recompute the recommendations of the active users of a shard.
+
+    Args:
+        shard: Shard number, from 0
+        shards: Number of shards, RECOMMENDATIONS_SHARDS by default
+        batch_size: Users scored at once, RECOMMENDATIONS_BATCH_SIZE by default
+
+    Returns:
+        dict: Numbers of users scored and recommendations stored
+    """
+    shards = shards or settings.RECOMMENDATIONS_SHARDS
+    batch_size = batch_size or settings.RECOMMENDATIONS_BATCH_SIZE
+    low, high = shard_bounds(shard, shards)
+    start = time.perf_counter()
+
+    users = User.objects.filter(is_active=True, pk__gte=low).order_by('pk')
+    if high is not None:
+        users = users.filter(pk__lt=high)
+
+    graph = FriendGraph.load()
+    result = {'users': 0, 'recommendations': 0}
+    last_pk = None
+    while True:
+        batch = users if last_pk is None else users.filter(pk__gt=last_pk)
+        user_ids = list(batch.values_list('pk', flat=True)[:batch_size])
+        if not user_ids:
+            break
+        result['users'] += len(user_ids)
+        result['recommendations'] += compute_recommendations(user_ids, graph)
+        last_pk = user_ids[-1]
+
+    logger.info(
+        f"Computed friend recommendations of shard {shard}/{shards}: {result['users']} users, "
+        f"{result['recommendations']} recommendations in {time.perf_counter() - start:.1f}s"
+    )
+    return result
+
+
+def compute_recommendations(user_ids, graph=None, top_n=None):
+    """
+    Recompute and store the recommendations of some users.
+
+    Args:
+        user_ids: Ids of the users
+        graph: FriendGraph to score with, loaded when not given
+        top_n: Candidates kept per user, RECOMMENDATIONS_TOP_N by default
+
+    Returns:
+        int: Number of recommendations stored
+    """
+    graph = graph or FriendGraph.load()
+    top_n = settings.RECOMMENDATIONS_TOP_N if top_n is None else top_n
+
+    users = [graph.index[user_id] for user_id in user_ids if user_id in graph.index]
+    users, candidates, mutual_counts, scores = _score(graph, np.array(users, dtype=np.int64))
+
+    # Best score first, then most mutual friends, then lowest index for stable ties
+    order = np.lexsort((candidates, -mutual_counts, -scores, users))
+    users, candidates = users[order], candidates[order]
+    mutual_counts, scores = mutual_counts[order], scores[order]
+    starts = np.ones(len(users), dtype=bool)
+    starts[1:] = users[1:] != users[:-1]
+    ranks = np.arange(len(users)) - np.flatnonzero(starts)[np.cumsum(starts) - 1]
+    kept = np.flatnonzero(ranks < top_n)
+
+    with transaction.atomic():
+        FriendRecommendation.objects.filter(user_id__in=user_ids).delete()
+        _insert(graph, users[kept], candidates[kept], ranks[kept], mutual_counts[kept], scores[kept])
+    return len(kept)
+
+
+def _insert(graph, users, candidates, ranks, mutual_counts, scores):
+    """
+    Insert recommendations with one parameterized INSERT.
+
+    QuerySet.bulk_create builds a model instance and prepares every value of
+    every row, which costs far more Python time than the database spends on
+    the rows. User ids are prepared once per graph instead, and the rows are
+    written with executemany.
+    """
+    connection = connections[router.db_for_write(FriendRecommendation)]
+    meta = FriendRecommendation._meta
+    columns = [
+        meta.get_field(name).column
+        for name in ('user', 'candidate', 'rank', 'mutual_count', 'score', 'computed_at')
+    ]
+    quote = connection.ops.quote_name
+
+    sql = 'INSERT INTO {table} ({columns}) VALUES ({values})'.format(
+        table=quote(meta.db_table),
+        columns=', '.join(quote(column) for column in columns),
+        values=', '.join(['%s'] * len(columns)),
+    )
+    db_ids = graph.db_ids(connection)
+    computed_at = meta.get_field('computed_at').get_db_prep_save(timezone.now(), connection)
+    params = [
+        (db_ids[user], db_ids[candidate], rank, mutual_count, score, computed_at)
+        for user, candidate, rank, mutual_count, score in zip(
+            users.tolist(), candidates.tolist(), ranks.tolist(), mutual_counts.tolist(), scores.tolist()
+        )
+    ]
+
+    with connection.cursor() as cursor:
+        for start in range(0, len(params), INSERT_BATCH_SIZE):
+            cursor.executemany(sql, params[start:start + INSERT_BATCH_SIZE])
+
+
+def _score(graph, users):
+    """
+    Score the two-hop candidates of some users.
+
+    Returns:
+        tuple: (user, candidate, mutual friends, score) numpy arrays, one
+        entry per pair of a user and a candidate
+    """
+    empty = np.zeros(0, dtype=np.int64)
+    if not len(users):
+        return empty, empty, empty, np.zeros(0)
+
+    positions, friends = graph.neighbors_of(users)
+    hops, candidates = graph.neighbors_of(friends)
+    owners = users[positions[hops]]
+
+    # Each pair is one int64 code, so counting paths is a single unique
+    size = len(graph.ids)
+    codes = owners * size + candidates
+    # Inactive users are neither candidates nor mutual friends
+    kept = (candidates != owners) & graph.active[candidates] & graph.active[friends[hops]]
+    # Friends are excluded through the graph, other relationships from the database
+    related = np.concatenate([users[positions] * size + friends, _related_codes(graph, users)])
+    codes = codes[kept & ~np.isin(codes, related)]
+    codes, mutual_counts = np.unique(codes, return_counts=True)
+    owners, candidates = codes // size, codes % size
+
+    scores = mutual_counts.astype(np.float64)
+    weight = settings.RECOMMENDATIONS_PROXIMITY_WEIGHT
+    if weight > 0 and len(codes):
+        scores *= 1 + weight * _proximity(graph, owners, candidates)
+    # Ranked as stored, so equal stored scores fall back to the tie breaks
+    return owners, candidates, mutual_counts, np.round(scores, 4)
+
+
+def _related_codes(graph, users):
+    """
+    Pair codes of the users and everyone they have a friendship with that the graph misses.
+
+    These are the friendships that are not accepted, and any changed since
+    the graph was loaded.
+    """
+    user_ids = [graph.ids[user] for user in users]
+    rows = Friendship.objects.filter(
+        Q(from_user_id__in=user_ids) | Q(to_user_id__in=user_ids),
+        ~Q(status='accepted') | Q(updated_at__gte=graph.loaded_at)
+    ).values_list('from_user_id', 'to_user_id')
+
+    size = len(graph.ids)
+    batch = set(users.tolist())
+    codes = []
+    for from_id, to_id in rows:
+        pair = graph.index.get(from_id), graph.index.get(to_id)
+        for user, other in (pair, pair[::-1]):
+            if user in batch and other is not None:
+                codes.append(user * size + other)
+    return np.array(codes, dtype=np.int64)
+
+
+def _proximity(graph, owners, candidates):
+    """Proximity factor in [0, 1] of each pair, 0 when either user is not located."""
+    distances = np.full(len(owners), np.nan)
+    # Pairs are sorted by user, so each user's candidates are one slice
+    bounds = np.flatnonzero(np.diff(owners)) + 1
+    for start, end in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(owners)]])):
+        owner = owners[start]
+        if not np.isnan(graph.latitudes[owner]):
+            distances[start:end] = haversine_distances(
+                graph.latitudes[owner], graph.longitudes[owner],
+                graph.latitudes[candidates[start:end]], graph.longitudes[candidates[start:end]]
+            )
+    return np.nan_to_num(np.exp(-distances / settings.RECOMMENDATIONS_PROXIMITY_SCALE_KM))
+
+
+def recommendations_for(user):
+    """
+    Get the stored recommendations of a user.
+
+    Args:
+        user: User instance
+
+    Returns:
+        QuerySet: FriendRecommendation rows with their candidates, best first
+    """
+    return FriendRecommendation.objects.filter(
+        user=user, candidate__is_active=True
+    ).select_related('candidate').order_by('rank')
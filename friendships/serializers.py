@@ -5,7 +5,7 @@ This module provides serializers for handling friendship relationships
 in REST API requests and responses.
 """
 
-from django.db import models
+from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework import serializers
 from .models import Friendship
 from users.serializers import UserListSerializer
@@ -36,6 +36,8 @@ class FriendshipCreateSerializer(serializers.ModelSerializer):
     Serializer for creating new friendships.
 
     This serializer handles friendship request creation with validation.
+    An existing friendship between the users is detected by the database's
+    unique pair constraint when the request is saved, not looked up first.
     """
 
     class Meta:
@@ -50,21 +52,17 @@ class FriendshipCreateSerializer(serializers.ModelSerializer):
         if value == request_user:
             raise serializers.ValidationError("You cannot send a friend request to yourself.")
 
-        # Check if friendship already exists
-        existing_friendship = Friendship.objects.filter(
-            models.Q(from_user=request_user, to_user=value) |
-            models.Q(from_user=value, to_user=request_user)
-        )
-
-        if existing_friendship.exists():
-            raise serializers.ValidationError("A friendship relationship already exists with this user.")
-
         return value
 
     def create(self, validated_data):
         """Create a new friendship request."""
         validated_data['from_user'] = self.context['request'].user
-        return super().create(validated_data)
+        try:
+            return super().create(validated_data)
+        except DjangoValidationError:
+            raise serializers.ValidationError(
+                {'to_user': ["A friendship relationship already exists with this user."]}
+            ) from None
 
 
 class FriendshipUpdateSerializer(serializers.ModelSerializer):
@@ -0,0 +1,95 @@
+"""
+Signal handlers for the Friendships app.
+
+This module invalidates the cached nearby friends of both users whenever a
+friendship between them is saved or deleted, updates their friendship
+counters and adjacency cache entries when it becomes or stops being
+accepted, drops the recommendations of two users to each other once a
+friendship between them is created, queues proximity evaluation for users
+who moved, and defines friend_proximity_changed, sent by the proximity
+engine (friendships.proximity) with the pairs of friends that came near
+each other or moved apart.
+"""
+
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal, receiver
+
+from users import nearby_cache
+from users.models import User
+from users.signals import locations_updated
+from . import adjacency, counts
+from .models import Friendship, FriendProximity, FriendRecommendation
+
+# Sent with entered, a list of (low id, high id, distance_km) tuples, and
+# left, a list of (low id, high id) tuples
+friend_proximity_changed = Signal()
+
+
+@receiver(post_save, sender=Friendship)
+@receiver(post_delete, sender=Friendship)
+def invalidate_nearby_friends(sender, instance, **kwargs):
+    """Invalidate the cached nearby friends of both sides of a friendship."""
+    if nearby_cache.is_enabled():
+        nearby_cache.invalidate_friends(instance.from_user_id)
+        nearby_cache.invalidate_friends(instance.to_user_id)
+
+
+@receiver(post_save, sender=Friendship)
+@receiver(post_delete, sender=Friendship)
+def update_accepted_friendship(sender, instance, **kwargs):
+    """
+    Follow a friendship becoming or stopping being accepted.
+
+    Counters are adjusted in the transaction of the change; the adjacency
+    cache is updated once it commits.
+    """
+    was_accepted = not kwargs.get('created') and instance._saved_status == 'accepted'
+    is_accepted = instance.is_accepted and kwargs['signal'] is post_save
+    instance._saved_status = instance.status
+    if was_accepted == is_accepted:
+        return
+
+    counts.adjust_counts(instance.from_user_id, instance.to_user_id, 1 if is_accepted else -1)
+    if adjacency.is_enabled():
+        transaction.on_commit(
+            partial(adjacency.refresh_pair, instance.from_user_id, instance.to_user_id)
+        )
+
+
+@receiver(post_save, sender=Friendship)
+@receiver(post_delete, sender=Friendship)
+def clear_friend_proximity(sender, instance, created=False, **kwargs):
+    """Forget the proximity state of two users who are no longer friends."""
+    # A new friendship has no state yet, and accepted friends keep theirs
+    if kwargs['signal'] is post_save and (created or instance.is_accepted):
+        return
+
+    low, high = FriendProximity.pair(instance.from_user_id, instance.to_user_id)
+    FriendProximity.objects.filter(user_low_id=low, user_high_id=high).delete()
+
+
+@receiver(post_save, sender=Friendship)
+def drop_friend_recommendations(sender, instance, created, **kwargs):
+    """Stop recommending two users to each other once either sends a request."""
+    if created:
+        FriendRecommendation.objects.filter(
+            Q(user_id=instance.from_user_id, candidate_id=instance.to_user_id) |
+            Q(user_id=instance.to_user_id, candidate_id=instance.from_user_id)
+        ).delete()
+
+
+@receiver(locations_updated, sender=User)
+def queue_proximity_evaluation(sender, user_ids, **kwargs):
+    """Evaluate the friend proximity of users once their new locations are committed."""
+    if not settings.PROXIMITY_ALERTS_ENABLED:
+        return
+
+    from users.tasks import evaluate_friend_proximity
+
+    ids = [str(user_id) for user_id in user_ids]
+    transaction.on_commit(lambda: evaluate_friend_proximity.delay(ids))
@@ -0,0 +1,39 @@
+"""
+Background tasks for the Friendships app.
+
+This module contains Celery tasks for friendship-related background processing.
+"""
+
+from celery import shared_task
+from django.conf import settings
+
+from . import recommendations
+
+
+@shared_task
+def refresh_friend_recommendations():
+    """
+    Queue the recomputation of every shard of friend recommendations.
+
+    Returns:
+        int: Number of shard tasks queued
+    """
+    shards = settings.RECOMMENDATIONS_SHARDS
+    for shard in range(shards):
+        compute_friend_recommendations.delay(shard, shards)
+    return shards
+
+
+@shared_task
+def compute_friend_recommendations(shard, shards):
+    """
+    Recompute the friend recommendations of one shard of users.
+
+    Args:
+        shard: Shard number, from 0
+        shards: Number of shards the users are split into
+
+    Returns:
+        dict: Numbers of users scored and recommendations stored
+    """
+    return recommendations.compute_shard(shard, shards)
@@ -5,19 +5,45 @@ This module contains comprehensive tests for friendship models, serializers, vie
 and API endpoints.
 """
 
+import math
+import os
+import tempfile
+import uuid
 from decimal import Decimal
-from django.test import TestCase
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from rest_framework.test import APITestCase, APIClient, APIRequestFactory
-from rest_framework import status
+from rest_framework import serializers, status
 from rest_framework.authtoken.models import Token
 
-from .models import Friendship
+from users import nearby_cache
+from users.location_updates import apply_location_updates
+from users.utils import calculate_distance
+from . import adjacency
+from .models import Friendship, FriendProximity, FriendRecommendation
+from .proximity import evaluate_proximity
+from .recommendations import FriendGraph, compute_recommendations, compute_shard, recommendations_for, shard_bounds
 from .serializers import FriendshipSerializer, FriendshipCreateSerializer
+from .signals import friend_proximity_changed
 
 User = get_user_model()
 
+# A cache every process can read, as the adjacency cache requires
+SHARED_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'friendships-tests-shared-cache'),
+    }
+}
+
 
 class FriendshipModelTest(TestCase):
     """Test cases for the Friendship model."""
@@ -80,6 +106,28 @@ class FriendshipModelTest(TestCase):
                 status='accepted'
             )
 
+    def test_friendship_validation_reverse_duplicate(self):
+        """Test that a friendship in the opposite direction is a duplicate too."""
+        Friendship.objects.create(from_user=self.user1, to_user=self.user2, status='pending')
+
+        with self.assertRaises(ValidationError):
+            Friendship.objects.create(from_user=self.user2, to_user=self.user1, status='pending')
+
+        # The conflict does not break the enclosing transaction
+        self.assertEqual(Friendship.objects.count(), 1)
+
+    def test_between(self):
+        """Test finding the friendship of a pair from either side."""
+        friendship = Friendship.objects.create(from_user=self.user2, to_user=self.user1)
+        self.assertEqual(
+            {friendship.user_low_id, friendship.user_high_id}, {self.user1.id, self.user2.id}
+        )
+        self.assertLess(friendship.user_low_id, friendship.user_high_id)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(Friendship.between(self.user1, self.user2).get(), friendship)
+        self.assertEqual(Friendship.between(self.user2.id, self.user1.id).get(), friendship)
+
     def test_friendship_properties(self):
         """Test friendship properties."""
         friendship = Friendship.objects.create(
@@ -136,6 +184,16 @@ class FriendshipModelTest(TestCase):
         self.assertEqual(len(friends), 1)
         self.assertEqual(friends[0], self.user1)
 
+    def test_friends_of(self):
+        """Test the friends queryset covers both directions of accepted friendships."""
+        user3 = User.objects.create_user('user3@example.com', name='User 3', password='pass123')
+        Friendship.objects.create(from_user=self.user1, to_user=self.user2, status='accepted')
+        Friendship.objects.create(from_user=user3, to_user=self.user1, status='pending')
+
+        self.assertEqual(list(Friendship.friends_of(self.user1)), [self.user2])
+        self.assertEqual(list(Friendship.friends_of(self.user2)), [self.user1])
+        self.assertEqual(list(Friendship.friends_of(user3)), [])
+
     def test_get_followers(self):
         """Test getting user's followers."""
         Friendship.objects.create(
@@ -221,6 +279,18 @@ class FriendshipSerializerTest(TestCase):
             print(f"Serializer errors: {serializer.errors}")
         self.assertTrue(serializer.is_valid())
 
+    def test_friendship_create_serializer_duplicate(self):
+        """Test FriendshipCreateSerializer rejects a request to an existing friend on save."""
+        request = self.factory.post('/api/friendships/', {}, format='json')
+        request.user = self.user2
+        serializer = FriendshipCreateSerializer(
+            data={'to_user': str(self.user1.id)}, context={'request': request}
+        )
+        self.assertTrue(serializer.is_valid())
+        with self.assertRaises(serializers.ValidationError) as raised:
+            serializer.save()
+        self.assertIn('to_user', raised.exception.detail)
+
     def test_friendship_create_serializer_self_friend(self):
         """Test FriendshipCreateSerializer with self-friend attempt."""
         data = {
@@ -270,6 +340,15 @@ class FriendshipAPITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(Friendship.objects.count(), 1)
 
+    def test_create_duplicate_friendship_request(self):
+        """Test that a request to a user who already sent one is rejected."""
+        Friendship.objects.create(from_user=self.user2, to_user=self.user1, status='pending')
+
+        response = self.client.post(reverse('friendship-list'), {'to_user': self.user2.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('to_user', response.data['fields'])
+        self.assertEqual(Friendship.objects.count(), 1)
+
     def test_create_friendship_request_to_self(self):
         """Test creating a friendship request to oneself."""
         url = reverse('friendship-list')
@@ -426,6 +505,270 @@ class FriendshipAPITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data['nearby_friends']), 1)
 
+    @override_settings(SPATIAL_INDEX_ENABLED=False)
+    def test_nearby_friends_cache_invalidated_by_friendships(self):
+        """Test that friendship changes invalidate cached nearby friends."""
+        cache.clear()
+        for user in (self.user1, self.user2, self.user3):
+            user.latitude, user.longitude = Decimal('40.7128'), Decimal('-74.0060')
+            user.save()
+
+        url = reverse('friendship-nearby-friends')
+        friendship = Friendship.objects.create(from_user=self.user1, to_user=self.user2, status='accepted')
+        self.assertEqual([f['id'] for f in self.client.get(url).data['nearby_friends']], [str(self.user2.id)])
+        self.assertEqual(len(self.client.get(url).data['nearby_friends']), 1)
+        self.assertEqual(nearby_cache.stats()['friends']['hits'], 1)
+
+        Friendship.objects.create(from_user=self.user3, to_user=self.user1, status='accepted')
+        self.assertEqual(len(self.client.get(url).data['nearby_friends']), 2)
+
+        friendship.delete()
+        self.assertEqual([f['id'] for f in self.client.get(url).data['nearby_friends']], [str(self.user3.id)])
+
+    @override_settings(NEARBY_CACHE_ENABLED=False, SPATIAL_INDEX_ENABLED=False)
+    def test_nearby_friends_radius_in_distance_mode(self):
+        """Test the radius and ranking follow the distance mode on the SQL path."""
+        # Geodesic distances at the equator are shorter than haversine ones
+        # along the meridian and longer along the equator
+        for user, latitude, longitude in (
+            (self.user1, '0', '0'), (self.user2, '0.0901', '0'), (self.user3, '0', '0.0899')
+        ):
+            user.latitude, user.longitude = Decimal(latitude), Decimal(longitude)
+            user.save()
+        Friendship.objects.create(from_user=self.user1, to_user=self.user2, status='accepted')
+        Friendship.objects.create(from_user=self.user3, to_user=self.user1, status='accepted')
+
+        for mode, friend in (('haversine', self.user3), ('exact', self.user2)):
+            response = self.client.get(
+                reverse('friendship-nearby-friends'), {'radius': 10, 'distance_mode': mode}
+            )
+            self.assertEqual([f['id'] for f in response.data['nearby_friends']], [str(friend.id)])
+            self.assertLessEqual(response.data['nearby_friends'][0]['distance_km'], 10)
+
+            response = self.client.get(
+                reverse('friendship-nearby-rings'), {'radii': '10', 'distance_mode': mode}
+            )
+            self.assertEqual([f['id'] for f in response.data['rings'][0]['friends']], [str(friend.id)])
+
+    def test_nearby_friends_pagination(self):
+        """Test paging through nearby friends with a cursor."""
+        for i, user in enumerate((self.user1, self.user2, self.user3)):
+            user.latitude, user.longitude = Decimal('40.7128') + Decimal(i) / 100, Decimal('-74.0060')
+            user.save()
+
+        Friendship.objects.create(from_user=self.user1, to_user=self.user2, status='accepted')
+        Friendship.objects.create(from_user=self.user3, to_user=self.user1, status='accepted')
+
+        url = reverse('friendship-nearby-friends')
+        for enabled in (True, False):
+            with override_settings(SPATIAL_INDEX_ENABLED=enabled, CACHES=SHARED_CACHES):
+                response = self.client.get(url, {'page_size': 1})
+                self.assertEqual([f['id'] for f in response.data['nearby_friends']], [str(self.user2.id)])
+
+                response = self.client.get(url, {'page_size': 1, 'cursor': response.data['next_cursor']})
+                self.assertEqual([f['id'] for f in response.data['nearby_friends']], [str(self.user3.id)])
+                self.assertIsNone(response.data['next_cursor'])
+
+    def test_nearby_friends_query_count_independent_of_friend_count(self):
+        """Test that a page of nearby friends is read with the same queries for any friend count."""
+        self.user1.latitude, self.user1.longitude = Decimal('40.7128'), Decimal('-74.0060')
+        self.user1.save()
+
+        def add_friends(start, count):
+            for i in range(start, start + count):
+                friend = User.objects.create_user(
+                    f'friend{i}@example.com', name=f'Friend {i}', password='pass123',
+                    latitude=Decimal('40.7128') + Decimal(i) / 10000, longitude=Decimal('-74.0060'),
+                )
+                Friendship.objects.create(from_user=self.user1, to_user=friend, status='accepted')
+
+        url = reverse('friendship-nearby-friends')
+        query_counts = []
+        for start, count in ((0, 5), (5, 45)):
+            add_friends(start, count)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, {'page_size': 3})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(response.data['nearby_friends']), 3)
+            query_counts.append(len(queries))
+
+        self.assertEqual(query_counts[0], query_counts[1])
+
+        # The page is the closest friends, refined with exact distances
+        distances = [f['distance_km'] for f in response.data['nearby_friends']]
+        self.assertEqual(distances, sorted(distances))
+        self.assertAlmostEqual(distances[0], 0.0, places=2)
+
+    def test_nearby_friends_invalid_cursor(self):
+        """Test that a malformed cursor is rejected."""
+        self.user1.latitude, self.user1.longitude = Decimal('40.7128'), Decimal('-74.0060')
+        self.user1.save()
+
+        response = self.client.get(reverse('friendship-nearby-friends'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_nearest_friends(self):
+        """Test getting the k nearest friends."""
+        self.user1.latitude, self.user1.longitude = Decimal('40.7128'), Decimal('-74.0060')
+        self.user1.save()
+        self.user2.latitude, self.user2.longitude = Decimal('41.7128'), Decimal('-74.0060')
+        self.user2.save()
+        self.user3.latitude, self.user3.longitude = Decimal('40.8128'), Decimal('-74.0060')
+        self.user3.save()
+
+        # A nearby stranger must not be returned
+        User.objects.create_user(
+            'stranger@example.com', name='Stranger', password='pass123',
+            latitude=Decimal('40.7129'), longitude=Decimal('-74.0060'),
+        )
+
+        Friendship.objects.create(from_user=self.user1, to_user=self.user2, status='accepted')
+        Friendship.objects.create(from_user=self.user3, to_user=self.user1, status='accepted')
+
+        for enabled in (True, False):
+            with override_settings(SPATIAL_INDEX_ENABLED=enabled, CACHES=SHARED_CACHES):
+                response = self.client.get(reverse('friendship-nearest') + '?k=1')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(
+                    [f['id'] for f in response.data['nearest_friends']], [str(self.user3.id)]
+                )
+
+                response = self.client.get(reverse('friendship-nearest'))
+                self.assertEqual(
+                    [f['id'] for f in response.data['nearest_friends']],
+                    [str(self.user3.id), str(self.user2.id)],
+                )
+
+    def test_mutual(self):
+        """Test listing and counting mutual friends."""
+        mutual = []
+        for i in range(3):
+            friend = User.objects.create_user(f'mutual{i}@example.com', name=f'Mutual {i}', password='pass123')
+            Friendship.objects.create(from_user=self.user1, to_user=friend, status='accepted')
+            Friendship.objects.create(from_user=friend, to_user=self.user2, status='accepted')
+            mutual.append(str(friend.id))
+        # Friends of only one of them, or not accepted, are not mutual
+        Friendship.objects.create(from_user=self.user1, to_user=self.user3, status='accepted')
+        Friendship.objects.create(from_user=self.user2, to_user=self.user3, status='pending')
+        mutual.sort()
+
+        for enabled in (True, False):
+            with override_settings(ADJACENCY_CACHE_ENABLED=enabled, CACHES=SHARED_CACHES):
+                response = self.client.get(reverse('friendship-mutual'), {'user_id': self.user2.id, 'limit': 2})
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.data['count'], 3)
+                self.assertEqual([f['id'] for f in response.data['mutual_friends']], mutual[:2])
+                response = self.client.get(
+                    reverse('friendship-mutual'),
+                    {'user_id': self.user2.id, 'limit': 2, 'offset': response.data['next_offset']}
+                )
+                self.assertEqual([f['id'] for f in response.data['mutual_friends']], mutual[2:])
+                self.assertIsNone(response.data['next_offset'])
+
+                response = self.client.get(
+                    reverse('friendship-mutual-counts'),
+                    {'ids': f'{self.user2.id},{self.user3.id},{uuid.uuid4()}'}
+                )
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(list(response.data['counts'].values()), [3, 0, 0])
+
+        response = self.client.get(reverse('friendship-mutual'), {'user_id': uuid.uuid4()})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(reverse('friendship-mutual'), {'user_id': self.user2.id, 'limit': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(
+            reverse('friendship-mutual-counts'), {'ids': ','.join(str(uuid.uuid4()) for _ in range(101))}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_nearby_rings(self):
+        """Test bucketing nearby friends into distance rings."""
+        self.user1.latitude, self.user1.longitude = Decimal('40.7128'), Decimal('-74.0060')
+        self.user1.save()
+        friends = []
+        # Friends about 0.5, 3, 8 and 20 km north, and one out of range
+        for i, offset in enumerate(['0.0045', '0.027', '0.072', '0.18', '0.5']):
+            friend = User.objects.create_user(
+                f'ring{i}@example.com', name=f'Ring {i}', password='pass123',
+                latitude=Decimal('40.7128') + Decimal(offset), longitude=Decimal('-74.0060'),
+            )
+            Friendship.objects.create(from_user=self.user1, to_user=friend, status='accepted')
+            friends.append(str(friend.id))
+        self.user2.latitude, self.user2.longitude = Decimal('40.7130'), Decimal('-74.0060')
+        self.user2.save()
+
+        url = reverse('friendship-nearby-rings')
+        for enabled in (True, False):
+            with override_settings(SPATIAL_INDEX_ENABLED=enabled, CACHES=SHARED_CACHES):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.data['count'], 4)
+                self.assertEqual(
+                    [(ring['min_km'], ring['max_km']) for ring in response.data['rings']],
+                    [(0, 1), (1, 5), (5, 10), (10, 25)],
+                )
+                self.assertEqual(
+                    [[f['id'] for f in ring['friends']] for ring in response.data['rings']],
+                    [[friend] for friend in friends[:4]],
+                )
+
+                # Rings match separate nearby_friends searches
+                response = self.client.get(url, {'radii': '10,3', 'limit': 1})
+                self.assertEqual([ring['count'] for ring in response.data['rings']], [1, 2])
+                self.assertEqual(len(response.data['rings'][1]['friends']), 1)
+                nearby = self.client.get(reverse('friendship-nearby-friends'), {'radius': 3})
+                self.assertEqual(response.data['rings'][0]['friends'][0], nearby.data['nearby_friends'][0])
+
+        for params in ({'radii': '1,x'}, {'radii': '-1'}, {'radii': ','.join(map(str, range(1, 13)))},
+                       {'limit': 0}):
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_distance_matrix(self):
+        """Test the distance matrix between the user and their friends."""
+        self.user1.latitude, self.user1.longitude = Decimal('40.7128'), Decimal('-74.0060')
+        self.user1.save()
+        self.user2.latitude, self.user2.longitude = Decimal('51.5074'), Decimal('-0.1278')
+        self.user2.save()
+        self.user3.latitude, self.user3.longitude = Decimal('40.8128'), Decimal('-74.0060')
+        self.user3.save()
+        Friendship.objects.create(from_user=self.user1, to_user=self.user2, status='accepted')
+        Friendship.objects.create(from_user=self.user3, to_user=self.user1, status='accepted')
+
+        url = reverse('friendship-distance-matrix')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(response.data['user_ids'][0], str(self.user1.id))
+
+        users = {str(user.id): user for user in (self.user1, self.user2, self.user3)}
+        for mode in ('haversine', 'fast', 'exact'):
+            matrix = self.client.get(url, {'distance_mode': mode}).data['distances_km']
+            for i, first in enumerate(response.data['user_ids']):
+                self.assertEqual(matrix[i][i], 0)
+                for j, second in enumerate(response.data['user_ids']):
+                    self.assertEqual(matrix[i][j], matrix[j][i])
+                    expected = calculate_distance(
+                        *users[first].get_location_tuple(), *users[second].get_location_tuple()
+                    )
+                    # The fast mode is only accurate over short distances
+                    if mode != 'fast' or expected < 100:
+                        self.assertAlmostEqual(matrix[i][j], expected, delta=expected * 0.006 + 0.01)
+
+        stranger = User.objects.create_user(
+            'stranger@example.com', name='Stranger', password='pass123',
+            latitude=Decimal('40.7129'), longitude=Decimal('-74.0060'),
+        )
+        response = self.client.get(url, {'ids': f'{self.user3.id},{stranger.id}'})
+        self.assertEqual(response.data['user_ids'], [str(self.user1.id), str(self.user3.id)])
+        self.assertEqual(response.data['missing_ids'], [str(stranger.id)])
+        self.assertAlmostEqual(response.data['distances_km'][0][1], 11.12, delta=0.01)
+
+        response = self.client.get(url, {'ids': 'not-an-id'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(url, {'distance_mode': 'bogus'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_nearby_friends_without_location(self):
         """Test getting nearby friends without location."""
         # Create friendship without location
@@ -478,3 +821,355 @@ class FriendshipAPITest(APITestCase):
         url = reverse('friendship-list')
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(CACHES=SHARED_CACHES)
+class AdjacencyCacheTest(TestCase):
+    """Test cases for the friendship adjacency cache."""
+
+    def setUp(self):
+        """Set up users and cache each one's adjacency before any friendship."""
+        cache.clear()
+        self.users = [
+            User.objects.create_user(f'adjacent{i}@example.com', name=f'Adjacent {i}', password='pass123')
+            for i in range(3)
+        ]
+        adjacency.clear_local()
+        for user in self.users:
+            adjacency.get_adjacency(user.id)
+
+    def test_updates_on_status_changes(self):
+        """Test entries follow accept, block, unblock and delete without reloading."""
+        first, second, _ = self.users
+
+        with self.captureOnCommitCallbacks(execute=True):
+            friendship = Friendship.objects.create(from_user=first, to_user=second)
+        self.assertEqual(adjacency.friend_ids(first.id), frozenset())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            friendship.accept()
+        with self.assertNumQueries(0):
+            self.assertEqual(adjacency.following_ids(first.id), {second.id})
+            self.assertEqual(adjacency.follower_ids(second.id), {first.id})
+            self.assertEqual(adjacency.friend_ids(second.id), {first.id})
+            self.assertEqual(adjacency.follower_ids(first.id), frozenset())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            friendship.block()
+        with self.assertNumQueries(0):
+            self.assertEqual(adjacency.friend_ids(first.id), frozenset())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            friendship.unblock()
+            friendship.accept()
+            self.assertEqual(adjacency.friend_ids(first.id), frozenset())
+        self.assertEqual(adjacency.friend_ids(first.id), {second.id})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            friendship.delete()
+        self.assertEqual(adjacency.friend_ids(second.id), frozenset())
+
+    def test_concurrent_writer_forces_reload(self):
+        """Test an entry another writer moved past is reloaded, not patched."""
+        first, second, third = self.users
+        Friendship.objects.create(from_user=first, to_user=third, status='accepted')
+        # Another process bumped the version without rewriting the entry
+        cache.incr(adjacency._version_key(first.id))
+
+        adjacency.refresh_pair(first.id, second.id)
+        self.assertIsNone(cache.get(adjacency._entry_key(first.id)))
+        self.assertEqual(adjacency.friend_ids(first.id), {third.id})
+
+    def test_change_reaches_other_processes(self):
+        """Test an in-process entry of another worker is not served after a change."""
+        first, second, _ = self.users
+        self.assertTrue(adjacency.is_enabled())
+        # The entries another worker holds in its own in-process cache
+        other_process = dict(adjacency._local)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.create(from_user=first, to_user=second, status='accepted')
+
+        adjacency.clear_local()
+        adjacency._local.update(other_process)
+        with self.assertNumQueries(0):
+            self.assertEqual(adjacency.friend_ids(first.id), {second.id})
+            self.assertEqual(adjacency.friend_ids(second.id), {first.id})
+
+    def test_process_local_cache_is_bypassed(self):
+        """Test friend lists come from the database when workers cannot share versions."""
+        first, second, _ = self.users
+        with override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+        }):
+            self.assertFalse(adjacency.is_enabled())
+            adjacency.get_adjacency(first.id)
+            # Written by another worker, whose refresh never reaches this one
+            Friendship.objects.create(from_user=first, to_user=second, status='accepted')
+            self.assertEqual(adjacency.friend_ids(first.id), {second.id})
+
+    def test_friend_lists_read_the_cache(self):
+        """Test the friend list queries take their ids from the cache."""
+        first, second, third = self.users
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.create(from_user=first, to_user=second, status='accepted')
+            Friendship.objects.create(from_user=third, to_user=first, status='accepted')
+
+        # Only the user rows are queried
+        with self.assertNumQueries(3):
+            self.assertEqual(set(Friendship.get_friends(first)), {second, third})
+            self.assertEqual(list(Friendship.get_following(first)), [second])
+            self.assertEqual(list(Friendship.get_followers(first)), [third])
+
+
+class FriendshipCountsTest(TestCase):
+    """Test cases for the friendship counters stored on users."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.users = [
+            User.objects.create_user(f'counted{i}@example.com', name=f'Counted {i}', password='pass123')
+            for i in range(3)
+        ]
+
+    def assert_counts(self, user, friends, followers, following):
+        user.refresh_from_db()
+        self.assertEqual(
+            (user.friends_count, user.followers_count, user.following_count),
+            (friends, followers, following),
+        )
+
+    def test_transitions(self):
+        """Test counters follow every change into and out of the accepted status."""
+        first, second, third = self.users
+        friendship = Friendship.objects.create(from_user=first, to_user=second)
+        self.assert_counts(first, 0, 0, 0)
+
+        friendship.accept()
+        self.assert_counts(first, 1, 0, 1)
+        self.assert_counts(second, 1, 1, 0)
+
+        # Saving a stale user instance leaves the counters alone
+        second.name = 'Renamed'
+        second.save()
+        self.assert_counts(second, 1, 1, 0)
+
+        friendship.block()
+        self.assert_counts(first, 0, 0, 0)
+        self.assert_counts(second, 0, 0, 0)
+
+        friendship.unblock()
+        friendship.accept()
+        Friendship.objects.create(from_user=third, to_user=first, status='accepted')
+        self.assert_counts(first, 2, 1, 1)
+
+        # Deleting a user deletes their friendships, and counts them out of their friends'
+        third.delete()
+        self.assert_counts(first, 1, 0, 1)
+        Friendship.objects.get(pk=friendship.pk).delete()
+        self.assert_counts(first, 0, 0, 0)
+        self.assert_counts(second, 0, 0, 0)
+
+    def test_reconcile(self):
+        """Test the reconcile command repairs drifted counters."""
+        first, second, third = self.users
+        Friendship.objects.create(from_user=first, to_user=second, status='accepted')
+        Friendship.objects.create(from_user=third, to_user=first, status='accepted')
+        # Queryset updates bypass the signals
+        Friendship.objects.filter(from_user=third).update(status='blocked')
+        User.objects.filter(pk=second.pk).update(friends_count=7)
+
+        out = StringIO()
+        call_command('reconcile_friendship_counts', chunk_size=2, workers=1, stdout=out)
+        self.assertIn('3 fixed', out.getvalue())
+        self.assert_counts(first, 1, 0, 1)
+        self.assert_counts(second, 1, 1, 0)
+        self.assert_counts(third, 0, 0, 0)
+
+    def test_friends_endpoint_counts(self):
+        """Test the friends endpoint reports the stored counters."""
+        first, second, third = self.users
+        Friendship.objects.create(from_user=first, to_user=second, status='accepted')
+        Friendship.objects.create(from_user=third, to_user=first, status='accepted')
+
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=first).key}')
+        response = client.get(reverse('friendship-friends'))
+        self.assertEqual(
+            [response.data[name] for name in ('friends_count', 'followers_count', 'following_count')],
+            [2, 1, 1],
+        )
+
+
+@override_settings(RECOMMENDATIONS_PROXIMITY_WEIGHT=0.5, RECOMMENDATIONS_PROXIMITY_SCALE_KM=25)
+class FriendRecommendationTest(TestCase):
+    """Test cases for friend-of-friend recommendations."""
+
+    def setUp(self):
+        """Set up a small graph around one user."""
+        def make(name, **kwargs):
+            return User.objects.create_user(f'{name}@example.com', name=name, password='pass123', **kwargs)
+
+        self.user = make('me', latitude=Decimal('40.7128'), longitude=Decimal('-74.0060'))
+        a, b, c = make('a'), make('b'), make('c')
+        self.x, self.v = make('x'), make('v')
+        # About 5 km north of the user
+        self.z = make('z', latitude=Decimal('40.7578'), longitude=Decimal('-74.0060'))
+        y, w, q = make('y'), make('w'), make('q', is_active=False)
+
+        for friend in (a, b, c):
+            Friendship.objects.create(from_user=self.user, to_user=friend, status='accepted')
+        for from_user, to_user in ((a, self.x), (self.x, b), (c, self.x), (c, self.z), (a, self.z),
+                                   (b, self.v), (self.v, c), (a, y), (b, w), (a, q), (b, q), (c, q)):
+            Friendship.objects.create(from_user=from_user, to_user=to_user, status='accepted')
+        # Pending and blocked relationships are never recommended
+        Friendship.objects.create(from_user=self.user, to_user=y)
+        Friendship.objects.create(from_user=w, to_user=self.user, status='blocked')
+
+    def test_ranking(self):
+        """Test candidates are ranked by mutual friends, boosted by proximity."""
+        compute_recommendations([self.user.id])
+        rows = list(recommendations_for(self.user))
+        self.assertEqual([row.candidate_id for row in rows], [self.x.id, self.z.id, self.v.id])
+        self.assertEqual([row.mutual_count for row in rows], [3, 2, 2])
+        self.assertEqual([row.rank for row in rows], [0, 1, 2])
+        self.assertAlmostEqual(rows[1].score, 2 * (1 + 0.5 * math.exp(-5.0 / 25)), places=2)
+
+        compute_recommendations([self.user.id], top_n=1)
+        self.assertEqual([row.candidate_id for row in recommendations_for(self.user)], [self.x.id])
+
+        # A request between the two users drops the recommendation
+        Friendship.objects.create(from_user=self.user, to_user=self.x)
+        self.assertFalse(recommendations_for(self.user).exists())
+
+        # Requests sent after the graph was loaded are still excluded
+        graph = FriendGraph.load()
+        Friendship.objects.create(from_user=self.v, to_user=self.user)
+        compute_recommendations([self.user.id], graph)
+        self.assertEqual([row.candidate_id for row in recommendations_for(self.user)], [self.z.id])
+
+    def test_shards(self):
+        """Test the shards cover every active user once."""
+        users = sum(compute_shard(shard, shards=3, batch_size=2)['users'] for shard in range(3))
+        self.assertEqual(users, User.objects.filter(is_active=True).count())
+        self.assertEqual(recommendations_for(self.user).count(), 3)
+        # Recommendations go both ways
+        self.assertTrue(FriendRecommendation.objects.filter(user=self.x, candidate=self.user).exists())
+        with self.assertRaises(ValueError):
+            shard_bounds(3, 3)
+
+    def test_endpoint(self):
+        """Test reading recommendations is a single query."""
+        compute_recommendations([self.user.id])
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with self.assertNumQueries(1):
+            response = client.get(reverse('friendship-recommendations'), {'limit': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(row['id'], row['mutual_count']) for row in response.data['recommendations']],
+            [(str(self.x.id), 3), (str(self.z.id), 2)],
+        )
+        response = client.get(reverse('friendship-recommendations'), {'limit': 21})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(PROXIMITY_ALERT_RADIUS_KM=10, PROXIMITY_ALERT_HYSTERESIS_KM=1)
+class FriendProximityTest(TestCase):
+    """Test cases for the friend proximity alert engine."""
+
+    def setUp(self):
+        """Set up a user with a near friend, a far friend and a near stranger."""
+        self.user = User.objects.create_user(
+            'mover@example.com', name='Mover', password='pass123',
+            latitude=Decimal('40.7128'), longitude=Decimal('-74.0060'),
+        )
+        self.near = User.objects.create_user(
+            'near@example.com', name='Near', password='pass123',
+            latitude=Decimal('40.7628'), longitude=Decimal('-74.0060'),
+        )
+        self.far = User.objects.create_user(
+            'far@example.com', name='Far', password='pass123',
+            latitude=Decimal('41.7128'), longitude=Decimal('-74.0060'),
+        )
+        User.objects.create_user(
+            'stranger@example.com', name='Stranger', password='pass123',
+            latitude=Decimal('40.7129'), longitude=Decimal('-74.0060'),
+        )
+        Friendship.objects.create(from_user=self.user, to_user=self.near, status='accepted')
+        Friendship.objects.create(from_user=self.far, to_user=self.user, status='accepted')
+
+        self.transitions = []
+        friend_proximity_changed.connect(self.record)
+        self.addCleanup(friend_proximity_changed.disconnect, self.record)
+
+    def record(self, sender, entered, left, **kwargs):
+        self.transitions.append(
+            ({(low, high) for low, high, _ in entered}, set(left))
+        )
+
+    def move(self, user, latitude):
+        user.latitude = latitude
+        user.save()
+        return evaluate_proximity([user.id])
+
+    def test_transitions_only(self):
+        """Test that entering and leaving are emitted once each."""
+        result = evaluate_proximity([self.user.id])
+        self.assertEqual(result, {'evaluated': 1, 'entered': 1, 'left': 0})
+        self.assertEqual(self.transitions, [({FriendProximity.pair(self.user.id, self.near.id)}, set())])
+
+        # Nothing changed, so nothing is emitted
+        self.assertEqual(evaluate_proximity([self.user.id, self.near.id])['entered'], 0)
+        self.assertEqual(len(self.transitions), 1)
+
+        # The far friend comes within the radius
+        self.assertEqual(self.move(self.far, Decimal('40.7628'))['entered'], 1)
+
+        # Moving just past the radius stays within the hysteresis margin
+        self.assertEqual(self.move(self.near, Decimal('40.7128') + Decimal('0.095'))['left'], 0)
+
+        result = self.move(self.near, Decimal('41.7128'))
+        self.assertEqual(result['left'], 1)
+        self.assertEqual(self.transitions[-1], (set(), {FriendProximity.pair(self.user.id, self.near.id)}))
+        self.assertEqual(FriendProximity.objects.count(), 1)
+
+    def test_pair_moving_together_is_decided_once(self):
+        """Test that two friends moving in the same batch produce one transition."""
+        self.far.latitude = Decimal('40.7130')
+        self.far.save()
+
+        result = evaluate_proximity([self.user.id, self.far.id, self.near.id])
+        self.assertEqual(result, {'evaluated': 3, 'entered': 2, 'left': 0})
+        self.assertEqual(FriendProximity.objects.count(), 2)
+
+    def test_unfriending_clears_state(self):
+        """Test that ending a friendship drops the pair's state without an alert."""
+        evaluate_proximity([self.user.id])
+        Friendship.objects.get(to_user=self.near).delete()
+
+        self.assertFalse(FriendProximity.objects.exists())
+        self.assertEqual(evaluate_proximity([self.user.id])['left'], 0)
+
+    def test_location_updates_queue_evaluation(self):
+        """Test that written location updates queue a proximity evaluation on commit."""
+        with self.captureOnCommitCallbacks() as callbacks:
+            apply_location_updates([(self.user.id, 40.72, -74.0)])
+        self.assertEqual(len(callbacks), 1)
+
+        with override_settings(PROXIMITY_ALERTS_ENABLED=False):
+            with self.captureOnCommitCallbacks() as callbacks:
+                apply_location_updates([(self.user.id, 40.73, -74.0)])
+        self.assertEqual(callbacks, [])
+
+    def test_saved_location_queues_evaluation(self):
+        """Test that saving new coordinates queues an evaluation and other saves do not."""
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.user.latitude = Decimal('40.7200')
+            self.user.save()
+        self.assertEqual(len(callbacks), 1)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.user.name = 'Renamed'
+            self.user.save()
+        self.assertEqual(callbacks, [])
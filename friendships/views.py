@@ -6,6 +6,10 @@ CRUD operations, status management, and location-based friend queries.
 """
 
 import logging
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db.models import Q
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import status, filters
@@ -13,19 +17,35 @@ from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
-from geopy.distance import geodesic
 
 from .models import Friendship
+from .mutual import (
+    mutual_friend_ids, mutual_counts,
+    DEFAULT_LIMIT as MUTUAL_DEFAULT_LIMIT, MAX_LIMIT as MUTUAL_MAX_LIMIT,
+    MAX_COUNT_TARGETS as MUTUAL_MAX_COUNT_TARGETS
+)
+from .recommendations import recommendations_for
 from .serializers import (
     FriendshipSerializer, FriendshipCreateSerializer, FriendshipUpdateSerializer,
     FriendshipListSerializer, FriendshipStatusSerializer, UserFriendsSerializer,
     NearbyFriendsSerializer, FriendshipActionSerializer
 )
 from users.models import User
+from users.nearby import (
+    cached_nearby_friend_ids, users_within, iter_ranked, find_nearest_friends,
+    nearby_friend_ids, parse_radii, split_rings,
+    NEAREST_DEFAULT_K, NEAREST_MAX_K, RINGS_DEFAULT_LIMIT, RINGS_MAX_LIMIT
+)
+from users.distance import DEFAULT_DISTANCE_MODE, distance_matrix, get_distance_backend
+from users.pagination import DistanceCursorPagination
 from users.serializers import UserListSerializer
 
 logger = logging.getLogger(__name__)
 
+# Most users in one distance matrix, and in one measured pair by pair
+DISTANCE_MATRIX_MAX_USERS = 200
+DISTANCE_MATRIX_MAX_EXACT_USERS = 50
+
 
 class FriendshipViewSet(ModelViewSet):
     """
@@ -157,7 +177,8 @@ class FriendshipViewSet(ModelViewSet):
         """
         Get current user's friends list.
 
-        Returns accepted friends, followers, and following lists.
+        Returns accepted friends, followers, and following lists. Counts come
+        from the counters stored on the user, not from the lists.
         """
         user = request.user
 
@@ -175,9 +196,133 @@ class FriendshipViewSet(ModelViewSet):
             'friends': friends_serializer.data,
             'followers': followers_serializer.data,
             'following': following_serializer.data,
-            'friends_count': len(friends),
-            'followers_count': len(followers),
-            'following_count': len(following)
+            'friends_count': user.friends_count,
+            'followers_count': user.followers_count,
+            'following_count': user.following_count
+        })
+
+    @action(detail=False, methods=['get'])
+    def mutual(self, request):
+        """
+        Get the mutual friends of the requesting user and another user.
+
+        The user is given by `user_id`. Mutual friends are returned in id
+        order, `limit` (default 50) at a time from `offset`, with their total
+        `count`; only the returned page of users is loaded.
+        """
+        user_id = request.query_params.get('user_id')
+        if not user_id:
+            return Response(
+                {'error': 'user_id parameter is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            limit = int(request.query_params.get('limit', MUTUAL_DEFAULT_LIMIT))
+            offset = int(request.query_params.get('offset', 0))
+        except ValueError:
+            return Response(
+                {'error': 'limit and offset must be integers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if not 1 <= limit <= MUTUAL_MAX_LIMIT or offset < 0:
+            return Response(
+                {'error': f'limit must be between 1 and {MUTUAL_MAX_LIMIT} and offset at least 0'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            target_user = User.objects.only('id').get(id=user_id)
+        except (User.DoesNotExist, ValidationError):
+            return Response(
+                {'error': 'User not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        mutual_ids = mutual_friend_ids(request.user.id, target_user.id)
+        page_ids = mutual_ids[offset:offset + limit]
+        users = User.objects.in_bulk(page_ids)
+        next_offset = offset + limit if offset + limit < len(mutual_ids) else None
+
+        return Response({
+            'user_id': str(target_user.id),
+            'mutual_friends': UserListSerializer(
+                [users[user_id] for user_id in page_ids if user_id in users],
+                many=True, context={'request': request}
+            ).data,
+            'count': len(mutual_ids),
+            'next_offset': next_offset
+        })
+
+    @action(detail=False, methods=['get'])
+    def mutual_counts(self, request):
+        """
+        Count the mutual friends of the requesting user and each of several users.
+
+        The users are given by `ids` (comma-separated, at most 100). Ids of
+        unknown users count zero mutual friends.
+        """
+        try:
+            target_ids = list(dict.fromkeys(
+                uuid.UUID(value.strip()) for value in request.query_params.get('ids', '').split(',')
+            ))
+        except ValueError:
+            return Response(
+                {'error': 'ids must be comma-separated user ids'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if len(target_ids) > MUTUAL_MAX_COUNT_TARGETS:
+            return Response(
+                {'error': f'Mutual friends can be counted for at most {MUTUAL_MAX_COUNT_TARGETS} users'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        counts = mutual_counts(request.user.id, target_ids)
+        return Response({
+            'counts': {str(target_id): counts[target_id] for target_id in target_ids},
+            'count': len(target_ids)
+        })
+
+    @action(detail=False, methods=['get'])
+    def recommendations(self, request):
+        """
+        Get "people you may know" recommendations for the requesting user.
+
+        Returns up to `limit` friends of friends, best first, with their number
+        of mutual friends and score; `limit` defaults to, and is at most, the
+        RECOMMENDATIONS_TOP_N stored per user. Recommendations are precomputed
+        periodically (friendships.recommendations), so this is a single
+        indexed read.
+        """
+        try:
+            limit = int(request.query_params.get('limit', settings.RECOMMENDATIONS_TOP_N))
+        except ValueError:
+            return Response(
+                {'error': 'limit must be an integer'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if not 1 <= limit <= settings.RECOMMENDATIONS_TOP_N:
+            return Response(
+                {'error': f'limit must be between 1 and {settings.RECOMMENDATIONS_TOP_N}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        rows = list(recommendations_for(request.user)[:limit])
+
+        return Response({
+            'recommendations': [
+                {
+                    **UserListSerializer(row.candidate, context={'request': request}).data,
+                    'mutual_count': row.mutual_count,
+                    'score': row.score
+                }
+                for row in rows
+            ],
+            'count': len(rows),
+            'computed_at': rows[0].computed_at if rows else None
         })
 
     @action(detail=False, methods=['get'])
@@ -185,40 +330,64 @@ class FriendshipViewSet(ModelViewSet):
         """
         Find nearby friends based on geographic coordinates.
 
-        Returns friends within a specified radius (default 10km) of the requesting user.
+        Returns friends within a specified radius (default 10km) of the requesting user,
+        closest first. Results are paginated with the `cursor` and `page_size` query
+        parameters; pass `stream=1` to receive them as NDJSON instead. The
+        `distance_mode` parameter (fast, haversine or exact) selects how
+        distances are measured for the radius, the ordering and the response.
         """
         user = request.user
         radius = float(request.query_params.get('radius', 10))  # Default 10km
 
+        distance_mode = request.query_params.get('distance_mode', DEFAULT_DISTANCE_MODE)
+        try:
+            get_distance_backend(distance_mode)
+        except ValueError as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
         if not user.has_location:
             return Response(
                 {'error': 'User location not available'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Get user's friends
-        friends = Friendship.get_friends(user)
+        # Friendship is checked inside the location query, so the friend list
+        # is never loaded
+        friends = Friendship.friends_of(user)
+        user_location = user.get_location_tuple()
 
-        # Filter friends with location data
-        friends_with_location = friends.filter(
-            latitude__isnull=False,
-            longitude__isnull=False
-        )
+        paginator = DistanceCursorPagination()
+        ranked = cached_nearby_friend_ids(user, friends, radius, distance_mode)
+        if ranked is not None:
+            ids, distances = paginator.paginate_ranked(*ranked, request)
+        elif distance_mode == DEFAULT_DISTANCE_MODE:
+            ids, distances = paginator.paginate_queryset(
+                users_within(friends, user_location, radius), request
+            )
+        else:
+            # SQL orders by spherical chords, so other modes rank in memory
+            ids, distances = paginator.paginate_ranked(
+                *nearby_friend_ids(user, friends, radius, distance_mode), request
+            )
 
-        nearby_friends = []
-        user_location = user.get_location_tuple()
+        rows = (
+            {
+                **UserListSerializer(friend, context={'request': request}).data,
+                'distance_km': round(distance, 2),
+            }
+            for friend, distance in iter_ranked(User.objects.all(), ids, distances)
+        )
 
-        for friend in friends_with_location:
-            friend_location = friend.get_location_tuple()
-            if friend_location:
-                distance = geodesic(user_location, friend_location).kilometers
-                if distance <= radius:
-                    friend_data = UserListSerializer(friend, context={'request': request}).data
-                    friend_data['distance_km'] = round(distance, 2)
-                    nearby_friends.append(friend_data)
+        if paginator.streaming:
+            logger.info(
+                f"Streaming {len(ids)} nearby friends for user {user.email} within {radius}km"
+            )
+            return paginator.get_streaming_response(rows)
 
-        # Sort by distance
-        nearby_friends.sort(key=lambda x: x['distance_km'])
+        nearby_friends = list(rows)
 
         logger.info(
             f"Nearby friends query for user {user.email}: "
@@ -228,8 +397,236 @@ class FriendshipViewSet(ModelViewSet):
         return Response({
             'user_location': user_location,
             'radius_km': radius,
+            'distance_mode': distance_mode,
             'nearby_friends': nearby_friends,
-            'count': len(nearby_friends)
+            'count': len(nearby_friends),
+            'next_cursor': paginator.next_cursor
+        })
+
+    @action(detail=False, methods=['get'])
+    def nearby_rings(self, request):
+        """
+        Get the requesting user's friends bucketed into distance rings.
+
+        `radii` lists the ring radii in km (default 1,5,10,25); ring i holds
+        the friends farther than radius i - 1 and within radius i. Every ring
+        reports its full count and its `limit` (default 50) closest friends.
+        Distances are ranked once over the largest ring, so one request
+        replaces a nearby_friends call per radius. The `distance_mode`
+        parameter selects how distances are measured and ranked.
+        """
+        user = request.user
+
+        try:
+            radii = parse_radii(request.query_params.get('radii', '1,5,10,25'))
+        except ValueError as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            limit = int(request.query_params.get('limit', RINGS_DEFAULT_LIMIT))
+        except ValueError:
+            return Response(
+                {'error': 'limit must be an integer'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if not 1 <= limit <= RINGS_MAX_LIMIT:
+            return Response(
+                {'error': f'limit must be between 1 and {RINGS_MAX_LIMIT}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        distance_mode = request.query_params.get('distance_mode', DEFAULT_DISTANCE_MODE)
+        try:
+            get_distance_backend(distance_mode)
+        except ValueError as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if not user.has_location:
+            return Response(
+                {'error': 'User location not available'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        user_location = user.get_location_tuple()
+        rings = split_rings(
+            *nearby_friend_ids(user, Friendship.friends_of(user), radii[-1], distance_mode),
+            radii, limit
+        )
+        # One query loads the users shown in every ring
+        users = User.objects.in_bulk(
+            [user_id for _, ring_ids, _ in rings for user_id in ring_ids]
+        )
+
+        ring_data = []
+        for (count, ring_ids, distances), min_km, max_km in zip(rings, [0] + radii, radii):
+            ranked = [
+                (users[user_id], float(distance))
+                for user_id, distance in zip(ring_ids, distances)
+                if user_id in users
+            ]
+            ring_data.append({
+                'min_km': min_km,
+                'max_km': max_km,
+                'count': count,
+                'friends': [
+                    {
+                        **UserListSerializer(friend, context={'request': request}).data,
+                        'distance_km': round(distance, 2),
+                    }
+                    for friend, distance in ranked
+                ],
+            })
+
+        total = sum(ring['count'] for ring in ring_data)
+        logger.info(
+            f"Nearby rings query for user {user.email}: "
+            f"{total} found within {radii[-1]}km in {len(radii)} rings"
+        )
+
+        return Response({
+            'user_location': user_location,
+            'distance_mode': distance_mode,
+            'rings': ring_data,
+            'count': total
+        })
+
+    @action(detail=False, methods=['get'])
+    def nearest(self, request):
+        """
+        Find the friends closest to the requesting user.
+
+        Returns the k (default 20) nearest friends ordered by distance. The
+        `distance_mode` parameter selects how distances are measured and ranked.
+        """
+        user = request.user
+
+        try:
+            k = int(request.query_params.get('k', NEAREST_DEFAULT_K))
+        except ValueError:
+            return Response(
+                {'error': 'k must be an integer'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if not 1 <= k <= NEAREST_MAX_K:
+            return Response(
+                {'error': f'k must be between 1 and {NEAREST_MAX_K}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        distance_mode = request.query_params.get('distance_mode', DEFAULT_DISTANCE_MODE)
+        try:
+            get_distance_backend(distance_mode)
+        except ValueError as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if not user.has_location:
+            return Response(
+                {'error': 'User location not available'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        friends = Friendship.get_friends(user)
+
+        nearest_friends = []
+        for friend, distance in find_nearest_friends(user, friends, k, distance_mode):
+            friend_data = UserListSerializer(friend, context={'request': request}).data
+            friend_data['distance_km'] = round(distance, 2)
+            nearest_friends.append(friend_data)
+
+        logger.info(
+            f"Nearest friends query for user {user.email}: "
+            f"{len(nearest_friends)} of k={k} found"
+        )
+
+        return Response({
+            'user_location': user.get_location_tuple(),
+            'k': k,
+            'distance_mode': distance_mode,
+            'nearest_friends': nearest_friends,
+            'count': len(nearest_friends)
+        })
+
+    @action(detail=False, methods=['get'])
+    def distance_matrix(self, request):
+        """
+        Get the pairwise distances between the requesting user and their friends.
+
+        The matrix covers the requesting user, when located, followed by every
+        located friend in id order, or only the friends listed in `ids`
+        (comma-separated). Requested ids that are not located friends are
+        reported in `missing_ids`. The `distance_mode` parameter selects how
+        distances are measured.
+        """
+        user = request.user
+
+        distance_mode = request.query_params.get('distance_mode', DEFAULT_DISTANCE_MODE)
+        try:
+            get_distance_backend(distance_mode)
+        except ValueError as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        requested = None
+        if request.query_params.get('ids'):
+            try:
+                requested = list(dict.fromkeys(
+                    uuid.UUID(value.strip()) for value in request.query_params['ids'].split(',')
+                ))
+            except ValueError:
+                return Response(
+                    {'error': 'ids must be comma-separated user ids'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+        friends = Friendship.get_friends(user).with_location()
+        if requested is not None:
+            friends = friends.filter(id__in=requested)
+        # The exact mode runs one geodesic per pair, so it gets a smaller matrix
+        max_users = (
+            DISTANCE_MATRIX_MAX_EXACT_USERS if distance_mode == 'exact' else DISTANCE_MATRIX_MAX_USERS
+        )
+        rows = list(friends.order_by('id').values_list(
+            'id', 'latitude', 'longitude'
+        )[:max_users + 1])
+        if user.has_location:
+            rows.insert(0, (user.id, *user.get_location_tuple()))
+
+        if len(rows) > max_users:
+            return Response(
+                {'error': f'A {distance_mode} distance matrix covers at most {max_users} users; '
+                          f'pass the ids of fewer friends'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        user_ids = [user_id for user_id, _, _ in rows]
+        matrix = distance_matrix(
+            [latitude for _, latitude, _ in rows], [longitude for _, _, longitude in rows],
+            distance_mode
+        )
+        found = set(user_ids)
+        missing_ids = [str(user_id) for user_id in requested or () if user_id not in found]
+
+        logger.info(f"Distance matrix for user {user.email}: {len(user_ids)} users ({distance_mode})")
+
+        return Response({
+            'user_ids': [str(user_id) for user_id in user_ids],
+            'distances_km': matrix.round(2).tolist(),
+            'distance_mode': distance_mode,
+            'count': len(user_ids),
+            'missing_ids': missing_ids
         })
 
     @action(detail=False, methods=['get'])
@@ -254,13 +651,10 @@ class FriendshipViewSet(ModelViewSet):
                 status=status.HTTP_404_NOT_FOUND
             )
 
-        # Check if friendship exists
-        friendship = Friendship.objects.filter(
-            Q(from_user=request.user, to_user=target_user) |
-            Q(from_user=target_user, to_user=request.user)
-        ).first()
+        # One probe of the pair index answers every question below
+        friendship = Friendship.between(request.user, target_user).first()
 
-        are_friends = Friendship.are_friends(request.user, target_user)
+        are_friends = friendship is not None and friendship.is_accepted
         friendship_status = friendship.status if friendship else None
         friendship_id = str(friendship.id) if friendship else None
 
@@ -0,0 +1,296 @@
+"""
+User density per grid cell, for the heatmap and map clustering endpoints.
+
+At zoom level z the world is split into square cells of 360 / 2**z degrees,
+counted in rows from the south pole and columns from the antimeridian. Each
+cell of a zoom level is exactly four cells of the next one, so counts and
+centroids at any zoom are sums over the density grids the spatial index keeps
+and adjusts as users move (see SpatialIndex.density). When the index is
+disabled they are aggregated in SQL instead, with one GROUP BY over the
+bounding box of the requested cells.
+
+Clusters are the users of one cell of the grid CLUSTER_ZOOM_OFFSET levels
+finer than the map zoom, about 64 pixels across on 256 pixel map tiles. Their
+sample ids are drawn from a bounded sample of the users in the viewport, so
+no request loads more than CLUSTER_SAMPLE_POINTS users.
+"""
+
+import math
+
+import numpy as np
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Floor
+
+from . import spatial
+from .models import User
+
+MAX_ZOOM = spatial.DENSITY_MAX_ZOOM
+DEFAULT_ZOOM = 8
+
+# Most cells a single response may cover
+MAX_CELLS = 10_000
+
+# Clusters are cells this many zoom levels finer than the map
+CLUSTER_ZOOM_OFFSET = 2
+CLUSTER_MAX_ZOOM = 20
+CLUSTER_DEFAULT_ZOOM = 12
+
+# Sample ids returned per cluster, and users sampled per request to find them
+CLUSTER_SAMPLE_SIZE = 3
+CLUSTER_SAMPLE_POINTS = 5_000
+
+
+def cell_size(zoom):
+    """Side of a grid cell at a zoom level, in degrees."""
+    return 360 / 2 ** zoom
+
+
+def parse_bbox(value):
+    """
+    Parse a min_lon,min_lat,max_lon,max_lat viewport.
+
+    A min_lon greater than max_lon describes a viewport crossing the
+    antimeridian.
+
+    Args:
+        value: Comma-separated bounding box
+
+    Returns:
+        tuple: (min_lon, min_lat, max_lon, max_lat) as floats
+
+    Raises:
+        ValueError: If the bounding box is malformed or out of range
+    """
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(part) for part in value.split(','))
+    except ValueError:
+        raise ValueError('bbox must be min_lon,min_lat,max_lon,max_lat') from None
+
+    if not all(math.isfinite(part) for part in (min_lon, min_lat, max_lon, max_lat)):
+        raise ValueError('bbox must be min_lon,min_lat,max_lon,max_lat')
+    if not (-90 <= min_lat <= max_lat <= 90):
+        raise ValueError('bbox latitudes must be between -90 and 90, south first')
+    if not (-180 <= min_lon <= 180 and -180 <= max_lon <= 180):
+        raise ValueError('bbox longitudes must be between -180 and 180')
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def cell_counts(bbox, zoom):
+    """
+    Count active users per grid cell over a viewport.
+
+    Every cell the viewport touches is counted in full, so counts do not
+    change as the viewport pans.
+
+    Args:
+        bbox: (min_lon, min_lat, max_lon, max_lat) viewport
+        zoom: Zoom level between 0 and MAX_ZOOM
+
+    Returns:
+        list: Non-empty cells as dicts with row, col, the latitude and
+        longitude of the cell center and count, ordered by row and column
+
+    Raises:
+        ValueError: If the zoom is out of range or the viewport covers more
+            than MAX_CELLS cells
+    """
+    if not 0 <= zoom <= MAX_ZOOM:
+        raise ValueError(f'zoom must be between 0 and {MAX_ZOOM}')
+
+    first_row, last_row, col_ranges = _viewport_cells(bbox, zoom)
+    size = cell_size(zoom)
+    return [
+        {
+            'row': row,
+            'col': col,
+            'latitude': round((row * size - 90 + min(row * size + size - 90, 90)) / 2, 6),
+            'longitude': round(col * size - 180 + size / 2, 6),
+            'count': count,
+        }
+        for row, col, count, _, _ in _cells(zoom, first_row, last_row, col_ranges)
+    ]
+
+
+def clusters(bbox, zoom):
+    """
+    Cluster the active users in a map viewport.
+
+    Args:
+        bbox: (min_lon, min_lat, max_lon, max_lat) viewport
+        zoom: Map zoom level between 0 and CLUSTER_MAX_ZOOM
+
+    Returns:
+        list: Clusters as dicts with the latitude and longitude of their
+        centroid, count and sample_ids, up to CLUSTER_SAMPLE_SIZE ids of
+        users in the cluster (possibly none for clusters in dense viewports)
+
+    Raises:
+        ValueError: If the zoom is out of range or the viewport covers more
+            than MAX_CELLS clusters
+    """
+    if not 0 <= zoom <= CLUSTER_MAX_ZOOM:
+        raise ValueError(f'zoom must be between 0 and {CLUSTER_MAX_ZOOM}')
+
+    grid_zoom = min(zoom + CLUSTER_ZOOM_OFFSET, MAX_ZOOM)
+    first_row, last_row, col_ranges = _viewport_cells(bbox, grid_zoom)
+    cells = _cells(grid_zoom, first_row, last_row, col_ranges)
+    if not cells:
+        return []
+
+    min_lat, max_lat, lon_ranges = _cells_box(grid_zoom, first_row, last_row, col_ranges)
+    if spatial.is_enabled():
+        sampled = spatial.get_index().sample_cells(
+            grid_zoom, min_lat, max_lat, lon_ranges, CLUSTER_SAMPLE_SIZE, CLUSTER_SAMPLE_POINTS
+        )
+    else:
+        sampled = _database_sample(grid_zoom, min_lat, max_lat, lon_ranges)
+
+    samples = {}
+    for row, col, user_id in zip(*sampled):
+        samples.setdefault((row, col), []).append(str(user_id))
+
+    return [
+        {
+            'latitude': round(latitude, 6),
+            'longitude': round(longitude, 6),
+            'count': count,
+            'sample_ids': samples.get((row, col), []),
+        }
+        for row, col, count, latitude, longitude in cells
+    ]
+
+
+def _cells(zoom, first_row, last_row, col_ranges):
+    """
+    Count the users of a block of cells and locate their centroids.
+
+    Returns:
+        list: (row, col, count, latitude, longitude) of the non-empty cells,
+        ordered by row and then column
+
+    Raises:
+        ValueError: If the block is larger than MAX_CELLS
+    """
+    cells = (last_row - first_row + 1) * sum(last - first + 1 for first, last in col_ranges)
+    if cells > MAX_CELLS:
+        raise ValueError(
+            f'bbox covers {cells} cells at zoom {zoom}, more than {MAX_CELLS}; '
+            f'lower the zoom or shrink the bbox'
+        )
+
+    if spatial.is_enabled():
+        rows, cols, counts, latitudes, longitudes = spatial.get_index().density(
+            zoom, first_row, last_row, col_ranges
+        )
+        return list(zip(
+            rows.tolist(), cols.tolist(), counts.tolist(), latitudes.tolist(), longitudes.tolist()
+        ))
+    return _database_cells(zoom, first_row, last_row, col_ranges)
+
+
+def _grid_shape(zoom):
+    """Number of (rows, columns) of the grid at a zoom level."""
+    return max(1, 2 ** zoom // 2), 2 ** zoom
+
+
+def _viewport_cells(bbox, zoom):
+    """
+    Find the block of grid cells a viewport touches.
+
+    Returns:
+        tuple: (first row, last row, list of (first, last) column ranges)
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    first_row, first_col = _cell_of(zoom, min_lat, min_lon)
+    last_row, last_col = _cell_of(zoom, max_lat, max_lon)
+
+    if min_lon <= max_lon:
+        col_ranges = [(first_col, last_col)]
+    elif first_col <= last_col:
+        # Both edges fall in the same column, so the viewport wraps the world
+        col_ranges = [(0, _grid_shape(zoom)[1] - 1)]
+    else:
+        col_ranges = [(first_col, _grid_shape(zoom)[1] - 1), (0, last_col)]
+    return first_row, last_row, col_ranges
+
+
+def _cells_box(zoom, first_row, last_row, col_ranges):
+    """
+    Find the lat/lon box covering a block of cells.
+
+    Returns:
+        tuple: (min_lat, max_lat, list of (min_lon, max_lon) ranges)
+    """
+    size = cell_size(zoom)
+    return (
+        first_row * size - 90,
+        min((last_row + 1) * size - 90, 90),
+        [(first * size - 180, (last + 1) * size - 180) for first, last in col_ranges],
+    )
+
+
+def _cell_of(zoom, latitude, longitude):
+    """Grid (row, col) of a location at a zoom level."""
+    size = cell_size(zoom)
+    row_count, col_count = _grid_shape(zoom)
+    return (
+        min(int((latitude + 90) // size), row_count - 1),
+        min(int((longitude + 180) // size), col_count - 1),
+    )
+
+
+def _users_in_box(min_lat, max_lat, lon_ranges):
+    """Active located users inside a lat/lon box, edges included."""
+    longitudes = Q()
+    for min_lon, max_lon in lon_ranges:
+        longitudes |= Q(longitude__gte=min_lon, longitude__lte=max_lon)
+    return User.objects.with_location().filter(
+        longitudes, is_active=True, latitude__gte=min_lat, latitude__lte=max_lat
+    )
+
+
+def _database_cells(zoom, first_row, last_row, col_ranges):
+    """Count users per cell of a block of cells with one GROUP BY query."""
+    size = cell_size(zoom)
+    row_count, col_count = _grid_shape(zoom)
+    rows = _users_in_box(*_cells_box(zoom, first_row, last_row, col_ranges)).annotate(
+        row=Floor((F('latitude') + 90) / size), col=Floor((F('longitude') + 180) / size)
+    ).values('row', 'col').annotate(
+        count=Count('id'), latitude_sum=Sum('latitude'), longitude_sum=Sum('longitude')
+    ).values_list('row', 'col', 'count', 'latitude_sum', 'longitude_sum')
+
+    sums = {}
+    for row, col, count, latitude_sum, longitude_sum in rows:
+        # The inclusive bounds admit points on the far edges, which belong to
+        # the next cell unless they are on the pole or the antimeridian
+        row, col = min(int(row), row_count - 1), min(int(col), col_count - 1)
+        if first_row <= row <= last_row and any(first <= col <= last for first, last in col_ranges):
+            cell = sums.setdefault((row, col), [0, 0.0, 0.0])
+            cell[0] += count
+            cell[1] += latitude_sum
+            cell[2] += longitude_sum
+    return [
+        (row, col, count, latitude_sum / count, longitude_sum / count)
+        for (row, col), (count, latitude_sum, longitude_sum) in sorted(sums.items())
+    ]
+
+
+def _database_sample(zoom, min_lat, max_lat, lon_ranges):
+    """
+    Sample a few users per grid cell from up to CLUSTER_SAMPLE_POINTS users in a box.
+
+    Returns:
+        tuple: (rows, cols, user ids) lists of the sampled users
+    """
+    rows = list(_users_in_box(min_lat, max_lat, lon_ranges).values_list(
+        'id', 'latitude', 'longitude'
+    )[:CLUSTER_SAMPLE_POINTS])
+    if not rows:
+        return [], [], []
+
+    ids, latitudes, longitudes = zip(*rows)
+    cell_rows, cell_cols = spatial.grid_cells(
+        zoom, np.array(latitudes, dtype=np.float64), np.array(longitudes, dtype=np.float64)
+    )
+    chosen = spatial.first_per_cell(cell_rows, cell_cols, CLUSTER_SAMPLE_SIZE)
+    return cell_rows[chosen].tolist(), cell_cols[chosen].tolist(), [ids[i] for i in chosen]
@@ -0,0 +1,56 @@
+"""
+Model fields for geographic coordinates.
+
+Coordinates are stored as double precision floats so distance code works on
+native numbers and the database compares them without numeric arithmetic.
+Decimals and strings are rounded to the six decimal places (about 0.1m) the
+API has always exposed.
+"""
+
+from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+
+# Decimal places kept for stored coordinates
+COORDINATE_DECIMAL_PLACES = 6
+
+
+def to_coordinate(value):
+    """
+    Convert a coordinate to a float rounded to the stored precision.
+
+    Values that cannot be converted are returned unchanged so that field
+    validation can report them.
+
+    Args:
+        value: Coordinate as a float, int, Decimal or string, or None
+
+    Returns:
+        float: The coordinate, or the original value if it is not numeric
+    """
+    if value is None or value.__class__ is float:
+        return value
+    try:
+        return round(float(value), COORDINATE_DECIMAL_PLACES)
+    except (TypeError, ValueError):
+        return value
+
+
+class CoordinateDescriptor(DeferredAttribute):
+    """Attribute access for CoordinateField that always holds floats."""
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = to_coordinate(value)
+
+
+class CoordinateField(models.FloatField):
+    """
+    A latitude or longitude stored as a float.
+
+    Assigned Decimals, ints and strings are converted on assignment, so the
+    attribute is always a float (or None) and never needs converting again.
+    """
+
+    descriptor_class = CoordinateDescriptor
+
+    def get_prep_value(self, value):
+        return super().get_prep_value(to_coordinate(value))
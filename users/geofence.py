@@ -0,0 +1,227 @@
+"""
+Polygon (geofence) queries over user locations.
+
+Polygons are GeoJSON Polygon or MultiPolygon geometries, with longitude and
+latitude treated as plane coordinates as RFC 7946 prescribes; polygons
+crossing the antimeridian must be split into a MultiPolygon. Candidates are
+prefiltered in SQL by the bounding box of each polygon, served by the
+(latitude, longitude) index, and then tested with an even-odd ray casting
+test vectorized over candidates and edges at once. Edges are bucketed into
+latitude bands so each point is only compared with the few edges spanning
+its band. Holes need no special handling: a point in a hole crosses the
+outer ring and the hole.
+"""
+
+import math
+
+import numpy as np
+from django.db.models import Q
+
+# Most vertices accepted in one geometry
+MAX_VERTICES = 10_000
+
+# Points times edges compared per block of the containment test
+BLOCK_ELEMENTS = 1_000_000
+
+# Latitude bands per edge, and at most, for bucketing edges
+BANDS_PER_EDGE = 0.25
+MAX_BANDS = 1024
+
+
+class Polygon:
+    """
+    A polygon with optional holes, prepared for containment tests.
+
+    Every ring contributes its edges to a single edge list, since the
+    even-odd rule counts crossings of holes and outer ring alike. The
+    latitude span of the polygon is cut into equal bands, each listing the
+    edges that overlap it.
+    """
+
+    def __init__(self, rings):
+        edges = []
+        for ring in rings:
+            ring = np.asarray(ring, dtype=np.float64)
+            edges.append(np.column_stack([ring[:-1], ring[1:]]))
+        edges = np.concatenate(edges)
+        # Horizontal edges are never crossed by the test's horizontal rays
+        edges = edges[edges[:, 1] != edges[:, 3]]
+
+        self._x1, self._y1, x2, y2 = edges.T
+        self._low_y = np.minimum(self._y1, y2)
+        self._high_y = np.maximum(self._y1, y2)
+        self._slope = (x2 - self._x1) / (y2 - self._y1)
+
+        outer = np.asarray(rings[0], dtype=np.float64)
+        self.min_lon, self.min_lat = outer.min(axis=0)
+        self.max_lon, self.max_lat = outer.max(axis=0)
+
+        self._band_count = int(min(MAX_BANDS, max(1, len(self._slope) * BANDS_PER_EDGE)))
+        self._band_height = (self.max_lat - self.min_lat) / self._band_count or 1.0
+        first = self._band_of(self._low_y)
+        last = self._band_of(self._high_y)
+        self._band_edges = [
+            np.flatnonzero((first <= band) & (last >= band)) for band in range(self._band_count)
+        ]
+
+    def _band_of(self, latitudes):
+        """Band index of latitudes within the polygon's span."""
+        bands = ((latitudes - self.min_lat) // self._band_height).astype(np.int64)
+        return np.clip(bands, 0, self._band_count - 1)
+
+    def contains(self, latitudes, longitudes):
+        """
+        Test which points lie inside the polygon.
+
+        Args:
+            latitudes: Numpy array of latitudes
+            longitudes: Numpy array of longitudes
+
+        Returns:
+            numpy.ndarray: Boolean mask of the points inside
+        """
+        inside = np.zeros(len(latitudes), dtype=bool)
+        candidates = np.flatnonzero(
+            (latitudes >= self.min_lat) & (latitudes <= self.max_lat)
+            & (longitudes >= self.min_lon) & (longitudes <= self.max_lon)
+        )
+
+        bands = self._band_of(latitudes[candidates])
+        order = np.argsort(bands, kind='stable')
+        bounds = np.searchsorted(bands[order], np.arange(self._band_count + 1))
+        for band, edges in enumerate(self._band_edges):
+            points = candidates[order[bounds[band]:bounds[band + 1]]]
+            if len(points) and len(edges):
+                inside[points] = self._crosses_odd(latitudes[points], longitudes[points], edges)
+        return inside
+
+    def _crosses_odd(self, latitudes, longitudes, edges):
+        """Whether rays cast east from points cross an odd number of some edges."""
+        odd = np.empty(len(latitudes), dtype=bool)
+        low_y, high_y = self._low_y[edges], self._high_y[edges]
+        x1, y1, slope = self._x1[edges], self._y1[edges], self._slope[edges]
+
+        block = max(1, BLOCK_ELEMENTS // len(edges))
+        for start in range(0, len(latitudes), block):
+            y = latitudes[start:start + block, None]
+            # Half-open bounds so a ray through a vertex counts it once
+            straddles = (low_y <= y) & (y < high_y)
+            crossing_x = x1 + (y - y1) * slope
+            crossings = np.count_nonzero(
+                straddles & (longitudes[start:start + block, None] < crossing_x), axis=1
+            )
+            odd[start:start + block] = crossings % 2 == 1
+        return odd
+
+
+def parse_geometry(data):
+    """
+    Parse a GeoJSON Polygon or MultiPolygon, bare or wrapped in a Feature.
+
+    Args:
+        data: Decoded GeoJSON object
+
+    Returns:
+        list: Polygon objects, one per polygon of the geometry
+
+    Raises:
+        ValueError: If the geometry is malformed or too large
+    """
+    if isinstance(data, dict) and data.get('type') == 'Feature':
+        data = data.get('geometry')
+    if not isinstance(data, dict) or data.get('type') not in ('Polygon', 'MultiPolygon'):
+        raise ValueError('geometry must be a GeoJSON Polygon or MultiPolygon')
+
+    coordinates = data.get('coordinates')
+    if data['type'] == 'Polygon':
+        coordinates = [coordinates]
+    if not isinstance(coordinates, list) or not coordinates:
+        raise ValueError('geometry has no coordinates')
+
+    polygons = []
+    vertices = 0
+    for rings in coordinates:
+        if not isinstance(rings, list) or not rings:
+            raise ValueError('every polygon needs an outer ring')
+        for ring in rings:
+            _validate_ring(ring)
+            vertices += len(ring)
+        polygons.append(rings)
+
+    if vertices > MAX_VERTICES:
+        raise ValueError(f'geometry has {vertices} vertices, more than {MAX_VERTICES}')
+    return [Polygon(rings) for rings in polygons]
+
+
+def _validate_ring(ring):
+    """Check a linear ring is closed, has four positions or more and valid coordinates."""
+    if not isinstance(ring, list) or len(ring) < 4:
+        raise ValueError('every ring needs at least four positions')
+
+    for position in ring:
+        if not isinstance(position, list) or len(position) < 2:
+            raise ValueError('positions must be [longitude, latitude] arrays')
+        longitude, latitude = position[:2]
+        if not all(
+            isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+            for value in (longitude, latitude)
+        ):
+            raise ValueError('coordinates must be numbers')
+        if not (-180 <= longitude <= 180 and -90 <= latitude <= 90):
+            raise ValueError('longitudes must be between -180 and 180 and latitudes between -90 and 90')
+
+    if ring[0][:2] != ring[-1][:2]:
+        raise ValueError('rings must be closed, ending at their first position')
+
+
+def bounds(polygons):
+    """
+    Get the bounding box of a set of polygons.
+
+    Returns:
+        list: [min_lon, min_lat, max_lon, max_lat]
+    """
+    return [
+        min(polygon.min_lon for polygon in polygons),
+        min(polygon.min_lat for polygon in polygons),
+        max(polygon.max_lon for polygon in polygons),
+        max(polygon.max_lat for polygon in polygons),
+    ]
+
+
+def within_bounds(queryset, polygons):
+    """
+    Restrict a queryset to the users inside the bounding box of any polygon.
+
+    Args:
+        queryset: QuerySet of users
+        polygons: Polygon objects
+
+    Returns:
+        QuerySet: Candidate users for the containment test
+    """
+    boxes = Q()
+    for polygon in polygons:
+        boxes |= Q(
+            latitude__range=(polygon.min_lat, polygon.max_lat),
+            longitude__range=(polygon.min_lon, polygon.max_lon),
+        )
+    return queryset.with_location().filter(boxes)
+
+
+def contains(polygons, latitudes, longitudes):
+    """
+    Test which points lie inside any of a set of polygons.
+
+    Args:
+        polygons: Polygon objects
+        latitudes: Numpy array of latitudes
+        longitudes: Numpy array of longitudes
+
+    Returns:
+        numpy.ndarray: Boolean mask of the points inside
+    """
+    inside = np.zeros(len(latitudes), dtype=bool)
+    for polygon in polygons:
+        inside |= polygon.contains(latitudes, longitudes)
+    return inside
@@ -0,0 +1,121 @@
+"""
+Geohash encoding for user locations.
+
+A geohash names a lat/lon cell with a base32 string; every extra character
+splits the cell into 32 smaller ones, so all points inside a cell share its
+geohash as a prefix. This lets an ordinary string index answer "which users
+are inside these cells" with a few range scans.
+"""
+
+import math
+
+from .utils import bounding_box
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Precision stored on User.geohash (cells of roughly 4.8m x 4.8m)
+GEOHASH_PRECISION = 9
+
+# Upper bound on the number of cells used to cover a search area
+MAX_COVERING_CELLS = 16
+
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """
+    Encode coordinates as a geohash.
+
+    Args:
+        latitude: Latitude in degrees
+        longitude: Longitude in degrees
+        precision: Number of characters in the geohash
+
+    Returns:
+        str: The geohash of the cell containing the point
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    latitude, longitude = float(latitude), float(longitude)
+
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even_bit = True
+
+    while len(geohash) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude
+        value, value_range = (longitude, lon_range) if even_bit else (latitude, lat_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        if value >= middle:
+            bits = (bits << 1) | 1
+            value_range[0] = middle
+        else:
+            bits <<= 1
+            value_range[1] = middle
+        even_bit = not even_bit
+
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(geohash)
+
+
+def cell_size(precision):
+    """
+    Get the size of a geohash cell.
+
+    Args:
+        precision: Number of characters in the geohash
+
+    Returns:
+        tuple: (height, width) of a cell in degrees
+    """
+    lat_bits = 5 * precision // 2
+    lon_bits = 5 * precision - lat_bits
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def covering_cells(latitude, longitude, radius_km, max_cells=MAX_COVERING_CELLS):
+    """
+    Find geohash cells that together cover a circle on the earth.
+
+    The finest precision whose cells cover the circle's bounding box with at
+    most max_cells cells is used.
+
+    Args:
+        latitude: Latitude of the circle center
+        longitude: Longitude of the circle center
+        radius_km: Radius of the circle in kilometers
+        max_cells: Maximum number of cells to return
+
+    Returns:
+        list: Sorted geohashes of the covering cells
+    """
+    min_lat, max_lat, lon_ranges = bounding_box(latitude, longitude, radius_km)
+
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        rows = _cell_span(min_lat + 90, max_lat + 90, height, 180)
+        column_spans = [
+            _cell_span(min_lon + 180, max_lon + 180, width, 360)
+            for min_lon, max_lon in lon_ranges
+        ]
+        if len(rows) * sum(len(columns) for columns in column_spans) <= max_cells:
+            break
+
+    return sorted({
+        encode(-90 + (row + 0.5) * height, -180 + (column + 0.5) * width, precision)
+        for row in rows
+        for columns in column_spans
+        for column in columns
+    })
+
+
+def _cell_span(low, high, size, extent):
+    """Indices of the cells of a given size overlapping [low, high]."""
+    last_index = int(round(extent / size)) - 1
+    first = min(max(math.floor(low / size), 0), last_index)
+    last = min(max(math.floor(high / size), 0), last_index)
+    return range(first, last + 1)
@@ -0,0 +1,183 @@
+"""
+Location history queries and retention.
+
+Points are appended by the location update flush (users.location_updates)
+and read back as tracks: one user's points over a time range, in order,
+using the (user, recorded_at, id) index so a page costs the same however
+large the table grows.
+
+Old points are compacted in two steps. Points older than
+LOCATION_HISTORY_RAW_DAYS are downsampled to the first point of every
+LOCATION_HISTORY_DOWNSAMPLE_MINUTES interval per user, and points older than
+LOCATION_HISTORY_RETENTION_DAYS are deleted. Both work through the minute
+bucket index a bounded slice at a time, so a run never has to touch the
+whole table.
+"""
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Min, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+
+from .models import LocationHistory
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY_PREFIX = 'users:location_history'
+
+# Minutes of history compacted per statement
+SLICE_MINUTES = 60
+
+# Slices compacted per run; later runs pick up where a run stopped
+MAX_SLICES_PER_RUN = 48
+
+# Slices behind the progress that every run compacts again, so points written
+# late into an already compacted slice are still downsampled
+LATE_SLICES = 24
+
+
+def track(user, start, end):
+    """
+    Get the points of a user's track over a time range.
+
+    Args:
+        user: User whose track is read
+        start: Aware datetime the range starts at (inclusive)
+        end: Aware datetime the range ends at (exclusive)
+
+    Returns:
+        QuerySet: LocationHistory points, oldest first
+    """
+    return LocationHistory.objects.filter(
+        user=user, recorded_at__gte=start, recorded_at__lt=end
+    ).order_by('recorded_at', 'id')
+
+
+def compact_location_history(now=None):
+    """
+    Downsample old raw points and delete expired ones.
+
+    Args:
+        now: Reference time, the current time by default
+
+    Returns:
+        dict: Numbers of points removed by downsampling and by expiry
+    """
+    now = now or timezone.now()
+    # Expire first so downsampling never spends slices on doomed points
+    expired = expire_location_history(now)
+    return {
+        'downsampled': downsample_location_history(now),
+        'expired': expired,
+    }
+
+
+def downsample_location_history(now=None):
+    """
+    Keep only the first point per user and interval of old history.
+
+    Progress is kept in the cache so each run continues from the last slice
+    it compacted, after compacting the LATE_SLICES before it again to catch
+    points that were written after their slice was compacted. Downsampling is
+    idempotent, so losing the progress only costs re-scanning history that is
+    already compacted.
+
+    Args:
+        now: Reference time, the current time by default
+
+    Returns:
+        int: Number of points removed
+    """
+    now = now or timezone.now()
+    interval = settings.LOCATION_HISTORY_DOWNSAMPLE_MINUTES
+    # Only whole intervals are compacted, so slices never split one
+    cutoff = LocationHistory.minute_bucket(now - timedelta(days=settings.LOCATION_HISTORY_RAW_DAYS))
+    cutoff -= cutoff % interval
+    slice_minutes = interval * max(1, SLICE_MINUTES // interval)
+
+    progress = cache.get(_progress_key())
+    if progress is None:
+        start = LocationHistory.objects.filter(minute__lt=cutoff).aggregate(
+            oldest=Min('minute')
+        )['oldest']
+        if start is None:
+            return 0
+    else:
+        start = progress - LATE_SLICES * slice_minutes
+    # Points past the retention period are left to expire_location_history
+    start = max(start, _retention_cutoff(now))
+    start -= start % interval
+
+    removed = 0
+    for _ in range(MAX_SLICES_PER_RUN):
+        if start >= cutoff:
+            break
+        end = min(start + slice_minutes, cutoff)
+        removed += _downsample_slice(start, end, interval)
+        start = end
+        # Re-scanning the late slices never moves the progress back
+        if progress is None or start > progress:
+            progress = start
+            cache.set(_progress_key(), progress, timeout=None)
+
+    logger.info(f"Downsampled location history up to minute {start}: {removed} points removed")
+    return removed
+
+
+def expire_location_history(now=None):
+    """
+    Delete history older than the retention period.
+
+    Args:
+        now: Reference time, the current time by default
+
+    Returns:
+        int: Number of points deleted
+    """
+    cutoff = _retention_cutoff(now or timezone.now())
+
+    oldest = LocationHistory.objects.filter(minute__lt=cutoff).aggregate(
+        oldest=Min('minute')
+    )['oldest']
+    if oldest is None:
+        return 0
+
+    deleted = 0
+    # A day per statement keeps each delete, and its locks, bounded
+    for start in range(oldest, cutoff, 24 * 60):
+        count, _ = LocationHistory.objects.filter(
+            minute__gte=start, minute__lt=min(start + 24 * 60, cutoff)
+        ).delete()
+        deleted += count
+
+    logger.info(f"Expired {deleted} location history points before minute {cutoff}")
+    return deleted
+
+
+def _downsample_slice(start, end, interval):
+    """Keep the first point per user and interval among the points of a minute range."""
+    points = LocationHistory.objects.filter(minute__gte=start, minute__lt=end)
+    # Ids are not assigned in recording order, so rank by recorded_at
+    later = points.annotate(position=Window(
+        RowNumber(),
+        partition_by=[F('user_id'), F('minute') / interval],
+        order_by=[F('recorded_at').asc(), F('id').asc()],
+    )).filter(position__gt=1).values('id')
+
+    deleted, _ = LocationHistory.objects.filter(id__in=later).delete()
+    return deleted
+
+
+def _retention_cutoff(now):
+    """Minute bucket before which history is past the retention period."""
+    return LocationHistory.minute_bucket(
+        now - timedelta(days=settings.LOCATION_HISTORY_RETENTION_DAYS)
+    )
+
+
+def _progress_key():
+    return f'{CACHE_KEY_PREFIX}:downsampled_until'
@@ -0,0 +1,252 @@
+"""
+Coalescing pipeline for user location updates.
+
+GPS pings are buffered in the shared cache instead of being written one by
+one. Each ping overwrites the user's latest position and registers the user
+in the current time window; when a window closes, the flush reads the users
+registered in it and writes their latest positions with a single
+bulk_update. A user pinging many times within a window costs one row write.
+The same positions are appended to the location history (see
+users.history), one point per user and window.
+
+Buffering needs a cache every process shares, such as Redis. With a
+process-local cache each update is written as it arrives.
+"""
+
+import logging
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import nearby_cache, spatial
+from .fields import to_coordinate
+from .models import LocationHistory, User
+from .signals import locations_updated
+from .utils import cache_is_shared, validate_coordinates
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY_PREFIX = 'users:location_updates'
+
+# Columns written by a flush, besides the fields derived from the coordinates
+UPDATE_FIELDS = ['latitude', 'longitude', 'updated_at']
+
+# Closed windows older than this many windows are abandoned by the flush
+MAX_BACKLOG_WINDOWS = 120
+
+
+def current_window():
+    """Number of the buffering window containing the current time."""
+    return int(time.time() // settings.LOCATION_UPDATE_WINDOW)
+
+
+def buffer_location_update(user_id, latitude, longitude):
+    """
+    Buffer a location update until the next flush.
+
+    With a process-local cache (LocMemCache, the default) the update is
+    written at once instead, since the flush may run in another process.
+
+    Args:
+        user_id: ID of the user
+        latitude: New latitude
+        longitude: New longitude
+
+    Returns:
+        bool: True if the update was buffered or written, False if it was invalid
+    """
+    is_valid, error = validate_coordinates(latitude, longitude)
+    if not is_valid:
+        logger.warning(f"Dropped location update for user {user_id}: {error}")
+        return False
+
+    if not cache_is_shared():
+        # A ping buffered in this process would never reach a flush running in another
+        apply_location_updates([(user_id, latitude, longitude)])
+        return True
+
+    window = current_window()
+    timeout = _buffer_timeout()
+    cache.set(
+        _latest_key(user_id),
+        (to_coordinate(latitude), to_coordinate(longitude), time.time()),
+        timeout
+    )
+
+    count_key = _count_key(window)
+    cache.add(count_key, 0, timeout)
+    slot = cache.incr(count_key)
+    cache.set(_slot_key(window, slot), str(user_id), timeout)
+    return True
+
+
+def flush_location_updates(include_current=False):
+    """
+    Write the buffered updates of every closed window.
+
+    Flushes are idempotent: applying a window twice writes the same latest
+    positions again.
+
+    Args:
+        include_current: Also flush the window that is still open
+
+    Returns:
+        int: Number of users whose location was written
+    """
+    window = current_window()
+    last = window if include_current else window - 1
+    first = max(cache.get(_flushed_key(), last - 1) + 1, last - MAX_BACKLOG_WINDOWS)
+
+    written = 0
+    for pending in range(first, last + 1):
+        # The open window can still receive updates, so it is kept for the next flush
+        closed = pending < window
+        written += _flush_window(pending, closed)
+        if closed:
+            cache.set(_flushed_key(), pending, timeout=None)
+    return written
+
+
+def apply_location_updates(updates, batch_size=None):
+    """
+    Write location updates, keeping only the latest one per user.
+
+    Only the coordinate columns, their derived fields and updated_at are
+    written; nothing is read except the previous coordinates, which are
+    needed to invalidate cached nearby results around them, and whether the
+    user is active. The moves are published to the spatial index of every
+    process (see spatial.publish_moves). Each written
+    position is also appended to the location history.
+
+    Args:
+        updates: Iterable of (user_id, latitude, longitude), oldest first,
+            optionally followed by the aware datetime the position was
+            recorded at (the time of the write by default)
+        batch_size: Rows per UPDATE statement, LOCATION_UPDATE_BATCH_SIZE by default
+
+    Returns:
+        int: Number of users whose location was written
+    """
+    now = timezone.now()
+    latest = {}
+    for user_id, latitude, longitude, *recorded_at in updates:
+        latest[str(user_id)] = (latitude, longitude, recorded_at[0] if recorded_at else now)
+    if not latest:
+        return 0
+
+    previous = User.objects.filter(id__in=latest.keys()).values_list(
+        'id', 'latitude', 'longitude', 'is_active'
+    )
+
+    users = []
+    history = []
+    locations = []
+    moves = []
+    for user_id, old_latitude, old_longitude, is_active in previous:
+        latitude, longitude, recorded_at = latest[str(user_id)]
+        user = User(id=user_id, updated_at=now, latitude=latitude, longitude=longitude)
+        user.refresh_location_fields()
+        users.append(user)
+        history.append(LocationHistory(
+            user_id=user_id,
+            latitude=user.latitude,
+            longitude=user.longitude,
+            recorded_at=recorded_at,
+            minute=LocationHistory.minute_bucket(recorded_at),
+        ))
+        locations.append((user.latitude, user.longitude))
+        if is_active:
+            moves.append((user_id, user.latitude, user.longitude))
+        if old_latitude is not None and old_longitude is not None:
+            locations.append((old_latitude, old_longitude))
+
+    batch_size = batch_size or settings.LOCATION_UPDATE_BATCH_SIZE
+    User.objects.bulk_update(
+        users, UPDATE_FIELDS + User.DERIVED_LOCATION_FIELDS, batch_size=batch_size
+    )
+    if settings.LOCATION_HISTORY_ENABLED:
+        LocationHistory.objects.bulk_create(history, batch_size=batch_size)
+
+    # Bulk writes do not send post_save, so update the index and invalidate
+    # cached results here
+    if spatial.is_enabled():
+        spatial.publish_moves(moves)
+    if nearby_cache.is_enabled():
+        nearby_cache.invalidate_locations(locations)
+
+    if users:
+        locations_updated.send(sender=User, user_ids=[user.id for user in users])
+
+    return len(users)
+
+
+def _flush_window(window, closed):
+    """
+    Apply the latest buffered position of every user registered in a window.
+
+    A ping from a process whose clock is slightly behind can still register in
+    a closed window while it is flushed, so the window's count is read again
+    after every write and only the slots that were applied are deleted.
+    """
+    flushed = 0
+    written = 0
+    slot_keys = []
+    while True:
+        count = cache.get(_count_key(window), 0)
+        if count <= flushed:
+            break
+
+        new_slot_keys = [_slot_key(window, slot) for slot in range(flushed + 1, count + 1)]
+        user_ids = list(dict.fromkeys(cache.get_many(new_slot_keys).values()))
+        positions = cache.get_many([_latest_key(user_id) for user_id in user_ids])
+
+        written += apply_location_updates(
+            _buffered_update(user_id, positions[_latest_key(user_id)])
+            for user_id in user_ids
+            if _latest_key(user_id) in positions
+        )
+        slot_keys.extend(new_slot_keys)
+        flushed = count
+        if not closed:
+            # The open window is flushed again by the next run
+            break
+
+    if not flushed:
+        return 0
+    if closed:
+        cache.delete_many([_count_key(window), *slot_keys])
+
+    logger.info(f"Flushed location window {window}: {flushed} updates, {written} users written")
+    return written
+
+
+def _buffered_update(user_id, position):
+    """Turn a buffered position into an update for apply_location_updates."""
+    latitude, longitude, *timestamp = position
+    if not timestamp:
+        # Buffered before positions carried their time
+        return user_id, latitude, longitude
+    return user_id, latitude, longitude, datetime.fromtimestamp(timestamp[0], tz=dt_timezone.utc)
+
+
+def _buffer_timeout():
+    return settings.LOCATION_UPDATE_WINDOW * (MAX_BACKLOG_WINDOWS + 2)
+
+
+def _latest_key(user_id):
+    return f'{CACHE_KEY_PREFIX}:latest:{user_id}'
+
+
+def _count_key(window):
+    return f'{CACHE_KEY_PREFIX}:{window}:count'
+
+
+def _slot_key(window, slot):
+    return f'{CACHE_KEY_PREFIX}:{window}:{slot}'
+
+
+def _flushed_key():
+    return f'{CACHE_KEY_PREFIX}:flushed'
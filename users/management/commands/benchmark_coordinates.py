@@ -0,0 +1,80 @@
+"""
+Micro-benchmark for coordinate conversion overhead.
+
+Compares the work done on coordinates returned as Decimals, as the old
+DecimalField columns were, against coordinates returned as floats. The hot
+paths measured are building location tuples, filling NumPy arrays for the
+distance kernel and computing distances one pair at a time.
+"""
+
+import random
+import statistics
+import timeit
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+import numpy as np
+
+from users.fields import to_coordinate
+from users.utils import calculate_distance, haversine_distances
+
+
+class Command(BaseCommand):
+    """Measure the cost of Decimal coordinates against native floats."""
+
+    help = 'Benchmark coordinate conversion with Decimal and float storage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100_000, help='Coordinate pairs per run')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        floats = [
+            (round(rng.uniform(-90, 90), 6), round(rng.uniform(-180, 180), 6))
+            for _ in range(options['rows'])
+        ]
+        # What a database driver hands back for numeric(9, 6) columns
+        decimals = [(Decimal(f'{lat:.6f}'), Decimal(f'{lon:.6f}')) for lat, lon in floats]
+        origin = floats[0]
+
+        benchmarks = [
+            ('location tuple', {
+                'decimal': lambda: [(float(lat), float(lon)) for lat, lon in decimals],
+                'float': lambda: [(lat, lon) for lat, lon in floats],
+            }),
+            ('attribute load', {
+                'decimal': lambda: [(to_coordinate(lat), to_coordinate(lon)) for lat, lon in decimals],
+                'float': lambda: [(to_coordinate(lat), to_coordinate(lon)) for lat, lon in floats],
+            }),
+            ('numpy arrays', {
+                'decimal': lambda: self._kernel(origin, decimals),
+                'float': lambda: self._kernel(origin, floats),
+            }),
+            ('scalar haversine', {
+                'decimal': lambda: [
+                    calculate_distance(*origin, float(lat), float(lon)) for lat, lon in decimals
+                ],
+                'float': lambda: [calculate_distance(*origin, lat, lon) for lat, lon in floats],
+            }),
+        ]
+
+        self.stdout.write(f"{'path':>18} {'decimal ms':>12} {'float ms':>12} {'speedup':>9}")
+        for name, variants in benchmarks:
+            timings = {
+                variant: statistics.median(
+                    timeit.repeat(function, number=1, repeat=options['repeat'])
+                ) * 1000
+                for variant, function in variants.items()
+            }
+            self.stdout.write(
+                f"{name:>18} {timings['decimal']:>12.1f} {timings['float']:>12.1f} "
+                f"{timings['decimal'] / timings['float']:>8.1f}x"
+            )
+
+    @staticmethod
+    def _kernel(origin, rows):
+        """Fill coordinate arrays and run the vectorized distance kernel."""
+        coordinates = np.array(rows, dtype=np.float64)
+        return haversine_distances(origin[0], origin[1], coordinates[:, 0], coordinates[:, 1])
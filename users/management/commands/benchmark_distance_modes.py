@@ -0,0 +1,87 @@
+"""
+Benchmark and accuracy table for the distance modes.
+
+For each radius, random points are placed uniformly inside circles around
+random origins, at known geodesic distances on the WGS-84 ellipsoid. Every
+mode of users.distance then measures them. Its error against the geodesic
+distance is reported along with its deviation from the spherical distance,
+which isolates the cost of the flat projection, and its time per point, so
+the cheapest mode that is accurate enough for a radius can be picked.
+"""
+
+import random
+import statistics
+import timeit
+
+from django.core.management.base import BaseCommand
+from geopy.distance import geodesic
+import numpy as np
+
+from users.distance import DISTANCE_BACKENDS
+from users.utils import haversine_distances
+
+
+class Command(BaseCommand):
+    """Measure the error and cost of every distance mode over typical radii."""
+
+    help = 'Benchmark distance modes and tabulate their error against the geodesic'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--radii', type=float, nargs='+', default=[1, 5, 10, 50, 100, 500],
+            help='Search radii in km'
+        )
+        parser.add_argument('--points', type=int, default=2000, help='Points per radius')
+        parser.add_argument(
+            '--max-latitude', type=float, default=70.0,
+            help='Origins are drawn between minus and plus this latitude'
+        )
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per timing')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        self.stdout.write(
+            f"{'radius km':>10} {'mode':>10} {'mean err m':>12} {'max err m':>12} "
+            f"{'max err %':>10} {'vs sphere m':>12} {'us/point':>10}"
+        )
+        for radius in options['radii']:
+            origin, latitudes, longitudes, expected = self._sample(
+                rng, radius, options['points'], options['max_latitude']
+            )
+            spherical = haversine_distances(*origin, latitudes, longitudes)
+            for mode, backend in DISTANCE_BACKENDS.items():
+                distances = backend(*origin, latitudes, longitudes)
+                errors = np.abs(distances - expected) * 1000
+                relative = np.abs(distances - expected) / np.maximum(expected, 1e-9) * 100
+                # Projection error alone, separated from the sphere's own error
+                deviation = np.abs(distances - spherical).max() * 1000
+
+                elapsed = statistics.median(timeit.repeat(
+                    lambda: backend(*origin, latitudes, longitudes),
+                    number=1, repeat=options['repeat']
+                ))
+                self.stdout.write(
+                    f"{radius:>10g} {mode:>10} {errors.mean():>12.3f} {errors.max():>12.3f} "
+                    f"{relative.max():>10.4f} {deviation:>12.3f} {elapsed / len(expected) * 1e6:>10.3f}"
+                )
+
+    @staticmethod
+    def _sample(rng, radius, count, max_latitude):
+        """
+        Place points uniformly inside a circle around a random origin.
+
+        Returns:
+            tuple: (origin, latitudes, longitudes, geodesic distances in km)
+        """
+        origin = (rng.uniform(-max_latitude, max_latitude), rng.uniform(-180, 180))
+        # Square-root scaling spreads points evenly over the disc's area
+        expected = np.array([radius * rng.random() ** 0.5 for _ in range(count)])
+        points = [
+            geodesic(kilometers=distance).destination(origin, rng.uniform(0, 360))
+            for distance in expected
+        ]
+        latitudes = np.array([point.latitude for point in points])
+        longitudes = np.array([point.longitude for point in points])
+        return origin, latitudes, longitudes, expected
@@ -0,0 +1,97 @@
+"""
+Benchmark for the location update pipeline.
+
+Populates the database with synthetic users inside a transaction that is
+rolled back at the end, then replays a stream of GPS pings through the
+legacy per-ping save and through the coalescing pipeline at several batch
+sizes, reporting throughput in pings per second.
+"""
+
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from users.location_updates import apply_location_updates
+from users.models import User
+
+
+class Command(BaseCommand):
+    """Measure location update throughput at different batch sizes."""
+
+    help = 'Benchmark location update throughput against synthetic users'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10_000, help='Synthetic users')
+        parser.add_argument('--updates', type=int, default=50_000, help='Pings to replay')
+        parser.add_argument(
+            '--batch-sizes', type=int, nargs='+', default=[10, 100, 1000, 5000],
+            help='Pings coalesced per flush'
+        )
+        parser.add_argument(
+            '--legacy-updates', type=int, default=2000,
+            help='Pings to replay through the legacy per-ping save (0 to skip)'
+        )
+        parser.add_argument('--seed', type=int, default=42, help='Random seed')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        self.stdout.write(f"{'strategy':>16} {'pings':>10} {'rows written':>14} {'pings/s':>12}")
+        with transaction.atomic():
+            user_ids = self._populate(options['users'], rng)
+            pings = [
+                (rng.choice(user_ids), rng.uniform(-60, 70), rng.uniform(-180, 180))
+                for _ in range(options['updates'])
+            ]
+
+            if options['legacy_updates']:
+                self._report('per-ping save', *self._legacy(pings[:options['legacy_updates']]))
+
+            for batch_size in options['batch_sizes']:
+                self._report(f'batch {batch_size}', *self._batched(pings, batch_size))
+
+            transaction.set_rollback(True)
+
+    def _populate(self, size, rng):
+        """Create synthetic located users."""
+        users = []
+        for i in range(size):
+            user = User(
+                id=uuid.uuid4(),
+                email=f'bench-{i}@example.com',
+                name=f'Bench User {i}',
+                password='!',
+                latitude=rng.uniform(-60, 70),
+                longitude=rng.uniform(-180, 180),
+            )
+            user.refresh_location_fields()
+            users.append(user)
+        User.objects.bulk_create(users, batch_size=5000)
+        return [user.id for user in users]
+
+    @staticmethod
+    def _legacy(pings):
+        """The previous task body: one get and one full save per ping."""
+        start = time.perf_counter()
+        for user_id, latitude, longitude in pings:
+            user = User.objects.get(id=user_id)
+            user.latitude = latitude
+            user.longitude = longitude
+            user.save()
+        return len(pings), len(pings), time.perf_counter() - start
+
+    @staticmethod
+    def _batched(pings, batch_size):
+        """Coalesce each batch of pings and write it with bulk_update."""
+        start = time.perf_counter()
+        written = 0
+        for offset in range(0, len(pings), batch_size):
+            written += apply_location_updates(pings[offset:offset + batch_size])
+        return len(pings), written, time.perf_counter() - start
+
+    def _report(self, strategy, pings, written, elapsed):
+        """Write one result row."""
+        self.stdout.write(f"{strategy:>16} {pings:>10} {written:>14} {pings / elapsed:>12.0f}")
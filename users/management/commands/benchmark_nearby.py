@@ -0,0 +1,181 @@
+"""
+Benchmark for the nearby users query.
+
+Populates the database with synthetic users inside a transaction that is
+rolled back at the end, then compares the legacy full scan against the
+bounding-box and geohash cell prefilters used by the nearby endpoints, and
+against the same prefilters with the exact radius test pushed into SQL.
+"""
+
+import random
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from geopy.distance import geodesic
+import numpy as np
+
+from users.models import User
+from users.utils import haversine_distances
+
+
+class Command(BaseCommand):
+    """Measure rows scanned and latency of the nearby users query."""
+
+    help = 'Benchmark the nearby users query against synthetic users'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, nargs='+', default=[100_000, 1_000_000],
+            help='Synthetic population sizes to benchmark'
+        )
+        parser.add_argument('--radius', type=float, default=10.0, help='Search radius in km')
+        parser.add_argument('--queries', type=int, default=20, help='Queries per population size')
+        parser.add_argument(
+            '--baseline-queries', type=int, default=3,
+            help='Queries to run with the legacy full scan (0 to skip)'
+        )
+        parser.add_argument('--seed', type=int, default=42, help='Random seed')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        self.stdout.write(
+            f"{'users':>10} {'strategy':>12} {'rows scanned':>14} {'matched':>10} "
+            f"{'p50 ms':>10} {'p95 ms':>10}"
+        )
+        for size in options['users']:
+            with transaction.atomic():
+                origins = self._populate(size, rng)
+
+                if options['baseline_queries']:
+                    self._report(size, 'full scan', [
+                        self._full_scan(origin, options['radius'])
+                        for origin in origins[:options['baseline_queries']]
+                    ])
+
+                self._report(size, 'bbox', [
+                    self._bounding_box(origin, options['radius'])
+                    for origin in origins[:options['queries']]
+                ])
+
+                self._report(size, 'geohash', [
+                    self._geohash_cells(origin, options['radius'])
+                    for origin in origins[:options['queries']]
+                ])
+
+                self._report(size, 'unit vector', [
+                    self._unit_vector(origin, options['radius'])
+                    for origin in origins[:options['queries']]
+                ])
+
+                transaction.set_rollback(True)
+
+    def _populate(self, size, rng):
+        """Create synthetic users clustered around random city centers."""
+        cities = [(rng.uniform(-60, 70), rng.uniform(-180, 180)) for _ in range(50)]
+        batch = []
+
+        for i in range(size):
+            if rng.random() < 0.8:
+                city_lat, city_lon = rng.choice(cities)
+                lat = min(90.0, max(-90.0, rng.gauss(city_lat, 0.3)))
+                lon = (rng.gauss(city_lon, 0.3) + 180) % 360 - 180
+            else:
+                lat, lon = rng.uniform(-90, 90), rng.uniform(-180, 180)
+
+            user = User(
+                id=uuid.uuid4(),
+                email=f'bench-{i}@example.com',
+                name=f'Bench User {i}',
+                password='!',
+                latitude=round(lat, 6),
+                longitude=round(lon, 6),
+            )
+            user.refresh_location_fields()
+            batch.append(user)
+            if len(batch) >= 10_000:
+                User.objects.bulk_create(batch)
+                batch = []
+
+        if batch:
+            User.objects.bulk_create(batch)
+
+        # Query from the locations of real users so dense areas are exercised
+        return [
+            (float(lat), float(lon))
+            for lat, lon in User.objects.with_location().order_by('?').values_list(
+                'latitude', 'longitude'
+            )[:100]
+        ]
+
+    def _full_scan(self, origin, radius):
+        """Legacy strategy: distance to every located user."""
+        start = time.perf_counter()
+        rows = User.objects.with_location().filter(is_active=True).values_list(
+            'latitude', 'longitude'
+        )
+        scanned, matched = self._count_within(origin, rows, radius)
+        return scanned, matched, time.perf_counter() - start
+
+    def _bounding_box(self, origin, radius):
+        """SQL bounding-box prefilter, then batch distances."""
+        start = time.perf_counter()
+        queryset = User.objects.with_location().filter(
+            is_active=True
+        ).within_bounding_box(*origin, radius)
+        scanned, matched = self._count_within_batch(origin, queryset, radius)
+        return scanned, matched, time.perf_counter() - start
+
+    def _geohash_cells(self, origin, radius):
+        """Geohash covering cells and bounding box, then batch distances."""
+        start = time.perf_counter()
+        queryset = User.objects.filter(is_active=True).in_covering_cells(
+            *origin, radius
+        ).within_bounding_box(*origin, radius)
+        scanned, matched = self._count_within_batch(origin, queryset, radius)
+        return scanned, matched, time.perf_counter() - start
+
+    def _unit_vector(self, origin, radius):
+        """Geohash cells and bounding box, with the exact radius test in SQL."""
+        start = time.perf_counter()
+        queryset = User.objects.filter(is_active=True).in_covering_cells(
+            *origin, radius
+        ).within_bounding_box(*origin, radius)
+        matched = len(queryset.within_radius(*origin, radius).order_by('chord_sq').values_list(
+            'id', 'chord_sq'
+        ))
+        elapsed = time.perf_counter() - start
+        return queryset.count(), matched, elapsed
+
+    @staticmethod
+    def _count_within_batch(origin, queryset, radius):
+        """Compute distances in one pass and return (rows examined, rows matched)."""
+        rows = np.array(list(queryset.values_list('latitude', 'longitude')), dtype=np.float64)
+        if not len(rows):
+            return 0, 0
+        distances = haversine_distances(origin[0], origin[1], rows[:, 0], rows[:, 1])
+        return len(rows), int(np.count_nonzero(distances <= radius))
+
+    @staticmethod
+    def _count_within(origin, rows, radius):
+        """Compute exact distances and return (rows examined, rows matched)."""
+        scanned = matched = 0
+        for lat, lon in rows:
+            scanned += 1
+            if geodesic(origin, (float(lat), float(lon))).kilometers <= radius:
+                matched += 1
+        return scanned, matched
+
+    def _report(self, size, strategy, results):
+        """Write one result row."""
+        scanned = statistics.mean(result[0] for result in results)
+        matched = statistics.mean(result[1] for result in results)
+        timings = sorted(result[2] * 1000 for result in results)
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        self.stdout.write(
+            f"{size:>10} {strategy:>12} {int(scanned):>14} {int(matched):>10} "
+            f"{statistics.median(timings):>10.1f} {p95:>10.1f}"
+        )
@@ -0,0 +1,52 @@
+# Backfills User.geohash for users that already have coordinates.
+
+from django.db import migrations, transaction
+
+from users.geohash import encode
+
+BATCH_SIZE = 1000
+
+
+def backfill_geohash(apps, schema_editor):
+    """
+    Compute the geohash of existing located users.
+
+    Rows are walked in primary key order and each batch is written in its own
+    transaction, so the users table is never locked for the whole backfill.
+    """
+    User = apps.get_model('users', 'User')
+    db_alias = schema_editor.connection.alias
+    pending = User.objects.using(db_alias).filter(
+        latitude__isnull=False,
+        longitude__isnull=False,
+        geohash='',
+    ).order_by('pk')
+
+    last_pk = None
+    while True:
+        batch = pending if last_pk is None else pending.filter(pk__gt=last_pk)
+        users = list(batch.only('pk', 'latitude', 'longitude')[:BATCH_SIZE])
+        if not users:
+            break
+
+        for user in users:
+            user.geohash = encode(user.latitude, user.longitude)
+
+        with transaction.atomic(using=db_alias):
+            User.objects.using(db_alias).bulk_update(users, ['geohash'])
+
+        last_pk = users[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    # Commit every batch separately instead of wrapping the backfill in one transaction
+    atomic = False
+
+    dependencies = [
+        ('users', '0004_user_geohash'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_geohash, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.3 on 2026-10-17 06:29
+
+import django.core.validators
+import users.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_backfill_user_geohash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='latitude',
+            field=users.fields.CoordinateField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-90, 'Latitude must be between -90 and 90'), django.core.validators.MaxValueValidator(90, 'Latitude must be between -90 and 90')], verbose_name='Latitude'),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='longitude',
+            field=users.fields.CoordinateField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-180, 'Longitude must be between -180 and 180'), django.core.validators.MaxValueValidator(180, 'Longitude must be between -180 and 180')], verbose_name='Longitude'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.3 on 2026-10-17 06:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_user_coordinates_float'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='loc_x',
+            field=models.FloatField(blank=True, editable=False, null=True, verbose_name='Unit Vector X'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='loc_y',
+            field=models.FloatField(blank=True, editable=False, null=True, verbose_name='Unit Vector Y'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='loc_z',
+            field=models.FloatField(blank=True, editable=False, null=True, verbose_name='Unit Vector Z'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.3 on 2026-10-17 07:02
+
+import django.db.models.deletion
+import users.fields
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_backfill_user_unit_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationHistory',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('latitude', users.fields.CoordinateField(verbose_name='Latitude')),
+                ('longitude', users.fields.CoordinateField(verbose_name='Longitude')),
+                ('recorded_at', models.DateTimeField(verbose_name='Recorded At')),
+                ('minute', models.BigIntegerField(verbose_name='Minute Bucket')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='location_history', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Location History',
+                'verbose_name_plural': 'Location History',
+                'db_table': 'location_history',
+                'indexes': [models.Index(fields=['user', 'recorded_at', 'id'], name='location_hi_user_id_ee4006_idx'), models.Index(fields=['minute'], name='location_hi_minute_05f3d2_idx')],
+            },
+        ),
+    ]
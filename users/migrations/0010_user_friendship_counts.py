@@ -0,0 +1,28 @@
+# Generated by Django 5.2.3 on 2026-10-17 10:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_location_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='followers_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Followers Count'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='following_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Following Count'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='friends_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Friends Count'),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Backfills the friendship counters of users that existed before they were added.
+
+from django.db import migrations, transaction
+from django.db.models import Count
+
+BATCH_SIZE = 1000
+
+
+def backfill_friendship_counts(apps, schema_editor):
+    """
+    Count the accepted friendships of existing users.
+
+    Rows are walked in primary key order and each batch is counted with two
+    grouped queries and written in its own transaction, so the users table is
+    never locked for the whole backfill.
+    """
+    User = apps.get_model('users', 'User')
+    Friendship = apps.get_model('friendships', 'Friendship')
+    db_alias = schema_editor.connection.alias
+    users = User.objects.using(db_alias).order_by('pk')
+    accepted = Friendship.objects.using(db_alias).filter(status='accepted')
+
+    last_pk = None
+    while True:
+        batch = users if last_pk is None else users.filter(pk__gt=last_pk)
+        batch = list(batch.only('pk')[:BATCH_SIZE])
+        if not batch:
+            break
+
+        user_ids = [user.pk for user in batch]
+        following = dict(
+            accepted.filter(from_user_id__in=user_ids).values('from_user_id').annotate(
+                count=Count('pk')
+            ).values_list('from_user_id', 'count')
+        )
+        followers = dict(
+            accepted.filter(to_user_id__in=user_ids).values('to_user_id').annotate(
+                count=Count('pk')
+            ).values_list('to_user_id', 'count')
+        )
+        for user in batch:
+            user.followers_count = followers.get(user.pk, 0)
+            user.following_count = following.get(user.pk, 0)
+            user.friends_count = user.followers_count + user.following_count
+
+        with transaction.atomic(using=db_alias):
+            User.objects.using(db_alias).bulk_update(
+                batch, ['friends_count', 'followers_count', 'following_count']
+            )
+
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    # Commit every batch separately instead of wrapping the backfill in one transaction
+    atomic = False
+
+    dependencies = [
+        ('users', '0010_user_friendship_counts'),
+        ('friendships', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_friendship_counts, migrations.RunPython.noop),
+    ]
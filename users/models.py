@@ -11,8 +11,90 @@ from django.db import models
 from django.utils import timezone
 import uuid
 
+from .fields import CoordinateField
+from .geohash import encode as encode_geohash, covering_cells
+from .utils import bounding_box, chord_threshold, unit_vector
 
-class UserManager(BaseUserManager):
+
+class UserQuerySet(models.QuerySet):
+    """
+    Custom queryset for location-based user queries.
+    """
+
+    def with_location(self):
+        """Return users that have both geographic coordinates set."""
+        return self.filter(latitude__isnull=False, longitude__isnull=False)
+
+    def within_bounding_box(self, latitude, longitude, radius_km):
+        """
+        Return users inside the lat/lon box enclosing a radius around a point.
+
+        This is a prefilter served by the (latitude, longitude) index; exact
+        distances still have to be checked on the returned candidates.
+
+        Args:
+            latitude: Latitude of the center point
+            longitude: Longitude of the center point
+            radius_km: Search radius in kilometers
+
+        Returns:
+            QuerySet: Users whose coordinates fall inside the box
+        """
+        min_lat, max_lat, lon_ranges = bounding_box(latitude, longitude, radius_km)
+
+        lon_filter = models.Q()
+        for min_lon, max_lon in lon_ranges:
+            lon_filter |= models.Q(longitude__range=(min_lon, max_lon))
+
+        return self.filter(lon_filter, latitude__range=(min_lat, max_lat))
+
+    def in_covering_cells(self, latitude, longitude, radius_km):
+        """
+        Return users inside the geohash cells covering a radius around a point.
+
+        Each covering cell is a prefix range scan on the geohash index.
+
+        Args:
+            latitude: Latitude of the center point
+            longitude: Longitude of the center point
+            radius_km: Search radius in kilometers
+
+        Returns:
+            QuerySet: Users whose geohash falls in one of the covering cells
+        """
+        cell_filter = models.Q()
+        for cell in covering_cells(latitude, longitude, radius_km):
+            cell_filter |= models.Q(geohash__startswith=cell)
+
+        return self.filter(cell_filter)
+
+    def within_radius(self, latitude, longitude, radius_km):
+        """
+        Return users within a great-circle radius of a point.
+
+        The exact distance test runs in SQL on the precomputed unit vectors,
+        and each user is annotated with chord_sq, the squared chord between
+        its unit vector and the point's, which orders users by distance.
+
+        Args:
+            latitude: Latitude of the center point
+            longitude: Longitude of the center point
+            radius_km: Search radius in kilometers
+
+        Returns:
+            QuerySet: Users within the radius, annotated with chord_sq
+        """
+        x, y, z = unit_vector(latitude, longitude)
+        dx = models.F('loc_x') - x
+        dy = models.F('loc_y') - y
+        dz = models.F('loc_z') - z
+
+        return self.annotate(chord_sq=dx * dx + dy * dy + dz * dz).filter(
+            chord_sq__lte=chord_threshold(radius_km)
+        )
+
+
+class UserManager(BaseUserManager.from_queryset(UserQuerySet)):
     """
     Custom user manager for email-based authentication.
 
@@ -89,9 +171,7 @@ class User(AbstractBaseUser, PermissionsMixin):
     description = models.TextField(verbose_name="Description", blank=True)
 
     # Geographic coordinates for location-based features
-    latitude = models.DecimalField(
-        max_digits=9,
-        decimal_places=6,
+    latitude = CoordinateField(
         null=True,
         blank=True,
         validators=[
@@ -100,9 +180,7 @@ class User(AbstractBaseUser, PermissionsMixin):
         ],
         verbose_name="Latitude"
     )
-    longitude = models.DecimalField(
-        max_digits=9,
-        decimal_places=6,
+    longitude = CoordinateField(
         null=True,
         blank=True,
         validators=[
@@ -112,6 +190,26 @@ class User(AbstractBaseUser, PermissionsMixin):
         verbose_name="Longitude"
     )
 
+    # Geohash of the coordinates, maintained by refresh_location_fields()
+    geohash = models.CharField(
+        max_length=12,
+        blank=True,
+        default='',
+        db_index=True,
+        editable=False,
+        verbose_name="Geohash"
+    )
+
+    # Unit vector of the coordinates, maintained by refresh_location_fields()
+    loc_x = models.FloatField(null=True, blank=True, editable=False, verbose_name="Unit Vector X")
+    loc_y = models.FloatField(null=True, blank=True, editable=False, verbose_name="Unit Vector Y")
+    loc_z = models.FloatField(null=True, blank=True, editable=False, verbose_name="Unit Vector Z")
+
+    # Accepted friendship counts, maintained by friendships.counts
+    friends_count = models.IntegerField(default=0, editable=False, verbose_name="Friends Count")
+    followers_count = models.IntegerField(default=0, editable=False, verbose_name="Followers Count")
+    following_count = models.IntegerField(default=0, editable=False, verbose_name="Following Count")
+
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Created At")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Updated At")
@@ -144,8 +242,16 @@ class User(AbstractBaseUser, PermissionsMixin):
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)
 
+    # Fields derived from latitude/longitude by refresh_location_fields()
+    DERIVED_LOCATION_FIELDS = ['geohash', 'loc_x', 'loc_y', 'loc_z']
+
+    # Counters only ever written with F() expressions by friendships.counts
+    FRIENDSHIP_COUNT_FIELDS = ['friends_count', 'followers_count', 'following_count']
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # Location as last loaded or saved, compared on save by users.signals
+        self._saved_location_state = self.location_state()
 
     class Meta:
         """Meta options for the User model."""
@@ -163,6 +269,48 @@ class User(AbstractBaseUser, PermissionsMixin):
         """String representation of the User model."""
         return f"{self.name} ({self.email})"
 
+    def save(self, *args, **kwargs):
+        """Save the user, keeping derived location fields in sync."""
+        self.refresh_location_fields()
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | set(self.DERIVED_LOCATION_FIELDS)
+        elif update_fields is None and not self._state.adding and not kwargs.get('force_insert'):
+            # Leave the counters out so a stale instance never overwrites them
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in deferred
+                and field.name not in self.FRIENDSHIP_COUNT_FIELDS
+            ]
+
+        super().save(*args, **kwargs)
+
+    def refresh_location_fields(self):
+        """Recompute the fields derived from latitude and longitude."""
+        if self.has_location:
+            self.geohash = encode_geohash(self.latitude, self.longitude)
+            self.loc_x, self.loc_y, self.loc_z = unit_vector(self.latitude, self.longitude)
+        else:
+            self.geohash = ''
+            self.loc_x = self.loc_y = self.loc_z = None
+
+    def location_state(self):
+        """
+        Get the fields that decide where, if anywhere, the user is found nearby.
+
+        Deferred fields are reported as None instead of being loaded.
+
+        Returns:
+            tuple: (latitude, longitude, is_active)
+        """
+        return (
+            self.__dict__.get('latitude'),
+            self.__dict__.get('longitude'),
+            self.__dict__.get('is_active'),
+        )
+
     @property
     def age(self):
         """Calculate user's age based on date of birth."""
@@ -181,5 +329,58 @@ class User(AbstractBaseUser, PermissionsMixin):
     def get_location_tuple(self):
         """Get location as a tuple of (latitude, longitude)."""
         if self.has_location:
-            return (float(self.latitude), float(self.longitude))
+            return (self.latitude, self.longitude)
         return None
+
+
+class LocationHistory(models.Model):
+    """
+    Append-only history of user locations.
+
+    One row is written per user and location update window by the location
+    update flush (see users.location_updates). Rows carry the minute they
+    were recorded in as an integer bucket, which the downsampling job
+    (users.history) uses to group and thin out old points, and which suits
+    range partitioning on databases that support it.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='location_history',
+        db_index=False,
+        verbose_name="User"
+    )
+    latitude = CoordinateField(verbose_name="Latitude")
+    longitude = CoordinateField(verbose_name="Longitude")
+    recorded_at = models.DateTimeField(verbose_name="Recorded At")
+    minute = models.BigIntegerField(verbose_name="Minute Bucket")
+
+    class Meta:
+        """Meta options for the LocationHistory model."""
+        verbose_name = "Location History"
+        verbose_name_plural = "Location History"
+        db_table = 'location_history'
+        indexes = [
+            # Serves track queries: one user, a time range, in order
+            models.Index(fields=['user', 'recorded_at', 'id']),
+            models.Index(fields=['minute']),
+        ]
+
+    def __str__(self):
+        """String representation of the LocationHistory model."""
+        return f"{self.user_id} at {self.recorded_at}: ({self.latitude}, {self.longitude})"
+
+    @staticmethod
+    def minute_bucket(moment):
+        """
+        Get the time bucket of a moment.
+
+        Args:
+            moment: Aware datetime
+
+        Returns:
+            int: Whole minutes since the Unix epoch
+        """
+        return int(moment.timestamp() // 60)
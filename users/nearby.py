@@ -0,0 +1,424 @@
+"""
+Location query helpers shared by the nearby endpoints.
+
+Candidates come from the in-process spatial index (users.spatial) when it is
+enabled, and otherwise from a queryset restricted to the geohash cells and
+bounding box covering the search circle, with the exact radius test and
+ordering evaluated in SQL on precomputed unit vectors. Database rankings for
+cacheable radii go through the result cache in users.nearby_cache. Nearby
+friends are otherwise read a page at a time from one SQL query (see
+users_within). Distances are computed with the vectorized kernels from
+users.utils, or with the backend of another distance mode from
+users.distance, which then also decides which users are within the radius
+and how they are ranked.
+
+Banded (multi-ring) searches rank the candidates of the largest ring once and
+split that ranking at the inner radii, rather than searching once per ring.
+"""
+
+import heapq
+import math
+from functools import partial
+
+import numpy as np
+
+from . import nearby_cache, spatial
+from .distance import DEFAULT_DISTANCE_MODE, get_distance_backend, rank_points, search_radius
+from .models import User
+from .utils import chord_distances, haversine_distances, radius_mask
+
+# Limits for the k-nearest endpoints
+NEAREST_DEFAULT_K = 20
+NEAREST_MAX_K = 100
+
+# First ring searched by the database k-nearest lookup
+NEAREST_INITIAL_RADIUS_KM = 1.0
+
+# Limits for the multi-ring endpoints: rings per search, and users per ring
+MAX_RINGS = 10
+RINGS_DEFAULT_LIMIT = 50
+RINGS_MAX_LIMIT = 500
+
+# Rows fetched per round trip while streaming candidates
+CHUNK_SIZE = 2000
+
+
+def nearby_user_ids(user, radius_km, distance_mode=DEFAULT_DISTANCE_MODE):
+    """
+    Rank the active users within a radius of a user's location.
+
+    Only ids and distances are returned so callers can load just the users
+    they are going to serialize.
+
+    Args:
+        user: User whose location is the search center
+        radius_km: Search radius in kilometers
+        distance_mode: Distance mode the radius and the ranking are measured in
+
+    Returns:
+        tuple: (list of user ids, numpy array of distances in km), ordered
+        by distance and then id
+    """
+    origin = user.get_location_tuple()
+
+    if spatial.is_enabled():
+        return spatial.get_index().query_radius(
+            *origin, radius_km, exclude=user.id, distance_mode=distance_mode
+        )
+
+    if nearby_cache.is_enabled():
+        ranked = nearby_cache.cached_ranking(
+            origin, radius_km, partial(_candidates_in_circle, User.objects.filter(is_active=True)),
+            exclude=user.id, distance_mode=distance_mode
+        )
+        if ranked is not None:
+            return ranked
+
+    prefilter_km = search_radius(radius_km, distance_mode)
+    candidates = User.objects.filter(is_active=True).in_covering_cells(
+        *origin, prefilter_km
+    ).within_bounding_box(*origin, prefilter_km).exclude(id=user.id)
+    return rank_ids_by_distance(candidates, origin, radius_km, distance_mode)
+
+
+def cached_nearby_friend_ids(user, friends, radius_km, distance_mode=DEFAULT_DISTANCE_MODE):
+    """
+    Rank the friends within a radius of a user's location from the result cache.
+
+    The cache fronts the database path only, so nothing is returned while the
+    spatial index is enabled.
+
+    Args:
+        user: User whose location is the search center
+        friends: QuerySet of the user's friends
+        radius_km: Search radius in kilometers
+        distance_mode: Distance mode the radius and the ranking are measured in
+
+    Returns:
+        tuple: (list of user ids, numpy array of distances in km), ordered
+        by distance and then id, or None when the cache cannot answer
+    """
+    if spatial.is_enabled() or not nearby_cache.is_enabled():
+        return None
+
+    return nearby_cache.cached_ranking(
+        user.get_location_tuple(), radius_km, partial(_candidates_in_circle, friends),
+        friends_of=user.id, distance_mode=distance_mode
+    )
+
+
+def nearby_friend_ids(user, friends, radius_km, distance_mode=DEFAULT_DISTANCE_MODE):
+    """
+    Rank the friends within a radius of a user's location.
+
+    Args:
+        user: User whose location is the search center
+        friends: QuerySet of the user's friends
+        radius_km: Search radius in kilometers
+        distance_mode: Distance mode the radius and the ranking are measured in
+
+    Returns:
+        tuple: (list of user ids, numpy array of distances in km), ordered
+        by distance and then id
+    """
+    ranked = cached_nearby_friend_ids(user, friends, radius_km, distance_mode)
+    if ranked is not None:
+        return ranked
+
+    origin = user.get_location_tuple()
+    prefilter_km = search_radius(radius_km, distance_mode)
+    candidates = friends.in_covering_cells(*origin, prefilter_km).within_bounding_box(
+        *origin, prefilter_km
+    )
+    return rank_ids_by_distance(candidates, origin, radius_km, distance_mode)
+
+
+def parse_radii(value):
+    """
+    Parse a comma-separated list of ring radii.
+
+    Args:
+        value: Comma-separated radii in kilometers, in any order
+
+    Returns:
+        list: Distinct radii as floats, smallest first
+
+    Raises:
+        ValueError: If a radius is not a positive number or there are more
+            than MAX_RINGS of them
+    """
+    try:
+        radii = sorted({float(part) for part in value.split(',')})
+    except ValueError:
+        raise ValueError('radii must be comma-separated numbers') from None
+
+    if not all(math.isfinite(radius) and radius > 0 for radius in radii):
+        raise ValueError('radii must be positive')
+    if len(radii) > MAX_RINGS:
+        raise ValueError(f'At most {MAX_RINGS} radii may be given')
+    return radii
+
+
+def split_rings(ids, distances, radii, limit):
+    """
+    Split a distance ranking into rings.
+
+    Ring i holds the users farther than radii[i - 1] and at most radii[i]
+    away. Since the ranking is sorted, each ring is a contiguous slice found
+    by one binary search per radius.
+
+    Args:
+        ids: User ids, closest first
+        distances: Numpy array of distances in km aligned with ids
+        radii: Ring radii, smallest first
+        limit: Most users kept per ring
+
+    Returns:
+        list: (count, ids, distances) per ring, where count is the number of
+        users in the ring and ids and distances its closest `limit` users
+    """
+    bounds = np.searchsorted(distances, radii, side='right').tolist()
+    rings = []
+    for start, end in zip([0] + bounds, bounds):
+        rings.append((end - start, ids[start:min(end, start + limit)],
+                      distances[start:min(end, start + limit)]))
+    return rings
+
+
+def users_within(queryset, center, radius_km):
+    """
+    Restrict a queryset to the users within a circle, entirely in SQL.
+
+    The geohash cells and bounding box give index-served prefilters and the
+    unit vectors give the exact test; see UserQuerySet.within_radius.
+
+    Args:
+        queryset: QuerySet of candidate users
+        center: (latitude, longitude) tuple of the circle center
+        radius_km: Radius in kilometers
+
+    Returns:
+        QuerySet: Users within the circle, annotated with chord_sq
+    """
+    return queryset.in_covering_cells(*center, radius_km).within_bounding_box(
+        *center, radius_km
+    ).within_radius(*center, radius_km)
+
+
+def find_nearest_users(user, k, distance_mode=DEFAULT_DISTANCE_MODE):
+    """
+    Find the k active users closest to a user's location.
+
+    Args:
+        user: User whose location is the search center
+        k: Number of users to return
+        distance_mode: Distance mode to rank by
+
+    Returns:
+        list: (user, distance_km) tuples, closest first
+    """
+    origin = user.get_location_tuple()
+
+    if spatial.is_enabled():
+        index = spatial.get_index()
+        active_users = User.objects.filter(is_active=True)
+
+        # The index may still hold users deleted or deactivated by another
+        # process; ask for more until k of them load
+        limit = k
+        while True:
+            ids, distances = index.query_knn(
+                *origin, limit, exclude=user.id, distance_mode=distance_mode
+            )
+            nearest = load_ranked(active_users, ids, distances)
+            if len(nearest) >= k or len(ids) < limit:
+                return nearest[:k]
+            limit *= 2
+
+    candidates = User.objects.filter(is_active=True).exclude(id=user.id)
+    return nearest_in_rings(candidates, origin, k, distance_mode)
+
+
+def find_nearest_friends(user, friends, k, distance_mode=DEFAULT_DISTANCE_MODE):
+    """
+    Find the k friends closest to a user's location.
+
+    Args:
+        user: User whose location is the search center
+        friends: QuerySet of the user's friends
+        k: Number of friends to return
+        distance_mode: Distance mode to rank by
+
+    Returns:
+        list: (user, distance_km) tuples, closest first
+    """
+    origin = user.get_location_tuple()
+
+    if spatial.is_enabled():
+        ids, distances = spatial.get_index().distances_to(
+            *origin, friends.values_list('id', flat=True), distance_mode=distance_mode
+        )
+        nearest = heapq.nsmallest(k, zip(distances.tolist(), ids))
+        return load_ranked(
+            friends, [user_id for _, user_id in nearest], [distance for distance, _ in nearest]
+        )
+
+    return nearest_in_rings(friends, origin, k, distance_mode)
+
+
+def nearest_in_rings(queryset, origin, k, distance_mode=DEFAULT_DISTANCE_MODE):
+    """
+    Select the k users of a queryset closest to an origin.
+
+    The search radius starts small and doubles until k users are confirmed
+    inside it; no user outside the radius can then be closer. Candidates of
+    each ring are streamed in chunks through a bounded max-heap, so neither
+    the candidate set nor its ordering is ever held in memory.
+
+    Args:
+        queryset: QuerySet of candidate users
+        origin: (latitude, longitude) tuple of the search center
+        k: Number of users to return
+        distance_mode: Distance mode to rank by
+
+    Returns:
+        list: (user, distance_km) tuples, closest first
+    """
+    backend = get_distance_backend(distance_mode)
+    radius_km = NEAREST_INITIAL_RADIUS_KM
+
+    while True:
+        # Max-heap of the k closest candidates so far, as (-distance, id)
+        heap = []
+        prefilter_km = search_radius(radius_km, distance_mode)
+        candidates = queryset.in_covering_cells(*origin, prefilter_km).within_bounding_box(
+            *origin, prefilter_km
+        ).values_list('id', 'latitude', 'longitude')
+        # The last ring covers the whole earth, however far a mode measures it
+        limit_km = None if radius_km >= spatial.MAX_RADIUS_KM else radius_km
+
+        for ids, distances in _stream_distances(candidates, origin, backend):
+            for i in np.flatnonzero(radius_mask(distances, limit_km)):
+                item = (-float(distances[i]), ids[i])
+                if len(heap) < k:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+
+        if len(heap) >= k or radius_km >= spatial.MAX_RADIUS_KM:
+            break
+        radius_km = min(radius_km * 2, spatial.MAX_RADIUS_KM)
+
+    nearest = sorted((-distance, user_id) for distance, user_id in heap)
+    return load_ranked(
+        queryset, [user_id for _, user_id in nearest], [distance for distance, _ in nearest]
+    )
+
+
+def _stream_distances(rows, origin, backend):
+    """Yield (ids, distances) for chunks of (id, latitude, longitude) rows."""
+    chunk = []
+    for row in rows.iterator(chunk_size=CHUNK_SIZE):
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            yield _chunk_distances(chunk, origin, backend)
+            chunk = []
+    if chunk:
+        yield _chunk_distances(chunk, origin, backend)
+
+
+def _chunk_distances(chunk, origin, backend):
+    """Compute distances for one chunk of (id, latitude, longitude) rows."""
+    ids, latitudes, longitudes = zip(*chunk)
+    return ids, backend(
+        origin[0], origin[1],
+        np.array(latitudes, dtype=np.float64),
+        np.array(longitudes, dtype=np.float64),
+    )
+
+
+def load_ranked(queryset, ids, distances):
+    """
+    Load users for an ordered list of ids, keeping the order.
+
+    Ids missing from the queryset are skipped.
+
+    Args:
+        queryset: QuerySet the users must belong to
+        ids: User ids, closest first
+        distances: Distances in kilometers aligned with ids
+
+    Returns:
+        list: (user, distance_km) tuples in the order of ids
+    """
+    users = queryset.in_bulk(ids)
+    return [
+        (users[user_id], float(distance))
+        for user_id, distance in zip(ids, distances)
+        if user_id in users
+    ]
+
+
+def iter_ranked(queryset, ids, distances, chunk_size=500):
+    """
+    Lazily load users for an ordered list of ids, a chunk at a time.
+
+    Args:
+        queryset: QuerySet the users must belong to
+        ids: User ids, closest first
+        distances: Distances in kilometers aligned with ids
+        chunk_size: Number of users loaded per query
+
+    Yields:
+        tuple: (user, distance_km) in the order of ids
+    """
+    for start in range(0, len(ids), chunk_size):
+        yield from load_ranked(
+            queryset, ids[start:start + chunk_size], distances[start:start + chunk_size]
+        )
+
+
+def rank_ids_by_distance(queryset, origin, radius_km, distance_mode=DEFAULT_DISTANCE_MODE):
+    """
+    Rank the users of a queryset by distance from an origin.
+
+    The radius test and the ordering both run in SQL on the users' unit
+    vectors; only ids and squared chords come back, and the chords are turned
+    into distances in one vectorized pass. In other distance modes SQL only
+    keeps the candidates within the mode's search radius, and they are
+    measured, filtered and ranked with the mode's backend.
+
+    Args:
+        queryset: QuerySet of candidate users
+        origin: (latitude, longitude) tuple of the search center
+        radius_km: Search radius in kilometers
+        distance_mode: Distance mode the radius and the ranking are measured in
+
+    Returns:
+        tuple: (list of user ids, numpy array of distances in km), ordered
+        by distance and then id
+    """
+    if get_distance_backend(distance_mode) is not haversine_distances:
+        rows = list(queryset.within_radius(
+            *origin, search_radius(radius_km, distance_mode)
+        ).values_list('id', 'latitude', 'longitude'))
+        if not rows:
+            return [], np.empty(0)
+        ids, latitudes, longitudes = zip(*rows)
+        return rank_points(list(ids), latitudes, longitudes, origin, radius_km, distance_mode)
+
+    rows = list(
+        queryset.within_radius(*origin, radius_km).order_by('chord_sq', 'id').values_list(
+            'id', 'chord_sq'
+        )
+    )
+    if not rows:
+        return [], np.empty(0)
+
+    ids, chords = zip(*rows)
+    return list(ids), chord_distances(chords)
+
+
+def _candidates_in_circle(queryset, center, radius_km):
+    """Query (id, latitude, longitude) rows of the users of a queryset within a circle."""
+    return users_within(queryset, center, radius_km).values_list('id', 'latitude', 'longitude')
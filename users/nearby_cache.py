@@ -0,0 +1,259 @@
+"""
+Result cache for the database path of the nearby endpoints.
+
+Clients poll the nearby endpoints with almost the same coordinates every few
+seconds. Requests are grouped by the grid cell their origin falls in and by
+a radius bucket (the requested radius rounded up). Each group caches the
+candidate users within the bucket radius plus half a cell diagonal of the
+cell center, a superset of the users near any origin in the cell. Every
+request then refines the cached candidates with exact distances from its own
+origin, measured in the request's distance mode; modes that need a wider
+spherical search than haversine cache their own candidates.
+
+Entries are invalidated selectively. Locations are also grouped into coarser
+invalidation cells, each with a version that is replaced when a user inside
+it moves, appears or disappears. An entry records the versions of the
+invalidation cells its search circle covers and is ignored once any of them
+changes. Friend-set versions play the same role for the friends variant.
+"""
+
+import math
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+import numpy as np
+
+from .distance import DEFAULT_DISTANCE_MODE, get_distance_backend, search_radius
+from .utils import EARTH_RADIUS_KM, bounding_box, radius_mask, argsort_by_distance
+
+CACHE_KEY_PREFIX = 'users:nearby_cache'
+
+# Requested radii are rounded up to one of these; larger radii are not cached
+RADIUS_BUCKETS_KM = (1, 2, 5, 10, 20, 50, 100)
+
+# Searches covering more invalidation cells than this are not cached
+MAX_INVALIDATION_CELLS = 64
+
+# Kinds of cached rankings reported by stats()
+SCOPES = ('users', 'friends')
+COUNTERS = ('hits', 'misses')
+
+
+def is_enabled():
+    """Whether nearby rankings should be served from the result cache."""
+    return settings.NEARBY_CACHE_ENABLED
+
+
+def radius_bucket(radius_km):
+    """
+    Round a radius up to its cache bucket.
+
+    Args:
+        radius_km: Requested radius in kilometers
+
+    Returns:
+        int: Bucket radius in kilometers, or None if the radius is too large
+    """
+    for bucket in RADIUS_BUCKETS_KM:
+        if radius_km <= bucket:
+            return bucket
+    return None
+
+
+def cached_ranking(origin, radius_km, load_candidates, exclude=None, friends_of=None,
+                   distance_mode=DEFAULT_DISTANCE_MODE):
+    """
+    Rank users near an origin from the cached candidates of its cell.
+
+    Args:
+        origin: (latitude, longitude) tuple of the search center
+        radius_km: Search radius in kilometers
+        load_candidates: Callable taking (center, radius_km) and returning
+            (id, latitude, longitude) rows of every candidate in that circle
+        exclude: Optional user id left out of the ranking
+        friends_of: Id of the user whose friends are ranked, or None to rank
+            all users; friends are cached per user and guarded by the
+            user's friend-set version
+        distance_mode: Distance mode (see users.distance) the radius and
+            the ranking are measured in
+
+    Returns:
+        tuple: (list of user ids, numpy array of distances in km), ordered by
+        distance and then id, or None when the search cannot be cached
+    """
+    bucket = radius_bucket(radius_km)
+    if bucket is None:
+        return None
+
+    size = settings.NEARBY_CACHE_CELL_SIZE
+    row, col = math.floor(origin[0] / size), math.floor(origin[1] / size)
+    center = ((row + 0.5) * size, (col + 0.5) * size)
+    widened = search_radius(bucket, distance_mode)
+    candidate_radius = widened + math.radians(size) * EARTH_RADIUS_KM * math.sqrt(2) / 2
+    # Modes searching the same circle share its candidates
+    bucket_key = bucket if widened == bucket else f'{bucket}:{distance_mode}'
+
+    version_keys = _invalidation_keys(center, candidate_radius)
+    if version_keys is None:
+        return None
+    if friends_of is None:
+        scope = 'users'
+        entry_key = f'{CACHE_KEY_PREFIX}:users:{row}:{col}:{bucket_key}'
+    else:
+        scope = 'friends'
+        entry_key = f'{CACHE_KEY_PREFIX}:friends:{friends_of}:{row}:{col}:{bucket_key}'
+        version_keys.append(_friends_version_key(friends_of))
+
+    values = cache.get_many([entry_key, *version_keys])
+    versions = [values.get(key) for key in version_keys]
+    entry = values.get(entry_key)
+
+    if entry is not None and entry['versions'] == versions:
+        _count(scope, 'hits')
+        ids, points = entry['ids'], entry['points']
+    else:
+        _count(scope, 'misses')
+        rows = list(load_candidates(center, candidate_radius))
+        ids = [user_id for user_id, _, _ in rows]
+        points = np.array([(lat, lon) for _, lat, lon in rows], dtype=np.float64).reshape(-1, 2)
+        cache.set(
+            entry_key, {'versions': versions, 'ids': ids, 'points': points},
+            timeout=settings.NEARBY_CACHE_TIMEOUT
+        )
+
+    distances = get_distance_backend(distance_mode)(origin[0], origin[1], points[:, 0], points[:, 1])
+    mask = radius_mask(distances, radius_km)
+    if exclude is not None:
+        mask &= np.array([user_id != exclude for user_id in ids], dtype=bool)
+
+    keys = np.array([user_id.bytes for user_id in ids], dtype='S16')
+    order = argsort_by_distance(distances, mask, tiebreak=keys)
+    return [ids[i] for i in order], distances[order]
+
+
+def invalidate_location(latitude, longitude):
+    """
+    Invalidate every cached entry whose search covers a location.
+
+    Args:
+        latitude: Latitude of the changed location
+        longitude: Longitude of the changed location
+    """
+    size = settings.NEARBY_CACHE_INVALIDATION_CELL_SIZE
+    _bump(_version_key(math.floor(latitude / size), math.floor(longitude / size)))
+
+
+def invalidate_locations(locations):
+    """
+    Invalidate every cached entry whose search covers any of some locations.
+
+    Each invalidation cell is bumped once however many locations it holds.
+
+    Args:
+        locations: Iterable of (latitude, longitude) tuples
+    """
+    size = settings.NEARBY_CACHE_INVALIDATION_CELL_SIZE
+    cells = {
+        (math.floor(latitude / size), math.floor(longitude / size))
+        for latitude, longitude in locations
+    }
+    _bump(*(_version_key(row, col) for row, col in cells))
+
+
+def invalidate_friends(user_id):
+    """
+    Invalidate the cached nearby friends of a user.
+
+    Args:
+        user_id: Id of the user whose friend set changed
+    """
+    _bump(_friends_version_key(user_id))
+
+
+def stats():
+    """
+    Get hit and miss counts of the cache, shared by every process.
+
+    Returns:
+        dict: Settings and per-scope hit/miss counters
+    """
+    counters = cache.get_many(_counter_keys())
+
+    result = {
+        'enabled': is_enabled(),
+        'cell_size_deg': settings.NEARBY_CACHE_CELL_SIZE,
+        'invalidation_cell_size_deg': settings.NEARBY_CACHE_INVALIDATION_CELL_SIZE,
+        'timeout_seconds': settings.NEARBY_CACHE_TIMEOUT,
+    }
+    for scope in SCOPES:
+        hits = counters.get(_counter_key(scope, 'hits'), 0)
+        misses = counters.get(_counter_key(scope, 'misses'), 0)
+        result[scope] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 4) if hits + misses else None,
+        }
+    return result
+
+
+def reset_stats():
+    """Reset the hit and miss counters."""
+    cache.delete_many(_counter_keys())
+
+
+def _invalidation_keys(center, radius_km):
+    """Version keys of the invalidation cells covering a circle, or None if too many."""
+    size = settings.NEARBY_CACHE_INVALIDATION_CELL_SIZE
+    min_lat, max_lat, lon_ranges = bounding_box(*center, radius_km)
+    rows = range(math.floor(min_lat / size), math.floor(max_lat / size) + 1)
+    column_spans = [
+        range(math.floor(min_lon / size), math.floor(max_lon / size) + 1)
+        for min_lon, max_lon in lon_ranges
+    ]
+    if len(rows) * sum(len(columns) for columns in column_spans) > MAX_INVALIDATION_CELLS:
+        return None
+
+    return [
+        _version_key(row, col)
+        for row in rows
+        for columns in column_spans
+        for col in columns
+    ]
+
+
+def _version_key(row, col):
+    return f'{CACHE_KEY_PREFIX}:version:{row}:{col}'
+
+
+def _friends_version_key(user_id):
+    return f'{CACHE_KEY_PREFIX}:friends_version:{user_id}'
+
+
+def _counter_key(scope, name):
+    return f'{CACHE_KEY_PREFIX}:{scope}:{name}'
+
+
+def _counter_keys():
+    return [_counter_key(scope, name) for scope in SCOPES for name in COUNTERS]
+
+
+def _bump(*keys):
+    """
+    Replace the versions stored under some keys, without expiry.
+
+    Versions only need to differ from the ones entries recorded, so a bump
+    writes one fresh random token to every key in a single round trip. This
+    also means a version evicted from the cache can never come back equal.
+    """
+    cache.set_many(dict.fromkeys(keys, uuid.uuid4().hex), timeout=None)
+
+
+def _count(scope, name):
+    """Increment a hit or miss counter."""
+    key = _counter_key(scope, name)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
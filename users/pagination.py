@@ -0,0 +1,388 @@
+"""
+Cursor pagination for distance-ordered results and location tracks.
+
+Nearby results are ranked by (distance, id). A cursor encodes the sort key
+and id of the last user on a page, so the next page starts right after it
+no matter how many users were added or removed further out in the meantime.
+Rankings computed in memory are keyed by distance; rankings read page by
+page from SQL are keyed by the squared chord the database orders by.
+Large pages can be streamed as NDJSON, one user per line, so a worker only
+ever holds a single chunk of users in memory. Tracks are paginated the same
+way by (recorded_at, id), and users filtered by a test SQL cannot express
+(such as geofences) by id.
+"""
+
+import base64
+import binascii
+import json
+import uuid
+
+import numpy as np
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.utils.encoders import JSONEncoder
+
+from .utils import chord_distances
+
+# Sort keys a cursor can encode
+DISTANCE_KEY = 'distance'
+CHORD_KEY = 'chord'
+
+
+class DistanceCursorPagination:
+    """
+    Paginate (ids, distances) rankings ordered by distance and then id.
+    """
+
+    page_size = 50
+    max_page_size = 200
+    max_stream_page_size = 10000
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    stream_query_param = 'stream'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self):
+        self.next_cursor = None
+        self.streaming = False
+
+    def paginate_ranked(self, ids, distances, request):
+        """
+        Select the page of a ranking requested by a query.
+
+        Args:
+            ids: User ids ordered by distance and then id
+            distances: Distances in kilometers aligned with ids
+            request: The request carrying the cursor and page size
+
+        Returns:
+            tuple: (ids, distances) of the page
+        """
+        self.streaming = self.is_streaming(request)
+        page_size = self.get_page_size(request)
+        distances = np.asarray(distances, dtype=np.float64)
+
+        cursor = self.decode_cursor(request, DISTANCE_KEY)
+        start = self._position_after(ids, distances, *cursor) if cursor else 0
+        end = min(start + page_size, len(ids))
+
+        if end < len(ids):
+            self.next_cursor = self.encode_cursor(
+                DISTANCE_KEY, float(distances[end - 1]), ids[end - 1]
+            )
+        else:
+            self.next_cursor = None
+
+        return ids[start:end], distances[start:end]
+
+    def paginate_queryset(self, queryset, request):
+        """
+        Read the page requested by a query straight from SQL.
+
+        The queryset must be annotated with chord_sq (see
+        UserQuerySet.within_radius). Only the rows of the page are fetched,
+        using the cursor as a keyset bound on (chord_sq, id).
+
+        Args:
+            queryset: QuerySet of users annotated with chord_sq
+            request: The request carrying the cursor and page size
+
+        Returns:
+            tuple: (ids, distances) of the page
+        """
+        self.streaming = self.is_streaming(request)
+        page_size = self.get_page_size(request)
+
+        cursor = self.decode_cursor(request, CHORD_KEY)
+        if cursor:
+            chord, user_id = cursor
+            queryset = queryset.filter(Q(chord_sq__gt=chord) | Q(chord_sq=chord, id__gt=user_id))
+
+        rows = list(
+            queryset.order_by('chord_sq', 'id').values_list('id', 'chord_sq')[:page_size + 1]
+        )
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            self.next_cursor = self.encode_cursor(CHORD_KEY, rows[-1][1], rows[-1][0])
+        else:
+            self.next_cursor = None
+
+        if not rows:
+            return [], np.empty(0)
+
+        ids, chords = zip(*rows)
+        return list(ids), chord_distances(chords)
+
+    def is_streaming(self, request):
+        """Check whether the request asks for an NDJSON stream."""
+        value = request.query_params.get(self.stream_query_param, '')
+        return value.lower() in ('1', 'true', 'yes')
+
+    def get_page_size(self, request):
+        """
+        Get the page size requested by a query, capped at the maximum.
+
+        Streamed responses default to, and are capped at, the larger
+        streaming page size.
+        """
+        limit = self.max_stream_page_size if self.streaming else self.max_page_size
+        default = limit if self.streaming else self.page_size
+
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return default
+
+        return default if page_size <= 0 else min(page_size, limit)
+
+    def encode_cursor(self, kind, key, user_id):
+        """Encode the position of a user in a ranking as an opaque cursor."""
+        position = f'{kind}:{key!r}:{user_id}'
+        return base64.urlsafe_b64encode(position.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, request, kind):
+        """
+        Decode the cursor of a query.
+
+        Args:
+            request: The request carrying the cursor
+            kind: Sort key the cursor must have been encoded with
+
+        Returns:
+            tuple: (sort key, user id), or None when no cursor was given
+
+        Raises:
+            NotFound: If the cursor is malformed or was issued for another ranking
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            position = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            cursor_kind, key, user_id = position.split(':')
+            if cursor_kind != kind:
+                raise ValueError(cursor_kind)
+            return float(key), uuid.UUID(user_id)
+        except (binascii.Error, UnicodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_streaming_response(self, rows):
+        """
+        Stream serialized rows as NDJSON.
+
+        The cursor of the following page is sent in the X-Next-Cursor header,
+        since it is known before the first row is produced.
+
+        Args:
+            rows: Iterable of serialized users, consumed lazily
+
+        Returns:
+            StreamingHttpResponse: One JSON document per line
+        """
+        response = StreamingHttpResponse(
+            (json.dumps(row, cls=JSONEncoder) + '\n' for row in rows),
+            content_type='application/x-ndjson'
+        )
+        if self.next_cursor:
+            response['X-Next-Cursor'] = self.next_cursor
+        return response
+
+    @staticmethod
+    def _position_after(ids, distances, distance, user_id):
+        """Index of the first entry ranked after (distance, user_id)."""
+        start = int(np.searchsorted(distances, distance, side='left'))
+        end = int(np.searchsorted(distances, distance, side='right'))
+        for position in range(start, end):
+            if ids[position] > user_id:
+                return position
+        return end
+
+
+class TrackCursorPagination:
+    """
+    Paginate location history points ordered by recorded_at and then id.
+    """
+
+    page_size = 500
+    max_page_size = 5000
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self):
+        self.next_cursor = None
+
+    def paginate_queryset(self, queryset, request):
+        """
+        Read the page requested by a query straight from SQL.
+
+        The cursor bound leads with recorded_at__gte, so the scan starts at
+        the cursor in the (user, recorded_at, id) index instead of at the
+        start of the range.
+
+        Args:
+            queryset: QuerySet of LocationHistory points
+            request: The request carrying the cursor and page size
+
+        Returns:
+            list: (id, latitude, longitude, recorded_at) tuples of the page
+        """
+        page_size = self.get_page_size(request)
+
+        cursor = self.decode_cursor(request)
+        if cursor:
+            recorded_at, point_id = cursor
+            queryset = queryset.filter(
+                Q(recorded_at__gt=recorded_at) | Q(id__gt=point_id), recorded_at__gte=recorded_at
+            )
+
+        rows = list(
+            queryset.order_by('recorded_at', 'id').values_list(
+                'id', 'latitude', 'longitude', 'recorded_at'
+            )[:page_size + 1]
+        )
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            self.next_cursor = self.encode_cursor(rows[-1][3], rows[-1][0])
+        else:
+            self.next_cursor = None
+
+        return rows
+
+    def get_page_size(self, request):
+        """Get the page size requested by a query, capped at the maximum."""
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+
+        return self.page_size if page_size <= 0 else min(page_size, self.max_page_size)
+
+    def encode_cursor(self, recorded_at, point_id):
+        """Encode the position of a point in a track as an opaque cursor."""
+        position = f'{recorded_at.isoformat()}|{point_id}'
+        return base64.urlsafe_b64encode(position.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, request):
+        """
+        Decode the cursor of a query.
+
+        Args:
+            request: The request carrying the cursor
+
+        Returns:
+            tuple: (recorded_at, point id), or None when no cursor was given
+
+        Raises:
+            NotFound: If the cursor is malformed
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            position = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            recorded_at, point_id = position.split('|')
+            recorded_at = parse_datetime(recorded_at)
+            if recorded_at is None:
+                raise ValueError(position)
+            return recorded_at, int(point_id)
+        except (binascii.Error, UnicodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+
+class FilteredCursorPagination:
+    """
+    Paginate the users that pass a vectorized location test, ordered by id.
+    """
+
+    page_size = 100
+    max_page_size = 1000
+    chunk_size = 5000
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self):
+        self.next_cursor = None
+
+    def paginate_filtered(self, queryset, test, request):
+        """
+        Scan candidates in id order until a page of them passes a test.
+
+        Candidates after the cursor are read chunk_size rows at a time as
+        (id, latitude, longitude), so memory stays bounded however many
+        candidates fail the test.
+
+        Args:
+            queryset: QuerySet of candidate users
+            test: Function mapping numpy arrays of latitudes and longitudes
+                to a boolean mask of the users to keep
+            request: The request carrying the cursor and page size
+
+        Returns:
+            list: Ids of the users of the page
+        """
+        page_size = self.get_page_size(request)
+        rows = queryset.order_by('id').values_list('id', 'latitude', 'longitude')
+
+        ids = []
+        after = self.decode_cursor(request)
+        while len(ids) <= page_size:
+            chunk = list((rows.filter(id__gt=after) if after else rows)[:self.chunk_size])
+            if not chunk:
+                break
+
+            chunk_ids, latitudes, longitudes = zip(*chunk)
+            keep = test(np.array(latitudes, dtype=np.float64), np.array(longitudes, dtype=np.float64))
+            ids.extend(user_id for user_id, kept in zip(chunk_ids, keep) if kept)
+            after = chunk_ids[-1]
+            if len(chunk) < self.chunk_size:
+                break
+
+        if len(ids) > page_size:
+            ids = ids[:page_size]
+            self.next_cursor = self.encode_cursor(ids[-1])
+        else:
+            self.next_cursor = None
+
+        return ids
+
+    def get_page_size(self, request):
+        """Get the page size requested by a query, capped at the maximum."""
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+
+        return self.page_size if page_size <= 0 else min(page_size, self.max_page_size)
+
+    def encode_cursor(self, user_id):
+        """Encode the last user of a page as an opaque cursor."""
+        return base64.urlsafe_b64encode(str(user_id).encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, request):
+        """
+        Decode the cursor of a query.
+
+        Args:
+            request: The request carrying the cursor
+
+        Returns:
+            uuid.UUID: Id of the last user of the previous page, or None
+            when no cursor was given
+
+        Raises:
+            NotFound: If the cursor is malformed
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            return uuid.UUID(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii'))
+        except (binascii.Error, UnicodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
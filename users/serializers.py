@@ -8,9 +8,34 @@ in REST API requests and responses.
 from rest_framework import serializers
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
+from .fields import COORDINATE_DECIMAL_PLACES
 from .models import User
 
 
+def coordinate_field(name):
+    """
+    Build the serializer field for a coordinate.
+
+    Coordinates are stored as floats but keep their fixed six-decimal API
+    representation.
+
+    Args:
+        name: Name of the coordinate field on User
+
+    Returns:
+        serializers.DecimalField: Field validated like the model field
+    """
+    model_field = User._meta.get_field(name)
+    return serializers.DecimalField(
+        max_digits=COORDINATE_DECIMAL_PLACES + 3,
+        decimal_places=COORDINATE_DECIMAL_PLACES,
+        required=False,
+        allow_null=True,
+        validators=model_field.validators,
+        label=model_field.verbose_name,
+    )
+
+
 class UserSerializer(serializers.ModelSerializer):
     """
     Serializer for User model with all fields.
@@ -21,15 +46,20 @@ class UserSerializer(serializers.ModelSerializer):
 
     age = serializers.ReadOnlyField(help_text="Calculated age based on date of birth")
     has_location = serializers.ReadOnlyField(help_text="Whether user has geographic coordinates")
+    latitude = coordinate_field('latitude')
+    longitude = coordinate_field('longitude')
 
     class Meta:
         model = User
         fields = [
             'id', 'email', 'name', 'dob', 'address', 'description',
             'latitude', 'longitude', 'created_at', 'updated_at',
-            'age', 'has_location'
+            'age', 'has_location', 'friends_count', 'followers_count', 'following_count'
+        ]
+        read_only_fields = [
+            'id', 'created_at', 'updated_at', 'age', 'has_location',
+            'friends_count', 'followers_count', 'following_count'
         ]
-        read_only_fields = ['id', 'created_at', 'updated_at', 'age', 'has_location']
         extra_kwargs = {
             'password': {'write_only': True},
             'email': {'required': True},
@@ -65,6 +95,8 @@ class UserCreateSerializer(serializers.ModelSerializer):
 
     password = serializers.CharField(write_only=True, validators=[validate_password])
     password_confirm = serializers.CharField(write_only=True)
+    latitude = coordinate_field('latitude')
+    longitude = coordinate_field('longitude')
 
     class Meta:
         model = User
@@ -117,6 +149,9 @@ class UserUpdateSerializer(serializers.ModelSerializer):
     This serializer allows partial updates and excludes sensitive fields.
     """
 
+    latitude = coordinate_field('latitude')
+    longitude = coordinate_field('longitude')
+
     class Meta:
         model = User
         fields = [
@@ -0,0 +1,79 @@
+"""
+Signal handlers for the User app.
+
+This module keeps the in-process spatial index and the nearby result cache
+in sync with User writes. Bulk updates bypass these signals; their writers
+invalidate the cache and publish the moves to the index themselves (see
+spatial.publish_moves). It also defines locations_updated, sent after a
+batch of location updates is written or a saved user's coordinates change,
+for other apps to react to users moving.
+"""
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal, receiver
+
+from . import nearby_cache, spatial
+from .models import User
+
+# Fields whose change can move a user in, out of, or around the spatial index
+LOCATION_INDEX_FIELDS = {'latitude', 'longitude', 'is_active'}
+
+# Sent with user_ids, a list of the ids of the users whose location was written
+locations_updated = Signal()
+
+
+@receiver(post_save, sender=User)
+def update_spatial_index(sender, instance, update_fields=None, **kwargs):
+    """Apply a saved user's coordinates to the spatial index."""
+    index = spatial.get_loaded_index()
+    if index is None:
+        return
+
+    if update_fields is not None and not LOCATION_INDEX_FIELDS & set(update_fields):
+        return
+
+    if instance.is_active and instance.has_location:
+        index.upsert(instance.id, *instance.get_location_tuple())
+    else:
+        index.remove(instance.id)
+
+
+@receiver(post_delete, sender=User)
+def remove_from_spatial_index(sender, instance, **kwargs):
+    """Drop a deleted user from the spatial index."""
+    index = spatial.get_loaded_index()
+    if index is not None:
+        index.remove(instance.id)
+
+
+@receiver(post_save, sender=User)
+def handle_location_change(sender, instance, created=False, **kwargs):
+    """
+    React to a saved user's location state changing.
+
+    Cached nearby results around the old and new location are invalidated,
+    and locations_updated is sent when the coordinates themselves changed,
+    as the bulk location writers do.
+    """
+    previous = instance._saved_location_state
+    current = instance.location_state()
+    instance._saved_location_state = current
+
+    if previous == current and not created:
+        return
+
+    if nearby_cache.is_enabled():
+        for latitude, longitude, _ in {current} if created else {previous, current}:
+            if latitude is not None and longitude is not None:
+                nearby_cache.invalidate_location(latitude, longitude)
+
+    moved = previous[:2] != current[:2] if not created else instance.has_location
+    if moved:
+        locations_updated.send(sender=User, user_ids=[instance.id])
+
+
+@receiver(post_delete, sender=User)
+def invalidate_nearby_cache_on_delete(sender, instance, **kwargs):
+    """Invalidate cached nearby results around a deleted user."""
+    if nearby_cache.is_enabled() and instance.has_location:
+        nearby_cache.invalidate_location(*instance.get_location_tuple())
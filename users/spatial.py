@@ -0,0 +1,903 @@
+"""
+In-process spatial index of active user locations.
+
+The index keeps the coordinates of every active, located user in flat NumPy
+arrays sorted by a lat/lon grid cell key, so radius and k-nearest queries only
+touch the cells that can contain a match instead of every user. It is built
+from a single values_list scan and kept current from the User post_save and
+post_delete signals (see users.signals).
+
+Changes received through signals are kept in a small overlay and merged into
+the sorted arrays once the overlay grows. The index also keeps user counts and
+coordinate sums per cell of a few power-of-two grids (see DensityGrid) for the
+heatmap and clustering endpoints in users.density, built on first use and
+adjusted on every change. Writes made by other processes are
+picked up by rebuilding: rebuild_spatial_index bumps a generation counter in
+the shared cache and every process rebuilds when it notices the new value.
+
+Bulk location writes, which send no signals, publish the users they moved as
+a numbered batch in the shared cache instead (see publish_moves). Every
+process applies the batches it has not seen when it checks the generation,
+and rebuilds when one has expired before it got to it.
+
+When SPATIAL_INDEX_SNAPSHOT_DIR is set, a rebuild is done once, by whoever
+requests it: the sorted arrays are saved as .npy files in a directory named
+after the new generation before the generation is published. Processes then
+map those files read-only instead of scanning the database, so every worker
+on a host shares one copy of the arrays through the page cache and a
+restarted worker can answer its first query as soon as the files are mapped.
+Each process still keeps its own overlay and density grids.
+"""
+
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from .distance import DEFAULT_DISTANCE_MODE, get_distance_backend, search_radius
+from .utils import EARTH_RADIUS_KM, bounding_box, argsort_by_distance, cache_is_shared, radius_mask
+
+logger = logging.getLogger(__name__)
+
+GENERATION_CACHE_KEY = 'users:spatial_index:generation'
+MOVES_SEQUENCE_CACHE_KEY = 'users:spatial_index:moves'
+
+# User ids are stored as raw 16-byte UUIDs
+ID_DTYPE = 'S16'
+
+# Great-circle distance to the antipode; no query ever needs to look further
+MAX_RADIUS_KM = math.pi * EARTH_RADIUS_KM
+
+# Zoom levels of the density grids; a query at any zoom up to the last one
+# reads the coarsest grid at least as fine as it
+DENSITY_ZOOMS = (4, 8, 12, 16)
+DENSITY_MAX_ZOOM = DENSITY_ZOOMS[-1]
+
+# Arrays saved in a snapshot, and the number of newest snapshots kept
+SNAPSHOT_ARRAYS = ('cells', 'ids', 'latitudes', 'longitudes', 'id_order', 'sorted_ids')
+SNAPSHOTS_KEPT = 2
+
+
+def _id_key(user_id):
+    """Convert a user id (UUID or string) to its 16-byte index key."""
+    if not isinstance(user_id, uuid.UUID):
+        user_id = uuid.UUID(str(user_id))
+    return user_id.bytes
+
+
+def _key_to_id(key):
+    """Convert a 16-byte index key back to a UUID."""
+    # NumPy strips trailing null bytes from fixed-width byte strings
+    return uuid.UUID(bytes=bytes(key).ljust(16, b'\0'))
+
+
+class DensityGrid:
+    """
+    User counts and coordinate sums per cell of one zoom level's grid.
+
+    At zoom z cells are 360 / 2**z degrees on a side, counted in rows from
+    the south pole and columns from the antimeridian, so every cell of a
+    coarser zoom is an exact block of cells of this one. Cells are kept as
+    arrays sorted by row-major key plus a dict of changes since they were
+    sorted, merged in once it grows.
+    """
+
+    def __init__(self, zoom, latitudes, longitudes):
+        self.zoom = zoom
+        self._cols = 2 ** zoom
+        self._rows = max(1, self._cols // 2)
+        self._size = 360 / self._cols
+        self._load(
+            self.keys(latitudes, longitudes),
+            np.stack([np.ones(len(latitudes)), latitudes, longitudes]),
+        )
+
+    def keys(self, latitudes, longitudes):
+        """Compute cell keys for arrays of coordinates."""
+        rows, cols = grid_cells(self.zoom, latitudes, longitudes)
+        return rows * self._cols + cols
+
+    def _load(self, keys, sums):
+        """Replace the cells with the summed (count, latitude, longitude) of keys."""
+        self._keys, self._sums = _sum_by_key(keys, sums)
+        self._changes = {}
+        self._change_arrays = None
+
+    def add(self, latitude, longitude, sign):
+        """Add (sign 1) or take away (sign -1) one user at a location."""
+        key = int(self.keys(np.array([latitude]), np.array([longitude]))[0])
+        change = self._changes.setdefault(key, [0.0, 0.0, 0.0])
+        change[0] += sign
+        change[1] += sign * latitude
+        change[2] += sign * longitude
+        self._change_arrays = None
+        if len(self._changes) > max(1_000, len(self._keys) // 20):
+            self._load(*self._with_changes(self._keys, self._sums))
+
+    def _with_changes(self, keys, sums):
+        """Append the pending changes to arrays of keys and sums."""
+        if not self._changes:
+            return keys, sums
+        if self._change_arrays is None:
+            self._change_arrays = (
+                np.fromiter(self._changes, dtype=np.int64),
+                np.array(list(self._changes.values())).T,
+            )
+        change_keys, change_sums = self._change_arrays
+        return np.concatenate([keys, change_keys]), np.concatenate([sums, change_sums], axis=1)
+
+    def query(self, zoom, first_row, last_row, col_ranges):
+        """
+        Sum the cells of a coarser or equal zoom level over a block of its cells.
+
+        Returns:
+            tuple: (rows, cols, counts, latitude sums, longitude sums) numpy
+            arrays of the non-empty cells, ordered by row and then column
+        """
+        shift = self.zoom - zoom
+        # Keys are row-major, so the rows of the block are one slice
+        start, end = np.searchsorted(
+            self._keys, [(first_row << shift) * self._cols, ((last_row + 1) << shift) * self._cols]
+        )
+        keys, sums = self._with_changes(self._keys[start:end], self._sums[:, start:end])
+
+        rows = (keys // self._cols) >> shift
+        cols = (keys % self._cols) >> shift
+        mask = (rows >= first_row) & (rows <= last_row)
+        mask &= np.logical_or.reduce([(cols >= first) & (cols <= last) for first, last in col_ranges])
+
+        cols_at_zoom = self._cols >> shift
+        cells, sums = _sum_by_key(rows[mask] * cols_at_zoom + cols[mask], sums[:, mask])
+        return (
+            cells // cols_at_zoom, cells % cols_at_zoom,
+            np.rint(sums[0]).astype(np.int64), sums[1], sums[2],
+        )
+
+
+def grid_cells(zoom, latitudes, longitudes):
+    """
+    Find the grid cells of arrays of coordinates at a zoom level.
+
+    Returns:
+        tuple: (rows, cols) numpy arrays
+    """
+    col_count = 2 ** zoom
+    size = 360 / col_count
+    rows = np.clip(((latitudes + 90) // size).astype(np.int64), 0, max(1, col_count // 2) - 1)
+    cols = np.clip(((longitudes + 180) // size).astype(np.int64), 0, col_count - 1)
+    return rows, cols
+
+
+def first_per_cell(rows, cols, count):
+    """
+    Pick the first few points of every cell.
+
+    Args:
+        rows: Numpy array of point rows
+        cols: Numpy array of point columns
+        count: Most points picked per cell
+
+    Returns:
+        numpy.ndarray: Positions of the picked points, in their original order
+    """
+    # lexsort is stable, so points keep their order within a cell
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    first = np.flatnonzero(starts)
+    rank = np.arange(len(order)) - first[np.cumsum(starts) - 1]
+    return np.sort(order[rank < count])
+
+
+def _sum_by_key(keys, sums):
+    """Sum columns of a (count, ...) array by key, dropping keys left empty."""
+    keys, inverse = np.unique(keys, return_inverse=True)
+    sums = np.stack([np.bincount(inverse, weights=row, minlength=len(keys)) for row in sums])
+    # Changes can cancel out; counts are whole numbers held as floats
+    occupied = sums[0] > 0.5
+    return keys[occupied], sums[:, occupied]
+
+
+class SpatialIndex:
+    """
+    Grid-bucketed index of user coordinates.
+
+    Points are bucketed into cells of cell_size degrees and stored sorted by
+    cell key, so the points of any run of cells in a grid row form one
+    contiguous slice that is found with a binary search.
+    """
+
+    def __init__(self, ids, latitudes, longitudes, cell_size=0.1, generation=None):
+        self.cell_size = float(cell_size)
+        self.generation = generation
+        self.built_at = time.time()
+        self.changes_since_build = 0
+        # Sequence number of the last published batch of moves applied
+        self.moves_applied = 0
+
+        self._rows = int(math.ceil(180 / self.cell_size))
+        self._cols = int(math.ceil(360 / self.cell_size))
+        self._lock = threading.RLock()
+        # Density grids by zoom, built on first use
+        self._density = None
+
+        self._load(
+            np.asarray(ids, dtype=ID_DTYPE),
+            np.asarray(latitudes, dtype=np.float64),
+            np.asarray(longitudes, dtype=np.float64),
+        )
+
+    @classmethod
+    def build(cls, cell_size=None, generation=None):
+        """
+        Build an index from the database with a single values_list scan.
+
+        Args:
+            cell_size: Grid cell size in degrees (defaults to the setting)
+            generation: Generation counter the index corresponds to
+
+        Returns:
+            SpatialIndex: The freshly built index
+        """
+        from .models import User
+
+        start = time.perf_counter()
+        # Moves published from here on may be missing from the scan
+        moves_applied = cache.get(MOVES_SEQUENCE_CACHE_KEY, 0)
+        ids, latitudes, longitudes = [], [], []
+        rows = User.objects.with_location().filter(is_active=True).values_list(
+            'id', 'latitude', 'longitude'
+        )
+        for user_id, latitude, longitude in rows.iterator(chunk_size=10_000):
+            ids.append(user_id.bytes)
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+
+        index = cls(
+            ids, latitudes, longitudes,
+            cell_size=cell_size or settings.SPATIAL_INDEX_CELL_SIZE,
+            generation=generation,
+        )
+        index.moves_applied = moves_applied
+        logger.info(
+            f"Built spatial index of {len(index)} users in "
+            f"{time.perf_counter() - start:.3f}s (generation {generation})"
+        )
+        return index
+
+    def __len__(self):
+        """Number of users in the index."""
+        with self._lock:
+            removed = self._overlay_arrays()[0]
+            hidden = int(np.isin(self._ids, removed).sum()) if len(removed) else 0
+            return len(self._ids) - hidden + len(self._updates)
+
+    @classmethod
+    def open_snapshot(cls, path, generation=None):
+        """
+        Open an index over the arrays of a snapshot, mapped read-only.
+
+        Args:
+            path: Snapshot directory written by save_snapshot
+            generation: Generation counter the snapshot corresponds to
+
+        Returns:
+            SpatialIndex: Index sharing the snapshot's pages with every
+            other process that maps it
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+
+        index = cls([], [], [], cell_size=meta['cell_size'], generation=generation)
+        index.built_at = meta['built_at']
+        index.moves_applied = meta.get('moves_applied', 0)
+        index._set_arrays(*(
+            np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in SNAPSHOT_ARRAYS
+        ))
+        return index
+
+    def save_snapshot(self, path):
+        """
+        Save the sorted arrays, with the overlay merged in, to a new directory.
+
+        Args:
+            path: Directory to create
+        """
+        with self._lock:
+            self.compact()
+            os.makedirs(path)
+            for name in SNAPSHOT_ARRAYS:
+                np.save(os.path.join(path, f'{name}.npy'), getattr(self, f'_{name}'))
+            with open(os.path.join(path, 'meta.json'), 'w') as f:
+                json.dump({
+                    'cell_size': self.cell_size,
+                    'built_at': self.built_at,
+                    'moves_applied': self.moves_applied,
+                }, f)
+
+    def _load(self, ids, latitudes, longitudes):
+        """Replace the sorted arrays and clear the overlay."""
+        cells = self._cell_keys(latitudes, longitudes)
+        order = np.argsort(cells, kind='stable')
+        ids = ids[order]
+        # Secondary ordering by id for lookups of specific users
+        id_order = np.argsort(ids, kind='stable')
+
+        self._set_arrays(cells[order], ids, latitudes[order], longitudes[order], id_order, ids[id_order])
+
+    def _set_arrays(self, cells, ids, latitudes, longitudes, id_order, sorted_ids):
+        """Replace the sorted arrays with arrays already in index order and clear the overlay."""
+        self._cells = cells
+        self._ids = ids
+        self._latitudes = latitudes
+        self._longitudes = longitudes
+        self._id_order = id_order
+        self._sorted_ids = sorted_ids
+
+        # Overlay of changes received since the arrays were sorted
+        self._updates = {}
+        self._removed = set()
+        self._overlay = None
+
+    def _cell_keys(self, latitudes, longitudes):
+        """Compute grid cell keys for arrays of coordinates."""
+        rows = np.clip(((latitudes + 90) // self.cell_size).astype(np.int64), 0, self._rows - 1)
+        cols = np.clip(((longitudes + 180) // self.cell_size).astype(np.int64), 0, self._cols - 1)
+        return rows * self._cols + cols
+
+    def _row(self, latitude):
+        return min(max(int((latitude + 90) // self.cell_size), 0), self._rows - 1)
+
+    def _col(self, longitude):
+        return min(max(int((longitude + 180) // self.cell_size), 0), self._cols - 1)
+
+    def _overlay_arrays(self):
+        """Return the overlay as (removed keys, ids, latitudes, longitudes) arrays."""
+        if self._overlay is None:
+            keys = list(self._updates)
+            coordinates = np.array([self._updates[key] for key in keys], dtype=np.float64).reshape(-1, 2)
+            self._overlay = (
+                np.array(list(self._removed), dtype=ID_DTYPE),
+                np.array(keys, dtype=ID_DTYPE),
+                coordinates[:, 0],
+                coordinates[:, 1],
+            )
+        return self._overlay
+
+    def _candidate_positions(self, latitude, longitude, radius_km):
+        """Positions in the sorted arrays of points inside the bounding box."""
+        return self._box_positions(*bounding_box(latitude, longitude, radius_km))
+
+    def _box_positions(self, min_lat, max_lat, lon_ranges):
+        """Positions in the sorted arrays of points in the grid cells a box touches."""
+        first_row, last_row = self._row(min_lat), self._row(max_lat)
+
+        if lon_ranges == [(-180.0, 180.0)]:
+            # Full rows are adjacent in key order, so one slice covers them
+            lows = np.array([first_row * self._cols])
+            highs = np.array([last_row * self._cols + self._cols - 1])
+        else:
+            row_starts = np.arange(first_row, last_row + 1, dtype=np.int64) * self._cols
+            lows = np.concatenate([row_starts + self._col(min_lon) for min_lon, _ in lon_ranges])
+            highs = np.concatenate([row_starts + self._col(max_lon) for _, max_lon in lon_ranges])
+
+        starts = np.searchsorted(self._cells, lows, side='left')
+        ends = np.searchsorted(self._cells, highs, side='right')
+        slices = [np.arange(start, end) for start, end in zip(starts, ends) if end > start]
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+
+    def _within(self, latitude, longitude, radius_km, exclude=None,
+                distance_mode=DEFAULT_DISTANCE_MODE):
+        """Unordered (keys, distances) of every point within the radius in a distance mode."""
+        positions = self._candidate_positions(
+            latitude, longitude, search_radius(radius_km, distance_mode)
+        )
+        removed, overlay_ids, overlay_lats, overlay_lons = self._overlay_arrays()
+
+        ids = self._ids[positions]
+        latitudes = self._latitudes[positions]
+        longitudes = self._longitudes[positions]
+        if len(removed):
+            keep = ~np.isin(ids, removed)
+            ids, latitudes, longitudes = ids[keep], latitudes[keep], longitudes[keep]
+
+        if len(overlay_ids):
+            ids = np.concatenate([ids, overlay_ids])
+            latitudes = np.concatenate([latitudes, overlay_lats])
+            longitudes = np.concatenate([longitudes, overlay_lons])
+
+        distances = get_distance_backend(distance_mode)(latitude, longitude, latitudes, longitudes)
+        # A search reaching the antipode keeps everyone, however far a mode measures them
+        mask = radius_mask(distances, None if radius_km >= MAX_RADIUS_KM else radius_km)
+        if exclude is not None:
+            mask &= ids != _id_key(exclude)
+        return ids[mask], distances[mask]
+
+    def query_radius(self, latitude, longitude, radius_km, exclude=None,
+                     distance_mode=DEFAULT_DISTANCE_MODE):
+        """
+        Find every user within a radius of a point.
+
+        Args:
+            latitude: Latitude of the center point
+            longitude: Longitude of the center point
+            radius_km: Search radius in kilometers
+            exclude: Optional user id to leave out of the results
+            distance_mode: Distance mode (see users.distance) the radius and
+                the ranking are measured in
+
+        Returns:
+            tuple: (list of user ids, numpy array of distances in km), ordered
+            by distance and then id
+        """
+        with self._lock:
+            ids, distances = self._within(latitude, longitude, radius_km, exclude, distance_mode)
+
+        order = argsort_by_distance(distances, tiebreak=ids)
+        return [_key_to_id(key) for key in ids[order]], distances[order]
+
+    def query_knn(self, latitude, longitude, k, exclude=None, distance_mode=DEFAULT_DISTANCE_MODE):
+        """
+        Find the k users closest to a point.
+
+        The search radius starts at one grid cell and doubles until at least
+        k users fall inside it; only those candidates are ranked.
+
+        Args:
+            latitude: Latitude of the center point
+            longitude: Longitude of the center point
+            k: Number of users to return
+            exclude: Optional user id to leave out of the results
+            distance_mode: Distance mode (see users.distance) to rank by
+
+        Returns:
+            tuple: (list of user ids, numpy array of distances in km), closest first
+        """
+        radius_km = self.cell_size * math.pi / 180 * EARTH_RADIUS_KM
+
+        with self._lock:
+            while True:
+                ids, distances = self._within(latitude, longitude, radius_km, exclude, distance_mode)
+                if len(ids) >= k or radius_km >= MAX_RADIUS_KM:
+                    break
+                radius_km = min(radius_km * 2, MAX_RADIUS_KM)
+
+        if len(ids) > k:
+            top = np.argpartition(distances, k - 1)[:k]
+            ids, distances = ids[top], distances[top]
+
+        order = argsort_by_distance(distances)
+        return [_key_to_id(key) for key in ids[order]], distances[order]
+
+    def distances_to(self, latitude, longitude, user_ids, distance_mode=DEFAULT_DISTANCE_MODE):
+        """
+        Compute distances from a point to specific users.
+
+        Users that are not in the index (inactive or without a location) are
+        left out of the result.
+
+        Args:
+            latitude: Latitude of the origin
+            longitude: Longitude of the origin
+            user_ids: Iterable of user ids
+            distance_mode: Distance mode (see users.distance) to measure in
+
+        Returns:
+            tuple: (list of user ids, numpy array of distances in km), unordered
+        """
+        keys = np.array([_id_key(user_id) for user_id in user_ids], dtype=ID_DTYPE)
+
+        with self._lock:
+            removed, overlay_ids, overlay_lats, overlay_lons = self._overlay_arrays()
+
+            positions = np.searchsorted(self._sorted_ids, keys)
+            found = positions < len(self._sorted_ids)
+            found[found] = self._sorted_ids[positions[found]] == keys[found]
+            if len(removed):
+                found &= ~np.isin(keys, removed)
+            positions = self._id_order[positions[found]]
+
+            in_overlay = np.isin(overlay_ids, keys)
+
+            ids = np.concatenate([self._ids[positions], overlay_ids[in_overlay]])
+            latitudes = np.concatenate([self._latitudes[positions], overlay_lats[in_overlay]])
+            longitudes = np.concatenate([self._longitudes[positions], overlay_lons[in_overlay]])
+
+        distances = get_distance_backend(distance_mode)(latitude, longitude, latitudes, longitudes)
+        return [_key_to_id(key) for key in ids], distances
+
+    def density(self, zoom, first_row, last_row, col_ranges):
+        """
+        Count users per cell of a zoom level's grid over a block of cells.
+
+        Counts and centroids are summed from the coarsest density grid at
+        least as fine as the zoom, so no point is visited.
+
+        Args:
+            zoom: Zoom level, at most DENSITY_MAX_ZOOM; cells are
+                360 / 2**zoom degrees on a side
+            first_row: First grid row, counted from the south pole
+            last_row: Last grid row (inclusive)
+            col_ranges: List of (first, last) grid column ranges, counted east
+                from the antimeridian
+
+        Returns:
+            tuple: (rows, cols, counts, latitudes, longitudes) numpy arrays
+            of the non-empty cells and the centroids of their users, ordered
+            by row and then column
+        """
+        grid_zoom = next(level for level in DENSITY_ZOOMS if level >= zoom)
+        with self._lock:
+            rows, cols, counts, latitude_sums, longitude_sums = self._density_grids()[grid_zoom].query(
+                zoom, first_row, last_row, col_ranges
+            )
+        return rows, cols, counts, latitude_sums / counts, longitude_sums / counts
+
+    def sample_cells(self, zoom, min_lat, max_lat, lon_ranges, per_cell, limit):
+        """
+        Sample a few users per grid cell inside a lat/lon box.
+
+        Only up to about limit users, spread evenly over the box, are looked
+        at, so cells in dense boxes may get no sample.
+
+        Args:
+            zoom: Zoom level of the grid
+            min_lat: Southern edge of the box
+            max_lat: Northern edge of the box
+            lon_ranges: List of (min_lon, max_lon) ranges
+            per_cell: Most users sampled per cell
+            limit: Most users looked at
+
+        Returns:
+            tuple: (rows, cols, user ids) lists of the sampled users
+        """
+        with self._lock:
+            positions = self._box_positions(min_lat, max_lat, lon_ranges)
+            removed, overlay_ids, overlay_lats, overlay_lons = self._overlay_arrays()
+            # Stride before filtering so the work is bounded by the limit
+            step = max(1, -(-(len(positions) + len(overlay_ids)) // limit))
+            positions = positions[::step]
+            if len(removed):
+                positions = positions[~np.isin(self._ids[positions], removed)]
+
+            ids = np.concatenate([self._ids[positions], overlay_ids[::step]])
+            latitudes = np.concatenate([self._latitudes[positions], overlay_lats[::step]])
+            longitudes = np.concatenate([self._longitudes[positions], overlay_lons[::step]])
+
+        # Cells at the box edges hold points outside it
+        mask = (latitudes >= min_lat) & (latitudes <= max_lat)
+        mask &= np.logical_or.reduce([
+            (longitudes >= min_lon) & (longitudes <= max_lon) for min_lon, max_lon in lon_ranges
+        ])
+        rows, cols = grid_cells(zoom, latitudes[mask], longitudes[mask])
+        chosen = first_per_cell(rows, cols, per_cell)
+        return rows[chosen].tolist(), cols[chosen].tolist(), [_key_to_id(key) for key in ids[mask][chosen]]
+
+    def _density_grids(self):
+        """Return the density grids, counting every indexed user on first use."""
+        if self._density is None:
+            removed, overlay_ids, overlay_lats, overlay_lons = self._overlay_arrays()
+            keep = ~np.isin(self._ids, removed) if len(removed) else slice(None)
+            latitudes = np.concatenate([self._latitudes[keep], overlay_lats])
+            longitudes = np.concatenate([self._longitudes[keep], overlay_lons])
+            self._density = {
+                zoom: DensityGrid(zoom, latitudes, longitudes) for zoom in DENSITY_ZOOMS
+            }
+        return self._density
+
+    def _location_of(self, key):
+        """Current (latitude, longitude) of an indexed user, or None."""
+        if key in self._updates:
+            return self._updates[key]
+        if key in self._removed:
+            return None
+
+        position = np.searchsorted(self._sorted_ids, key)
+        # Elements read back from the array have their trailing null bytes stripped
+        if position < len(self._sorted_ids) and self._sorted_ids[position] == key.rstrip(b'\0'):
+            position = self._id_order[position]
+            return float(self._latitudes[position]), float(self._longitudes[position])
+        return None
+
+    def _move_density(self, key, location):
+        """Move a user in the density grids to a new location, or drop them."""
+        if self._density is None:
+            return
+
+        previous = self._location_of(key)
+        for grid in self._density.values():
+            if previous is not None:
+                grid.add(*previous, -1)
+            if location is not None:
+                grid.add(*location, 1)
+
+    def upsert(self, user_id, latitude, longitude):
+        """Add a user to the index or move them to new coordinates."""
+        key = _id_key(user_id)
+        with self._lock:
+            self._move_density(key, (float(latitude), float(longitude)))
+            self._removed.add(key)
+            self._updates[key] = (float(latitude), float(longitude))
+            self._changed()
+
+    def remove(self, user_id):
+        """Remove a user from the index."""
+        key = _id_key(user_id)
+        with self._lock:
+            self._move_density(key, None)
+            self._removed.add(key)
+            self._updates.pop(key, None)
+            self._changed()
+
+    def _changed(self):
+        """Record a change and merge the overlay once it grows too large."""
+        self._overlay = None
+        self.changes_since_build += 1
+        if len(self._removed) > max(1_000, len(self._ids) // 20):
+            self.compact()
+
+    def compact(self):
+        """Merge the overlay into the sorted arrays without touching the database."""
+        with self._lock:
+            removed, overlay_ids, overlay_lats, overlay_lons = self._overlay_arrays()
+            keep = ~np.isin(self._ids, removed) if len(removed) else slice(None)
+            self._load(
+                np.concatenate([self._ids[keep], overlay_ids]),
+                np.concatenate([self._latitudes[keep], overlay_lats]),
+                np.concatenate([self._longitudes[keep], overlay_lons]),
+            )
+
+    def stats(self):
+        """
+        Describe the size and staleness of the index.
+
+        The index can only miss writes made by other processes, so staleness
+        is measured as the age of the last database scan and whether a newer
+        generation has been requested.
+
+        Returns:
+            dict: Index statistics
+        """
+        latest_generation = cache.get(GENERATION_CACHE_KEY, 0)
+        age = time.time() - self.built_at
+        with self._lock:
+            pending_changes = len(self._removed) + len(self._updates)
+
+        return {
+            'size': len(self),
+            'cell_size_deg': self.cell_size,
+            'built_at': self.built_at,
+            'age_seconds': round(age, 3),
+            'changes_since_build': self.changes_since_build,
+            'pending_changes': pending_changes,
+            'generation': self.generation,
+            'latest_generation': latest_generation,
+            'stale': self.generation != latest_generation or age > settings.SPATIAL_INDEX_MAX_AGE,
+        }
+
+
+_index = None
+_index_lock = threading.Lock()
+_last_generation_check = 0.0
+
+
+def is_enabled():
+    """
+    Whether the nearby endpoints should use the in-process index.
+
+    Generations and published moves reach other processes through the
+    cache, so with a process-local cache the database is queried instead.
+    """
+    return settings.SPATIAL_INDEX_ENABLED and cache_is_shared()
+
+
+def snapshots_enabled():
+    """Whether rebuilds are shared between processes through snapshot files."""
+    return bool(settings.SPATIAL_INDEX_SNAPSHOT_DIR)
+
+
+def get_index():
+    """
+    Return the process-wide index, building or rebuilding it when needed.
+
+    The shared generation counter is checked at most once every
+    SPATIAL_INDEX_CHECK_INTERVAL seconds.
+    """
+    global _index, _last_generation_check
+
+    now = time.monotonic()
+    if _index is not None and now - _last_generation_check < settings.SPATIAL_INDEX_CHECK_INTERVAL:
+        return _index
+
+    with _index_lock:
+        latest_generation = cache.get(GENERATION_CACHE_KEY, 0)
+        _last_generation_check = now
+        if _index is None or _index.generation != latest_generation:
+            _index = _open_snapshot(latest_generation) or SpatialIndex.build(
+                generation=latest_generation
+            )
+        if not _apply_moves(_index):
+            _index = SpatialIndex.build(generation=latest_generation)
+            _apply_moves(_index)
+    return _index
+
+
+def publish_moves(moves):
+    """
+    Publish users moved by a write that sent no post_save to every process.
+
+    The moves are stored as the next numbered batch for SPATIAL_INDEX_MAX_AGE
+    seconds. The index of this process, if loaded, applies them at once;
+    other processes apply them on their next generation check.
+
+    Args:
+        moves: List of (user_id, latitude, longitude) of active users, with
+            None coordinates for users to drop from the index
+    """
+    if not moves:
+        return
+
+    moves = [
+        (str(user_id), None if latitude is None else float(latitude),
+         None if longitude is None else float(longitude))
+        for user_id, latitude, longitude in moves
+    ]
+    try:
+        sequence = cache.incr(MOVES_SEQUENCE_CACHE_KEY)
+    except ValueError:
+        cache.add(MOVES_SEQUENCE_CACHE_KEY, 0, timeout=None)
+        sequence = cache.incr(MOVES_SEQUENCE_CACHE_KEY)
+    cache.set(_moves_key(sequence), moves, timeout=settings.SPATIAL_INDEX_MAX_AGE)
+
+    with _index_lock:
+        if _index is not None:
+            _apply_moves(_index)
+
+
+def _moves_key(sequence):
+    return f'{MOVES_SEQUENCE_CACHE_KEY}:{sequence}'
+
+
+def _apply_moves(index):
+    """
+    Apply the published batches of moves an index has not seen yet, in order.
+
+    A missing batch is skipped over only while it is the newest, as its
+    writer may not have stored it yet.
+
+    Returns:
+        bool: False when a batch has expired or the sequence was reset, so
+        the index can no longer be brought up to date
+    """
+    latest = cache.get(MOVES_SEQUENCE_CACHE_KEY, 0)
+    if latest < index.moves_applied:
+        return False
+    if latest == index.moves_applied:
+        return True
+
+    sequences = range(index.moves_applied + 1, latest + 1)
+    batches = cache.get_many([_moves_key(sequence) for sequence in sequences])
+    for sequence in sequences:
+        moves = batches.get(_moves_key(sequence))
+        if moves is None:
+            return sequence == latest
+        for user_id, latitude, longitude in moves:
+            if latitude is None or longitude is None:
+                index.remove(user_id)
+            else:
+                index.upsert(user_id, latitude, longitude)
+        index.moves_applied = sequence
+    return True
+
+
+def get_loaded_index():
+    """Return the process-wide index if it has been built, without building it."""
+    return _index
+
+
+def request_rebuild():
+    """
+    Ask every process to rebuild its index from the database.
+
+    With snapshots enabled the index is built here, once, and published for
+    every process to map.
+
+    Returns:
+        int: The new generation number
+    """
+    if snapshots_enabled():
+        return publish_snapshot(SpatialIndex.build())
+    return _next_generation()
+
+
+def publish_snapshot(index):
+    """
+    Save an index as the snapshot of a new generation and publish it.
+
+    The snapshot directory is named after the generation it is expected to
+    get before the counter is bumped, so no process sees the new generation
+    before its files exist; if another publisher took that number, the
+    directory is renamed to the number actually assigned.
+
+    Args:
+        index: SpatialIndex built from the database
+
+    Returns:
+        int: The new generation number
+    """
+    directory = settings.SPATIAL_INDEX_SNAPSHOT_DIR
+    os.makedirs(directory, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix='.publishing-', dir=directory)
+    index.save_snapshot(os.path.join(staging, 'snapshot'))
+
+    expected = cache.get(GENERATION_CACHE_KEY, 0) + 1
+    path = _snapshot_path(expected)
+    # A directory left by a counter that was since reset holds stale data
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(os.path.join(staging, 'snapshot'), path)
+    os.rmdir(staging)
+
+    generation = _next_generation()
+    if generation != expected:
+        shutil.rmtree(_snapshot_path(generation), ignore_errors=True)
+        os.rename(path, _snapshot_path(generation))
+    index.generation = generation
+
+    _prune_snapshots(directory)
+    logger.info(f"Published spatial index snapshot of {len(index)} users (generation {generation})")
+    return generation
+
+
+def _open_snapshot(generation):
+    """Open the snapshot of a generation, or return None when there is none to use."""
+    if not snapshots_enabled():
+        return None
+
+    try:
+        index = SpatialIndex.open_snapshot(_snapshot_path(generation), generation=generation)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"No usable spatial index snapshot for generation {generation}: {e}")
+        return None
+
+    if index.cell_size != settings.SPATIAL_INDEX_CELL_SIZE:
+        return None
+    logger.info(f"Mapped spatial index snapshot of {len(index)} users (generation {generation})")
+    return index
+
+
+def _snapshot_path(generation):
+    return os.path.join(settings.SPATIAL_INDEX_SNAPSHOT_DIR, f'generation-{generation}')
+
+
+def _prune_snapshots(directory):
+    """
+    Delete all but the newest SNAPSHOTS_KEPT snapshots.
+
+    Processes that still map a deleted snapshot keep reading it; the files
+    are only freed once the last mapping goes away.
+    """
+    generations = sorted(
+        int(name.split('-', 1)[1]) for name in os.listdir(directory)
+        if name.startswith('generation-') and name.split('-', 1)[1].isdigit()
+    )
+    for generation in generations[:-SNAPSHOTS_KEPT]:
+        shutil.rmtree(os.path.join(directory, f'generation-{generation}'), ignore_errors=True)
+
+
+def _next_generation():
+    """Bump the shared generation counter."""
+    try:
+        return cache.incr(GENERATION_CACHE_KEY)
+    except ValueError:
+        cache.add(GENERATION_CACHE_KEY, 0, timeout=None)
+        return cache.incr(GENERATION_CACHE_KEY)
@@ -9,6 +9,7 @@ from celery import shared_task
 from django.utils import timezone
 from datetime import timedelta
 
+from . import history, location_updates, spatial
 from .models import User
 
 logger = logging.getLogger(__name__)
@@ -30,6 +31,10 @@ def cleanup_inactive_users():
     count = inactive_users.count()
     inactive_users.update(is_active=False)
 
+    # Queryset updates bypass the signals that keep the spatial index current
+    if count:
+        spatial.request_rebuild()
+
     logger.info(f"Deactivated {count} inactive users")
     return count
 
@@ -81,51 +86,111 @@ def update_user_statistics():
     }
 
 
+@shared_task
+def refresh_spatial_index():
+    """
+    Ask every process to rebuild its spatial index of user locations.
+
+    This bounds how long writes made by other processes can be missing
+    from an index.
+    """
+    generation = spatial.request_rebuild()
+    logger.info(f"Requested spatial index generation {generation}")
+    return generation
+
+
 @shared_task
 def process_user_location_update(user_id, latitude, longitude):
     """
     Process user location updates in the background.
 
+    The update is buffered and written by the next flush_location_updates
+    run, together with every other update of its window, or written at once
+    when the cache is process-local; callers that can reach the cache
+    directly should use buffer_location_update instead of queueing this task.
+
     Args:
         user_id: ID of the user
         latitude: New latitude
         longitude: New longitude
+
+    Returns:
+        bool: True if the update was buffered or written, False if it was invalid
     """
-    try:
-        user = User.objects.get(id=user_id)
-        user.latitude = latitude
-        user.longitude = longitude
-        user.save()
+    return location_updates.buffer_location_update(user_id, latitude, longitude)
 
-        logger.info(f"Updated location for user {user.email}: "
-                   f"({latitude}, {longitude})")
-        return True
-    except User.DoesNotExist:
-        logger.error(f"User with ID {user_id} not found")
-        return False
+
+@shared_task
+def flush_location_updates():
+    """
+    Write the buffered location updates of every closed window.
+
+    Each user's latest position is written once per window, with one
+    bulk_update for all users.
+    """
+    return location_updates.flush_location_updates()
 
 
 @shared_task
-def notify_nearby_friends(user_id, radius=10):
+def compact_location_history():
+    """
+    Downsample old location history and delete expired points.
+
+    Returns:
+        dict: Numbers of points removed by downsampling and by expiry
+    """
+    return history.compact_location_history()
+
+
+@shared_task
+def notify_nearby_friends(user_id, radius=None):
     """
     Notify friends when a user updates their location.
 
+    Works out which accepted friends came within PROXIMITY_ALERT_RADIUS_KM
+    of the user or moved away from it since the last evaluation, and sends
+    friend_proximity_changed for those transitions only. The radius cannot
+    be chosen per call, as the stored pair state is only valid for one.
+
     Args:
         user_id: ID of the user who updated their location
-        radius: Radius in kilometers to check for nearby friends
+        radius: Ignored; only accepted so tasks queued before it was dropped
+            still run, and to be removed in the next release
+
+    Returns:
+        dict: Numbers of pairs that entered and left, or False if the user
+        was not found or has no location
     """
     try:
         user = User.objects.get(id=user_id)
+    except User.DoesNotExist:
+        logger.error(f"User with ID {user_id} not found")
+        return False
 
-        if not user.has_location:
-            logger.warning(f"User {user.email} has no location data")
-            return False
+    if not user.has_location:
+        logger.warning(f"User {user.email} has no location data")
+        return False
 
-        # Here you would implement the logic to notify nearby friends
-        # This could involve sending push notifications, emails, etc.
+    from friendships.proximity import evaluate_proximity
 
-        logger.info(f"Notified nearby friends for user {user.email}")
-        return True
-    except User.DoesNotExist:
-        logger.error(f"User with ID {user_id} not found")
-        return False
\ No newline at end of file
+    result = evaluate_proximity([user.id])
+    logger.info(f"Notified nearby friends for user {user.email}")
+    return result
+
+
+@shared_task
+def evaluate_friend_proximity(user_ids):
+    """
+    Update friend proximity state for users who moved.
+
+    Queued after every batch of location updates is written.
+
+    Args:
+        user_ids: IDs of the users whose location changed
+
+    Returns:
+        dict: Numbers of users evaluated and of pairs that entered and left
+    """
+    from friendships.proximity import evaluate_proximity
+
+    return evaluate_proximity(user_ids)
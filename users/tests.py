@@ -6,20 +6,46 @@ and API endpoints.
 """
 
 import json
+import os
+import shutil
+import tempfile
+import uuid
+from unittest import mock
 from datetime import date, timedelta
 from decimal import Decimal
-from django.test import TestCase
+
+import numpy as np
+from geopy.distance import geodesic
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 
-from .models import User
+from . import geofence, history, location_updates, nearby, nearby_cache, spatial, utils
+from .distance import DISTANCE_BACKENDS, equirectangular_distances, get_distance_backend
+from .geohash import encode as encode_geohash, covering_cells
+from .models import LocationHistory
 from .serializers import UserSerializer, UserCreateSerializer, UserUpdateSerializer
+from .tasks import process_user_location_update
+from .utils import (
+    bounding_box, calculate_distance, haversine_distances, radius_mask, argsort_by_distance,
+    chord_distances
+)
 
 User = get_user_model()
 
+# A cache every process on the host shares, as buffering and the spatial index require
+SHARED_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'users-tests-shared-cache'),
+    }
+}
+
 
 class UserModelTest(TestCase):
     """Test cases for the User model."""
@@ -113,6 +139,22 @@ class UserModelTest(TestCase):
         location = user.get_location_tuple()
         self.assertEqual(location, (40.7128, -74.0060))
 
+    def test_coordinates_stored_as_floats(self):
+        """Test that coordinates are converted to floats on assignment."""
+        user = User.objects.create_user(
+            self.user_data['email'],
+            name=self.user_data['name'],
+            password=self.user_data['password'],
+            latitude='40.71280049',
+            longitude=self.user_data['longitude'],
+        )
+        self.assertIs(type(user.latitude), float)
+        self.assertEqual(user.get_location_tuple(), (40.7128, -74.006))
+
+        user.refresh_from_db()
+        self.assertEqual(user.get_location_tuple(), (40.7128, -74.006))
+        self.assertEqual(UserSerializer(user).data['latitude'], '40.712800')
+
     def test_invalid_coordinates(self):
         """Test coordinate validation."""
         with self.assertRaises(Exception):
@@ -388,3 +430,1158 @@ class UserPermissionsTest(APITestCase):
         url = reverse('user-detail', args=[self.user2.id])
         response = self.client.delete(url)
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class BoundingBoxTest(TestCase):
+    """Test cases for the bounding-box prefilter."""
+
+    def test_bounding_box_regular(self):
+        """Test box around a mid-latitude point."""
+        min_lat, max_lat, lon_ranges = bounding_box(40.7128, -74.0060, 10)
+        self.assertAlmostEqual(max_lat - 40.7128, 0.0899, places=3)
+        self.assertAlmostEqual(40.7128 - min_lat, 0.0899, places=3)
+        self.assertEqual(len(lon_ranges), 1)
+        min_lon, max_lon = lon_ranges[0]
+        # Longitude degrees are shorter away from the equator
+        self.assertGreater(max_lon - min_lon, max_lat - min_lat)
+
+    def test_bounding_box_antimeridian(self):
+        """Test that a box crossing the antimeridian is split in two."""
+        _, _, lon_ranges = bounding_box(0, 179.95, 20)
+        self.assertEqual(len(lon_ranges), 2)
+        self.assertEqual(lon_ranges[0][1], 180.0)
+        self.assertEqual(lon_ranges[1][0], -180.0)
+        self.assertLess(lon_ranges[1][1], -179.8)
+
+    def test_bounding_box_pole(self):
+        """Test that a box containing a pole covers every longitude."""
+        min_lat, max_lat, lon_ranges = bounding_box(89.95, 10, 20)
+        self.assertEqual(max_lat, 90.0)
+        self.assertEqual(lon_ranges, [(-180.0, 180.0)])
+
+    def test_within_bounding_box_queryset(self):
+        """Test the queryset prefilter across the antimeridian."""
+        east = User.objects.create_user(
+            'east@example.com', name='East', password='pass123',
+            latitude=Decimal('0.0'), longitude=Decimal('179.99'),
+        )
+        west = User.objects.create_user(
+            'west@example.com', name='West', password='pass123',
+            latitude=Decimal('0.0'), longitude=Decimal('-179.99'),
+        )
+        User.objects.create_user(
+            'far@example.com', name='Far', password='pass123',
+            latitude=Decimal('0.0'), longitude=Decimal('170.0'),
+        )
+
+        users = User.objects.with_location().within_bounding_box(0, 179.995, 5)
+        self.assertEqual(set(users), {east, west})
+
+
+class BatchDistanceTest(TestCase):
+    """Test cases for the vectorized distance kernel."""
+
+    def test_haversine_distances_matches_scalar(self):
+        """Test batch distances against the scalar haversine."""
+        points = [(40.7130, -74.0062), (34.0522, -118.2437), (-33.8688, 151.2093)]
+        distances = haversine_distances(40.7128, -74.0060, [p[0] for p in points], [p[1] for p in points])
+
+        for (lat, lon), distance in zip(points, distances):
+            self.assertAlmostEqual(distance, calculate_distance(40.7128, -74.0060, lat, lon), places=6)
+
+    def test_distance_backends_agree(self):
+        """Test every distance mode against the haversine at short range."""
+        points = [(40.7228, -74.0060), (40.7128, -73.9960), (40.6528, -74.0660)]
+        latitudes, longitudes = [p[0] for p in points], [p[1] for p in points]
+        expected = haversine_distances(40.7128, -74.0060, latitudes, longitudes)
+
+        for mode, backend in DISTANCE_BACKENDS.items():
+            distances = backend(40.7128, -74.0060, latitudes, longitudes)
+            # The ellipsoid differs from the sphere by at most about 0.5%
+            np.testing.assert_allclose(distances, expected, rtol=0.005, err_msg=mode)
+
+        # Pairs across the antimeridian are measured the short way round
+        distance, = equirectangular_distances(0.0, 179.95, [0.0], [-179.95])
+        self.assertAlmostEqual(distance, haversine_distances(0.0, 179.95, [0.0], [-179.95])[0], places=6)
+
+        with self.assertRaises(ValueError):
+            get_distance_backend('precise')
+
+    def test_radius_mask_and_argsort(self):
+        """Test radius masking and ordering by distance."""
+        distances = [12.0, 3.0, 7.5, 30.0]
+
+        mask = radius_mask(distances, 10)
+        self.assertEqual(mask.tolist(), [False, True, True, False])
+        self.assertEqual(argsort_by_distance(distances, mask).tolist(), [1, 2])
+        self.assertEqual(argsort_by_distance(distances).tolist(), [1, 2, 0, 3])
+        self.assertTrue(radius_mask(distances).all())
+
+
+class SpatialIndexTest(TestCase):
+    """Test cases for the in-process spatial index."""
+
+    def setUp(self):
+        """Set up an index over a few known points."""
+        self.points = {
+            uuid.uuid4(): (40.7128, -74.0060),   # New York
+            uuid.uuid4(): (40.7306, -73.9352),   # Brooklyn, ~6.5km away
+            uuid.uuid4(): (40.6413, -73.7781),   # JFK, ~21km away
+            uuid.uuid4(): (51.5074, -0.1278),    # London
+            uuid.uuid4(): (0.0, 179.99),         # East of the antimeridian
+            uuid.uuid4(): (0.0, -179.99),        # West of the antimeridian
+        }
+        self.ids = list(self.points)
+        self.index = spatial.SpatialIndex(
+            [user_id.bytes for user_id in self.ids],
+            [lat for lat, _ in self.points.values()],
+            [lon for _, lon in self.points.values()],
+        )
+
+    def test_query_radius(self):
+        """Test radius queries return matches closest first."""
+        ids, distances = self.index.query_radius(40.7128, -74.0060, 10)
+        self.assertEqual(ids, self.ids[:2])
+        self.assertAlmostEqual(distances[0], 0.0)
+
+        ids, _ = self.index.query_radius(40.7128, -74.0060, 25, exclude=self.ids[0])
+        self.assertEqual(ids, self.ids[1:3])
+
+    def test_query_radius_antimeridian(self):
+        """Test radius queries across the antimeridian."""
+        ids, _ = self.index.query_radius(0.0, 180.0, 5)
+        self.assertEqual(set(ids), set(self.ids[4:6]))
+
+    def test_query_knn(self):
+        """Test k-nearest queries grow until enough users are found."""
+        ids, distances = self.index.query_knn(40.7128, -74.0060, 4)
+        self.assertEqual(ids, self.ids[:4])
+        self.assertGreater(distances[3], 5000)
+
+        ids, _ = self.index.query_knn(40.7128, -74.0060, 100)
+        self.assertEqual(len(ids), len(self.ids))
+
+    def test_upsert_and_remove(self):
+        """Test overlay changes are visible to queries."""
+        new_id = uuid.uuid4()
+        self.index.upsert(new_id, 40.7130, -74.0062)
+        self.index.upsert(self.ids[3], 40.7140, -74.0070)  # London user moves to New York
+        self.index.remove(self.ids[1])
+
+        ids, _ = self.index.query_radius(40.7128, -74.0060, 10)
+        self.assertEqual(set(ids), {self.ids[0], new_id, self.ids[3]})
+        self.assertEqual(len(self.index), len(self.ids))
+
+        self.index.compact()
+        ids, _ = self.index.query_radius(40.7128, -74.0060, 10)
+        self.assertEqual(set(ids), {self.ids[0], new_id, self.ids[3]})
+        self.assertEqual(self.index.stats()['pending_changes'], 0)
+
+    def test_density(self):
+        """Test density counts merge cells across zooms and follow changes."""
+        rows, cols, counts, _, _ = self.index.density(0, 0, 0, [(0, 0)])
+        self.assertEqual(counts.tolist(), [len(self.ids)])
+
+        # Zoom 4 cells are 22.5 degrees: the New York area shares one cell
+        rows, cols, counts, latitudes, longitudes = self.index.density(4, 0, 7, [(0, 15)])
+        self.assertEqual(counts.tolist(), [1, 1, 3, 1])
+        self.assertEqual((rows[2], cols[2]), (5, 4))
+        self.assertAlmostEqual(latitudes[2], (40.7128 + 40.7306 + 40.6413) / 3)
+        self.assertAlmostEqual(longitudes[2], (-74.0060 - 73.9352 - 73.7781) / 3)
+
+        # Zoom 10 is read from a finer grid than zoom 4
+        self.assertEqual(len(self.index.density(10, 0, 511, [(0, 1023)])[0]), 5)
+
+        self.index.upsert(self.ids[3], 40.7140, -74.0070)  # London user moves to New York
+        self.index.remove(self.ids[0])
+        self.index.upsert(uuid.uuid4(), 51.5, -0.1)
+        rows, cols, counts, _, _ = self.index.density(4, 5, 6, [(4, 4), (7, 7)])
+        self.assertEqual(
+            list(zip(rows.tolist(), cols.tolist(), counts.tolist())), [(5, 4, 3), (6, 7, 1)]
+        )
+
+        self.index.compact()
+        self.assertEqual(self.index.density(0, 0, 0, [(0, 0)])[2].tolist(), [len(self.ids)])
+        self.assertEqual(self.index.density(4, 5, 5, [(4, 4)])[2].tolist(), [3])
+
+    def test_move_id_ending_in_null_byte(self):
+        """Test moving a user whose id ends in a null byte keeps density counts right."""
+        user_id = uuid.UUID(bytes=b'\x12' * 15 + b'\0')
+        index = spatial.SpatialIndex([user_id.bytes], [40.7128], [-74.0060])
+        self.assertEqual(index.density(0, 0, 0, [(0, 0)])[2].tolist(), [1])
+
+        index.upsert(user_id, 51.5074, -0.1278)
+        self.assertEqual(index.density(0, 0, 0, [(0, 0)])[2].tolist(), [1])
+        self.assertEqual(index.query_radius(51.5074, -0.1278, 1)[0], [user_id])
+
+    def test_distances_to(self):
+        """Test distances to specific users."""
+        missing_id = uuid.uuid4()
+        self.index.remove(self.ids[2])
+        ids, distances = self.index.distances_to(40.7128, -74.0060, [self.ids[1], self.ids[2], missing_id])
+        self.assertEqual(ids, [self.ids[1]])
+        self.assertAlmostEqual(distances[0], 6.5, delta=0.5)
+
+    def test_build_from_database(self):
+        """Test building from active located users only."""
+        located = User.objects.create_user(
+            'located@example.com', name='Located', password='pass123',
+            latitude=Decimal('1.0'), longitude=Decimal('1.0'),
+        )
+        User.objects.create_user('unlocated@example.com', name='Unlocated', password='pass123')
+        User.objects.create_user(
+            'inactive@example.com', name='Inactive', password='pass123',
+            latitude=Decimal('1.0'), longitude=Decimal('1.0'), is_active=False,
+        )
+
+        index = spatial.SpatialIndex.build()
+        ids, _ = index.query_radius(1.0, 1.0, 1)
+        self.assertEqual(ids, [located.id])
+
+    def test_snapshots(self):
+        """Test processes map the published snapshot instead of scanning the database."""
+        located = User.objects.create_user(
+            'snapshot@example.com', name='Snapshot', password='pass123',
+            latitude=Decimal('12.5'), longitude=Decimal('-70.0'),
+        )
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(SPATIAL_INDEX_SNAPSHOT_DIR=directory):
+            for _ in range(3):
+                generation = spatial.request_rebuild()
+            self.assertEqual(
+                sorted(os.listdir(directory)),
+                [f'generation-{generation - 1}', f'generation-{generation}'],
+            )
+
+            spatial._index = None
+            index = spatial.get_index()
+            self.assertEqual(index.generation, generation)
+            self.assertIsInstance(index._latitudes, np.memmap)
+            self.assertEqual(index.query_radius(12.5, -70.0, 1)[0], [located.id])
+
+            # Local changes still apply on top of the read-only arrays
+            index.remove(located.id)
+            self.assertEqual(index.query_radius(12.5, -70.0, 1)[0], [])
+            index.compact()
+            self.assertEqual(index.query_radius(12.5, -70.0, 1)[0], [])
+
+            # A missing snapshot falls back to a database scan
+            shutil.rmtree(os.path.join(directory, f'generation-{generation}'))
+            spatial._index = None
+            self.assertEqual(spatial.get_index().query_radius(12.5, -70.0, 1)[0], [located.id])
+        spatial._index = None
+
+    def test_signals_update_loaded_index(self):
+        """Test saves and deletes are applied to the loaded index."""
+        index = spatial.get_index()
+        user = User.objects.create_user(
+            'mover@example.com', name='Mover', password='pass123',
+            latitude=Decimal('-33.8688'), longitude=Decimal('151.2093'),
+        )
+        self.assertEqual(index.query_radius(-33.8688, 151.2093, 1)[0], [user.id])
+
+        user.latitude, user.longitude = Decimal('35.6762'), Decimal('139.6503')
+        user.save()
+        self.assertEqual(index.query_radius(-33.8688, 151.2093, 1)[0], [])
+        self.assertEqual(index.query_radius(35.6762, 139.6503, 1)[0], [user.id])
+
+        user.delete()
+        self.assertEqual(index.query_radius(35.6762, 139.6503, 1)[0], [])
+
+    @override_settings(CACHES=SHARED_CACHES)
+    def test_spatial_index_stats_endpoint(self):
+        """Test that index statistics are only available to staff."""
+        client = APIClient()
+        user = User.objects.create_user('member@example.com', name='Member', password='pass123')
+        client.force_authenticate(user)
+        self.assertEqual(client.get(reverse('user-spatial-index')).status_code, status.HTTP_403_FORBIDDEN)
+
+        user.is_staff = True
+        user.save()
+        response = client.get(reverse('user-spatial-index'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('age_seconds', response.data)
+        self.assertIn('stale', response.data)
+
+
+class GeohashTest(TestCase):
+    """Test cases for geohash cells."""
+
+    def test_encode(self):
+        """Test encoding against a reference geohash."""
+        self.assertEqual(encode_geohash(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(encode_geohash(40.7128, -74.0060, 5), 'dr5re')
+
+    def test_covering_cells_cover_circle(self):
+        """Test that points inside the radius fall in a covering cell."""
+        cells = covering_cells(40.7128, -74.0060, 10)
+        self.assertLessEqual(len(cells), 16)
+
+        for lat, lon in [(40.7128, -74.0060), (40.79, -74.0060), (40.7128, -73.90), (40.64, -74.08)]:
+            geohash = encode_geohash(lat, lon)
+            self.assertTrue(any(geohash.startswith(cell) for cell in cells), (lat, lon))
+
+    def test_covering_cells_antimeridian(self):
+        """Test covering cells on both sides of the antimeridian."""
+        cells = covering_cells(0.0, 179.99, 10)
+        self.assertTrue(any(encode_geohash(0.0, -179.99).startswith(cell) for cell in cells))
+        self.assertTrue(any(encode_geohash(0.0, 179.99).startswith(cell) for cell in cells))
+
+    def test_geohash_maintained_on_save(self):
+        """Test the geohash follows coordinate changes in every write path."""
+        user = User.objects.create_user(
+            'geo@example.com', name='Geo', password='pass123',
+            latitude=Decimal('40.7128'), longitude=Decimal('-74.0060'),
+        )
+        self.assertEqual(user.geohash, encode_geohash(40.7128, -74.0060))
+
+        serializer = UserUpdateSerializer(
+            user, data={'latitude': '51.5074', 'longitude': '-0.1278'}, partial=True
+        )
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+        user.refresh_from_db()
+        self.assertEqual(user.geohash, encode_geohash(51.5074, -0.1278))
+
+        process_user_location_update(user.id, 35.6762, 139.6503)
+        location_updates.flush_location_updates(include_current=True)
+        user.refresh_from_db()
+        self.assertEqual(user.geohash, encode_geohash(35.6762, 139.6503))
+
+        user.latitude = user.longitude = None
+        user.save(update_fields=['latitude', 'longitude'])
+        user.refresh_from_db()
+        self.assertEqual(user.geohash, '')
+
+    def test_in_covering_cells_queryset(self):
+        """Test the covering-cell lookup."""
+        near = User.objects.create_user(
+            'near@example.com', name='Near', password='pass123',
+            latitude=Decimal('40.7306'), longitude=Decimal('-73.9352'),
+        )
+        User.objects.create_user(
+            'far@example.com', name='Far', password='pass123',
+            latitude=Decimal('51.5074'), longitude=Decimal('-0.1278'),
+        )
+
+        self.assertEqual(list(User.objects.in_covering_cells(40.7128, -74.0060, 10)), [near])
+
+    @override_settings(SPATIAL_INDEX_ENABLED=False)
+    def test_nearby_without_spatial_index(self):
+        """Test the nearby endpoint using the database lookup."""
+        user = User.objects.create_user(
+            'origin@example.com', name='Origin', password='pass123',
+            latitude=Decimal('40.7128'), longitude=Decimal('-74.0060'),
+        )
+        User.objects.create_user(
+            'near@example.com', name='Near', password='pass123',
+            latitude=Decimal('40.7306'), longitude=Decimal('-73.9352'),
+        )
+        User.objects.create_user(
+            'far@example.com', name='Far', password='pass123',
+            latitude=Decimal('40.6413'), longitude=Decimal('-73.7781'),
+        )
+
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.get(reverse('user-nearby-friends') + '?radius=10')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([u['email'] for u in response.data['nearby_users']], ['near@example.com'])
+
+
+class UnitVectorTest(TestCase):
+    """Test cases for the unit vector columns and SQL radius filter."""
+
+    def test_unit_vector_maintained_on_save(self):
+        """Test that unit vector columns follow the coordinates."""
+        user = User.objects.create_user(
+            'vector@example.com', name='Vector', password='pass123',
+            latitude=Decimal('0'), longitude=Decimal('90'),
+        )
+        self.assertAlmostEqual(user.loc_x, 0.0)
+        self.assertAlmostEqual(user.loc_y, 1.0)
+        self.assertAlmostEqual(user.loc_z, 0.0)
+
+        user.latitude = user.longitude = None
+        user.save()
+        user.refresh_from_db()
+        self.assertIsNone(user.loc_x)
+
+    def test_within_radius_queryset(self):
+        """Test the exact radius filter and ordering evaluated in SQL."""
+        points = {
+            'near@example.com': (Decimal('40.7306'), Decimal('-73.9352')),
+            'nearest@example.com': (Decimal('40.7130'), Decimal('-74.0062')),
+            'far@example.com': (Decimal('40.6413'), Decimal('-73.7781')),
+            'antipode@example.com': (Decimal('-40.7128'), Decimal('105.9940')),
+        }
+        for email, (lat, lon) in points.items():
+            User.objects.create_user(email, name=email, password='pass123', latitude=lat, longitude=lon)
+        User.objects.create_user('nowhere@example.com', name='Nowhere', password='pass123')
+
+        rows = list(
+            User.objects.within_radius(40.7128, -74.0060, 10).order_by('chord_sq').values_list(
+                'email', 'chord_sq'
+            )
+        )
+        self.assertEqual([email for email, _ in rows], ['nearest@example.com', 'near@example.com'])
+
+        distances = chord_distances([chord for _, chord in rows])
+        expected = [calculate_distance(40.7128, -74.0060, *map(float, points[email])) for email, _ in rows]
+        np.testing.assert_allclose(distances, expected, rtol=1e-6)
+
+        self.assertEqual(User.objects.within_radius(40.7128, -74.0060, 25000).count(), 4)
+
+
+@override_settings(SPATIAL_INDEX_ENABLED=False)
+class NearbyCacheTest(APITestCase):
+    """Test cases for the nearby result cache."""
+
+    def setUp(self):
+        """Set up a requester and a nearby user with an empty cache."""
+        cache.clear()
+        self.user = User.objects.create_user(
+            'origin@example.com', name='Origin', password='pass123',
+            latitude=Decimal('40.7128'), longitude=Decimal('-74.0060'),
+        )
+        self.near = User.objects.create_user(
+            'near@example.com', name='Near', password='pass123',
+            latitude=Decimal('40.7306'), longitude=Decimal('-73.9352'),
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('user-nearby-friends')
+
+    def nearby_emails(self, radius=10):
+        response = self.client.get(self.url, {'radius': radius})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [u['email'] for u in response.data['nearby_users']]
+
+    def test_hits_and_misses(self):
+        """Test that polls from the same cell and radius bucket hit the cache."""
+        self.assertEqual(self.nearby_emails(), ['near@example.com'])
+        self.assertEqual(nearby_cache.stats()['users'], {'hits': 0, 'misses': 1, 'hit_rate': 0.0})
+
+        # A slightly moved origin and a smaller radius in the same bucket
+        self.user.latitude = Decimal('40.7129')
+        self.assertEqual(self.nearby_emails(radius=8), ['near@example.com'])
+        self.assertEqual(nearby_cache.stats()['users']['hits'], 1)
+
+        # Results are still refined from the requester's exact origin
+        self.assertEqual(self.nearby_emails(radius=5.5), [])
+        self.assertEqual(nearby_cache.stats()['users']['hits'], 2)
+
+    def test_invalidated_by_moves_in_covered_cells(self):
+        """Test that only location changes inside the covered area invalidate."""
+        self.nearby_emails()
+
+        User.objects.create_user(
+            'london@example.com', name='London', password='pass123',
+            latitude=Decimal('51.5074'), longitude=Decimal('-0.1278'),
+        )
+        self.nearby_emails()
+        self.assertEqual(nearby_cache.stats()['users']['hits'], 1)
+
+        self.near.latitude, self.near.longitude = Decimal('51.5'), Decimal('-0.12')
+        self.near.save()
+        self.assertEqual(self.nearby_emails(), [])
+        self.assertEqual(nearby_cache.stats()['users']['misses'], 2)
+
+        self.near.latitude, self.near.longitude = Decimal('40.7130'), Decimal('-74.0062')
+        self.near.save()
+        self.assertEqual(self.nearby_emails(), ['near@example.com'])
+
+        self.near.is_active = False
+        self.near.save(update_fields=['is_active'])
+        self.assertEqual(self.nearby_emails(), [])
+
+    def test_stats_endpoint(self):
+        """Test the staff-only cache statistics endpoint."""
+        url = reverse('user-nearby-cache')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+        self.nearby_emails()
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['users']['misses'], 1)
+
+        self.assertEqual(self.client.delete(url).status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.get(url).data['users']['misses'], 0)
+
+
+@override_settings(CACHES=SHARED_CACHES)
+class LocationUpdatePipelineTest(TestCase):
+    """Test cases for the coalescing location update pipeline."""
+
+    def setUp(self):
+        """Set up users with an empty buffer."""
+        cache.clear()
+        self.user = User.objects.create_user(
+            'moving@example.com', name='Moving', password='pass123',
+            latitude=Decimal('40.7128'), longitude=Decimal('-74.0060'),
+        )
+        self.other = User.objects.create_user('other@example.com', name='Other', password='pass123')
+
+    def test_latest_update_per_user_is_written(self):
+        """Test that buffered pings are coalesced into one write per user."""
+        updated_at = self.user.updated_at
+        for i in range(5):
+            self.assertTrue(process_user_location_update(self.user.id, 40.7 + i / 100, '-74.0'))
+        process_user_location_update(str(self.other.id), Decimal('51.5074'), Decimal('-0.1278'))
+        self.assertFalse(process_user_location_update(self.other.id, 100, 0))
+
+        # Nothing is written until the window is flushed
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.latitude, 40.7128)
+
+        self.assertEqual(location_updates.flush_location_updates(include_current=True), 2)
+
+        self.user.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual(self.user.get_location_tuple(), (40.74, -74.0))
+        self.assertEqual(self.user.geohash, encode_geohash(40.74, -74.0))
+        self.assertGreater(self.user.updated_at, updated_at)
+        self.assertEqual(self.other.get_location_tuple(), (51.5074, -0.1278))
+        self.assertIsNotNone(self.other.loc_x)
+
+    def test_buffer_shared_between_processes(self):
+        """Test that a ping buffered in one process is written by a flush in another."""
+        pid = os.fork()
+        if pid == 0:
+            # The child only touches the cache, never the parent's test database
+            try:
+                location_updates.buffer_location_update(self.user.id, 51.5074, -0.1278)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertEqual(location_updates.flush_location_updates(include_current=True), 1)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.get_location_tuple(), (51.5074, -0.1278))
+
+    def test_process_local_cache_writes_directly(self):
+        """Test that nothing is buffered in a cache other processes cannot read."""
+        with override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+        }):
+            self.assertFalse(utils.cache_is_shared())
+            self.assertTrue(location_updates.buffer_location_update(self.user.id, 35.6762, 139.6503))
+            self.user.refresh_from_db()
+            self.assertEqual(self.user.get_location_tuple(), (35.6762, 139.6503))
+            self.assertEqual(location_updates.flush_location_updates(include_current=True), 0)
+        self.assertTrue(utils.cache_is_shared())
+
+    def test_apply_location_updates(self):
+        """Test writing a batch of updates directly."""
+        written = location_updates.apply_location_updates([
+            (self.user.id, 35.0, 139.0),
+            (uuid.uuid4(), 10.0, 10.0),
+            (self.user.id, 35.6762, 139.6503),
+        ])
+        self.assertEqual(written, 1)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.get_location_tuple(), (35.6762, 139.6503))
+        self.assertEqual(self.user.name, 'Moving')
+
+    def test_ping_during_flush_is_not_lost(self):
+        """Test that a ping registered in a window while it is flushed is still written."""
+        window = location_updates.current_window() - 1
+        apply = location_updates.apply_location_updates
+
+        def apply_and_ping(updates):
+            # A process with a lagging clock registers a ping in the closing window
+            if mock_apply.call_count == 1:
+                location_updates.buffer_location_update(self.other.id, 51.5074, -0.1278)
+            return apply(updates)
+
+        with mock.patch.object(location_updates, 'current_window', return_value=window):
+            location_updates.buffer_location_update(self.user.id, 35.6762, 139.6503)
+        with mock.patch.object(location_updates, 'current_window', return_value=window), \
+                mock.patch.object(location_updates, 'apply_location_updates',
+                                  side_effect=apply_and_ping) as mock_apply:
+            self.assertEqual(location_updates._flush_window(window, closed=True), 2)
+
+        self.other.refresh_from_db()
+        self.assertEqual(self.other.get_location_tuple(), (51.5074, -0.1278))
+        self.assertIsNone(cache.get(location_updates._count_key(window)))
+
+    @override_settings(SPATIAL_INDEX_ENABLED=True, SPATIAL_INDEX_CHECK_INTERVAL=3600)
+    def test_flush_updates_spatial_index(self):
+        """Test that flushed moves reach the index of this and other processes."""
+        spatial._index = None
+        self.addCleanup(setattr, spatial, '_index', None)
+        self.assertEqual(nearby.nearby_user_ids(self.user, 5)[0], [])
+        # Stands in for the index of another process, built before the flush
+        other_process = spatial.SpatialIndex.build()
+
+        location_updates.buffer_location_update(self.other.id, 40.7130, -74.0062)
+        location_updates.flush_location_updates(include_current=True)
+        self.assertEqual(nearby.nearby_user_ids(self.user, 5)[0], [self.other.id])
+
+        self.assertEqual(other_process.query_radius(40.7128, -74.0060, 5)[0], [self.user.id])
+        self.assertTrue(spatial._apply_moves(other_process))
+        self.assertEqual(
+            other_process.query_radius(40.7128, -74.0060, 5)[0], [self.user.id, self.other.id]
+        )
+
+        # A batch that expired before it was applied forces a rebuild
+        stale = spatial.SpatialIndex.build()
+        location_updates.apply_location_updates([(self.other.id, 51.5074, -0.1278)])
+        location_updates.apply_location_updates([(self.other.id, 40.7130, -74.0062)])
+        cache.delete(spatial._moves_key(stale.moves_applied + 1))
+        self.assertFalse(spatial._apply_moves(stale))
+
+    @override_settings(SPATIAL_INDEX_ENABLED=False)
+    def test_flush_invalidates_nearby_cache(self):
+        """Test that flushed moves invalidate cached nearby results."""
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = reverse('user-nearby-friends')
+        self.assertEqual(client.get(url).data['count'], 0)
+
+        location_updates.buffer_location_update(self.other.id, 40.7130, -74.0062)
+        location_updates.flush_location_updates(include_current=True)
+        self.assertEqual(client.get(url).data['count'], 1)
+
+
+class NearestUsersAPITest(APITestCase):
+    """Test cases for the k-nearest users endpoint."""
+
+    def setUp(self):
+        """Set up users at increasing distances from the requester."""
+        self.user = User.objects.create_user(
+            'origin@example.com', name='Origin', password='pass123',
+            latitude=Decimal('40.7128'), longitude=Decimal('-74.0060'),
+        )
+        self.others = [
+            User.objects.create_user(
+                f'user{i}@example.com', name=f'User {i}', password='pass123',
+                latitude=Decimal('40.7128') + Decimal(i) / 10, longitude=Decimal('-74.0060'),
+            )
+            for i in (3, 1, 30, 2)
+        ]
+        User.objects.create_user(
+            'inactive@example.com', name='Inactive', password='pass123',
+            latitude=Decimal('40.7129'), longitude=Decimal('-74.0060'), is_active=False,
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('user-nearest')
+
+    def assert_nearest(self):
+        response = self.client.get(self.url + '?k=3')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [u['email'] for u in response.data['nearest_users']],
+            ['user1@example.com', 'user2@example.com', 'user3@example.com'],
+        )
+        self.assertLess(response.data['nearest_users'][0]['distance_km'], 12)
+
+        # A distant user is still found once the ring has grown far enough
+        response = self.client.get(self.url + '?k=10')
+        self.assertEqual(response.data['count'], 4)
+
+    def test_nearest_with_spatial_index(self):
+        """Test k-nearest users from the spatial index."""
+        self.assert_nearest()
+
+    @override_settings(SPATIAL_INDEX_ENABLED=False)
+    def test_nearest_without_spatial_index(self):
+        """Test k-nearest users from growing database rings."""
+        self.assert_nearest()
+
+    def test_nearest_distance_modes(self):
+        """Test that every distance mode ranks these users alike and reports its own distances."""
+        emails = None
+        for mode in DISTANCE_BACKENDS:
+            response = self.client.get(self.url, {'k': 3, 'distance_mode': mode})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['distance_mode'], mode)
+
+            ranked = [u['email'] for u in response.data['nearest_users']]
+            self.assertEqual(ranked, emails or ranked)
+            emails = ranked
+
+        nearest = response.data['nearest_users'][0]
+        expected = geodesic((40.7128, -74.0060), (40.8128, -74.0060)).kilometers
+        self.assertEqual(nearest['distance_km'], round(expected, 2))
+
+        response = self.client.get(self.url, {'distance_mode': 'precise'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_nearest_invalid_k(self):
+        """Test validation of k."""
+        self.assertEqual(self.client.get(self.url + '?k=abc').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(self.url + '?k=0').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(self.url + '?k=1000').status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(SPATIAL_INDEX_CHECK_INTERVAL=0, CACHES=SHARED_CACHES)
+class DistanceModeSearchTest(APITestCase):
+    """Test cases for searches filtered and ranked in a distance mode."""
+
+    def setUp(self):
+        """Set up users just inside 10km by one measure and just outside by another."""
+        cache.clear()
+        # A cleared cache restarts the generation count, so drop the loaded index too
+        spatial._index = None
+        self.user = User.objects.create_user(
+            'equator@example.com', name='Equator', password='pass123',
+            latitude=Decimal('0'), longitude=Decimal('0'),
+        )
+        # Meridians are shorter than the sphere's arcs at the equator, and the
+        # equator longer, so the geodesic and haversine disagree on both
+        self.north = User.objects.create_user(
+            'north@example.com', name='North', password='pass123',
+            latitude=Decimal('0.0901'), longitude=Decimal('0'),
+        )
+        self.east = User.objects.create_user(
+            'east@example.com', name='East', password='pass123',
+            latitude=Decimal('0'), longitude=Decimal('0.0899'),
+        )
+        spatial.request_rebuild()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_radius_measured_in_mode(self):
+        """Test the radius is applied with the selected mode on every search path."""
+        expected = {
+            'fast': 'east@example.com', 'haversine': 'east@example.com', 'exact': 'north@example.com'
+        }
+        for index_enabled, cache_enabled in ((True, False), (False, True), (False, False)):
+            with override_settings(SPATIAL_INDEX_ENABLED=index_enabled, NEARBY_CACHE_ENABLED=cache_enabled):
+                for mode, email in expected.items():
+                    response = self.client.get(
+                        reverse('user-nearby-friends'), {'radius': 10, 'distance_mode': mode}
+                    )
+                    self.assertEqual([u['email'] for u in response.data['nearby_users']], [email])
+                    self.assertLessEqual(response.data['nearby_users'][0]['distance_km'], 10)
+
+                response = self.client.get(reverse('user-nearest'), {'k': 1, 'distance_mode': 'exact'})
+                self.assertEqual(response.data['nearest_users'][0]['email'], 'north@example.com')
+
+
+@override_settings(SPATIAL_INDEX_CHECK_INTERVAL=0, CACHES=SHARED_CACHES)
+class NearbyPaginationAPITest(APITestCase):
+    """Test cases for cursor pagination and streaming of nearby users."""
+
+    def setUp(self):
+        """Set up users, some of them sharing a location."""
+        cache.clear()
+        spatial._index = None
+        self.user = User.objects.create_user(
+            'origin@example.com', name='Origin', password='pass123',
+            latitude=Decimal('40.7128'), longitude=Decimal('-74.0060'),
+        )
+        for i in range(7):
+            User.objects.create_user(
+                f'user{i}@example.com', name=f'User {i}', password='pass123',
+                latitude=Decimal('40.7128') + Decimal(i // 2) / 100, longitude=Decimal('-74.0060'),
+            )
+        # Drop users left in the index by earlier tests at the same locations
+        spatial.request_rebuild()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('user-nearby-friends')
+
+    def collect_pages(self, page_size):
+        """Follow cursors until the last page and return every user."""
+        users = []
+        cursor = None
+        while True:
+            params = {'page_size': page_size}
+            if cursor:
+                params['cursor'] = cursor
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(response.data['count'], page_size)
+            users.extend(response.data['nearby_users'])
+            cursor = response.data['next_cursor']
+            if not cursor:
+                return users
+
+    def assert_pages(self):
+        everyone = self.client.get(self.url).data['nearby_users']
+        self.assertEqual(len(everyone), 7)
+        distances = [u['distance_km'] for u in everyone]
+        self.assertEqual(distances, sorted(distances))
+
+        for page_size in (1, 2, 3):
+            self.assertEqual(
+                [u['id'] for u in self.collect_pages(page_size)], [u['id'] for u in everyone]
+            )
+
+    def test_cursor_pagination_with_spatial_index(self):
+        """Test cursor pages over the spatial index ranking."""
+        self.assert_pages()
+
+    @override_settings(SPATIAL_INDEX_ENABLED=False)
+    def test_cursor_pagination_without_spatial_index(self):
+        """Test cursor pages over the database ranking."""
+        self.assert_pages()
+
+    def test_invalid_cursor(self):
+        """Test that a malformed cursor is rejected."""
+        response = self.client.get(self.url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_stream_ndjson(self):
+        """Test streaming nearby users as NDJSON."""
+        response = self.client.get(self.url, {'stream': '1', 'page_size': 5})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        streamed = [json.loads(line) for line in lines]
+        self.assertEqual(len(streamed), 5)
+        self.assertIn('distance_km', streamed[0])
+
+        rest = self.client.get(self.url, {'cursor': response['X-Next-Cursor']})
+        self.assertEqual(
+            [u['id'] for u in rest.data['nearby_users']],
+            [u['id'] for u in self.client.get(self.url).data['nearby_users']][5:],
+        )
+
+
+@override_settings(
+    LOCATION_HISTORY_RAW_DAYS=7, LOCATION_HISTORY_DOWNSAMPLE_MINUTES=5,
+    LOCATION_HISTORY_RETENTION_DAYS=30
+)
+class LocationHistoryTest(APITestCase):
+    """Test cases for the location history, its compaction and the track endpoint."""
+
+    def setUp(self):
+        """Set up a user and clear the location buffer and compaction progress."""
+        cache.clear()
+        self.user = User.objects.create_user(
+            'tracked@example.com', name='Tracked', password='pass123',
+            latitude=Decimal('40.7128'), longitude=Decimal('-74.0060'),
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('user-track', args=[self.user.id])
+        self.now = timezone.now()
+
+    def add_points(self, user, start, minutes):
+        LocationHistory.objects.bulk_create([
+            LocationHistory(
+                user=user, latitude=40.0 + i / 1000, longitude=-74.0,
+                recorded_at=start + timedelta(minutes=i),
+                minute=LocationHistory.minute_bucket(start + timedelta(minutes=i)),
+            )
+            for i in range(minutes)
+        ])
+
+    @override_settings(CACHES=SHARED_CACHES)
+    def test_flush_appends_history(self):
+        """Test that every flushed position is appended with its ping time."""
+        cache.clear()
+        process_user_location_update(self.user.id, 40.72, -74.0)
+        process_user_location_update(self.user.id, 40.73, -74.0)
+        location_updates.flush_location_updates(include_current=True)
+
+        point, = LocationHistory.objects.filter(user=self.user)
+        self.assertEqual((point.latitude, point.longitude), (40.73, -74.0))
+        self.assertLessEqual(point.recorded_at, timezone.now())
+        self.assertEqual(point.minute, LocationHistory.minute_bucket(point.recorded_at))
+
+    def test_downsample_and_expire(self):
+        """Test that old points keep one per interval and expired points are deleted."""
+        other = User.objects.create_user('other@example.com', name='Other', password='pass123')
+        old = self.now - timedelta(days=10)
+        old = old.replace(minute=0, second=0, microsecond=0)
+        self.add_points(self.user, old, 20)
+        self.add_points(other, old, 20)
+        self.add_points(self.user, self.now - timedelta(hours=1), 20)
+        self.add_points(self.user, self.now - timedelta(days=40), 3)
+
+        self.assertEqual(
+            history.compact_location_history(self.now), {'downsampled': 32, 'expired': 3}
+        )
+        self.assertEqual(LocationHistory.objects.filter(user=other).count(), 4)
+        self.assertEqual(
+            [p.recorded_at for p in history.track(self.user, old, old + timedelta(hours=1))],
+            [old + timedelta(minutes=m) for m in (0, 5, 10, 15)],
+        )
+        # Recent points stay at full resolution
+        self.assertEqual(
+            history.track(self.user, self.now - timedelta(hours=2), self.now).count(), 20
+        )
+
+        cache.clear()
+        self.assertEqual(history.compact_location_history(self.now), {'downsampled': 0, 'expired': 0})
+
+    def test_downsample_late_points(self):
+        """Test that points written into an already compacted slice are downsampled."""
+        # Just past the raw period, inside the slices every run compacts again
+        old = (self.now - timedelta(days=7, hours=3)).replace(minute=0, second=0, microsecond=0)
+        self.add_points(self.user, old, 10)
+        self.assertEqual(history.compact_location_history(self.now)['downsampled'], 8)
+
+        # Late flush of pings from the intervals compacted above
+        self.add_points(self.user, old + timedelta(seconds=30), 10)
+        self.assertEqual(history.compact_location_history(self.now)['downsampled'], 10)
+        self.assertEqual(
+            [p.recorded_at for p in history.track(self.user, old, old + timedelta(hours=1))],
+            [old, old + timedelta(minutes=5)],
+        )
+
+    def test_downsample_keeps_earliest_recorded(self):
+        """Test that downsampling keeps the earliest point, not the lowest id."""
+        old = (self.now - timedelta(days=10)).replace(minute=0, second=0, microsecond=0)
+        # Written newest first, as a late flush of buffered pings can do
+        for minute in (4, 3, 1, 1, 2):
+            self.add_points(self.user, old + timedelta(minutes=minute), 1)
+        first = LocationHistory.objects.filter(recorded_at=old + timedelta(minutes=1)).order_by('id')[0]
+
+        self.assertEqual(history.compact_location_history(self.now)['downsampled'], 4)
+        self.assertEqual(list(LocationHistory.objects.values_list('id', flat=True)), [first.id])
+
+    def test_track_pagination(self):
+        """Test reading a track page by page over a time range."""
+        start = self.now - timedelta(hours=1)
+        self.add_points(self.user, start, 30)
+
+        params = {'start': start.isoformat(), 'end': self.now.isoformat(), 'page_size': 20}
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 20)
+
+        rest = self.client.get(self.url, {**params, 'cursor': response.data['next_cursor']})
+        points = response.data['points'] + rest.data['points']
+        self.assertEqual(
+            [p['recorded_at'] for p in points], [start + timedelta(minutes=i) for i in range(30)]
+        )
+        self.assertIsNone(rest.data['next_cursor'])
+
+        response = self.client.get(self.url, {'start': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_track_permissions(self):
+        """Test that a track is only visible to its user and to staff."""
+        other = User.objects.create_user('other@example.com', name='Other', password='pass123')
+        self.client.force_authenticate(other)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+
+        other.is_staff = True
+        other.save()
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+
+
+@override_settings(SPATIAL_INDEX_CHECK_INTERVAL=0, CACHES=SHARED_CACHES)
+class DensityAPITest(APITestCase):
+    """Test cases for the heatmap and clustering endpoints."""
+
+    def setUp(self):
+        """Set up located users and a staff client."""
+        cache.clear()
+        spatial._index = None
+        self.staff = User.objects.create_user(
+            'ops@example.com', name='Ops', password='pass123', is_staff=True
+        )
+        for i, (latitude, longitude) in enumerate([
+            (40.7128, -74.0060), (40.7306, -73.9352), (40.6413, -73.7781),
+            (51.5074, -0.1278), (0.0, 179.99), (0.0, -179.99),
+        ]):
+            User.objects.create_user(
+                f'user{i}@example.com', name=f'User {i}', password='pass123',
+                latitude=latitude, longitude=longitude,
+            )
+        User.objects.create_user(
+            'inactive@example.com', name='Inactive', password='pass123',
+            latitude=40.7128, longitude=-74.0060, is_active=False,
+        )
+        spatial.request_rebuild()
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+        self.url = reverse('user-heatmap')
+
+    def assert_heatmap(self):
+        response = self.client.get(self.url, {'bbox': '-75,40,-73,41', 'zoom': 12})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total'], 3)
+        self.assertEqual(response.data['count'], 3)
+
+        # Whole cells are counted, however little of them the viewport covers
+        response = self.client.get(self.url, {'bbox': '-74.01,40.70,-74.00,40.71', 'zoom': 4})
+        self.assertEqual(
+            [(cell['row'], cell['col'], cell['count']) for cell in response.data['cells']],
+            [(5, 4, 3)]
+        )
+
+        # A viewport across the antimeridian
+        response = self.client.get(self.url, {'bbox': '170,-1,-170,1', 'zoom': 6})
+        self.assertEqual([cell['col'] for cell in response.data['cells']], [0, 63])
+
+        response = self.client.get(self.url, {'bbox': '-180,-90,180,90', 'zoom': 0})
+        self.assertEqual(response.data['cells'][0]['count'], 6)
+
+    def assert_clusters(self):
+        url = reverse('user-clusters')
+        # Zoom 4 clusters are zoom 6 cells, 5.625 degrees: New York is one cluster
+        response = self.client.get(url, {'bbox': '-80,35,-70,45', 'zoom': 4})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        cluster, = response.data['clusters']
+        self.assertEqual(cluster['count'], 3)
+        self.assertAlmostEqual(cluster['latitude'], (40.7128 + 40.7306 + 40.6413) / 3, places=5)
+        self.assertEqual(len(cluster['sample_ids']), 3)
+        self.assertNotIn('email', cluster)
+
+        # Zoomed in, every user is a cluster of its own
+        response = self.client.get(url, {'bbox': '-74.1,40.6,-73.7,40.8', 'zoom': 14})
+        self.assertEqual([cluster['count'] for cluster in response.data['clusters']], [1, 1, 1])
+        located = set(
+            str(user_id) for user_id in User.objects.filter(
+                email__in=['user0@example.com', 'user1@example.com', 'user2@example.com']
+            ).values_list('id', flat=True)
+        )
+        self.assertEqual(
+            {cluster['sample_ids'][0] for cluster in response.data['clusters']}, located
+        )
+
+        response = self.client.get(url, {'bbox': '0,-10,10,10', 'zoom': 4})
+        self.assertEqual(response.data['clusters'], [])
+
+    def test_heatmap_with_spatial_index(self):
+        """Test heatmap counts from the spatial index density grid."""
+        self.assert_heatmap()
+
+    @override_settings(SPATIAL_INDEX_ENABLED=False)
+    def test_heatmap_without_spatial_index(self):
+        """Test heatmap counts aggregated in SQL."""
+        self.assert_heatmap()
+
+    def test_clusters_with_spatial_index(self):
+        """Test clusters from the spatial index density grids."""
+        self.assert_clusters()
+
+    @override_settings(SPATIAL_INDEX_ENABLED=False)
+    def test_clusters_without_spatial_index(self):
+        """Test clusters aggregated in SQL."""
+        self.assert_clusters()
+
+    def test_clusters_for_members(self):
+        """Test that clusters are available to every authenticated user."""
+        self.client.force_authenticate(User.objects.get(email='user0@example.com'))
+        response = self.client.get(reverse('user-clusters'), {'bbox': '-180,-90,180,90', 'zoom': 0})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total'], 6)
+
+        response = self.client.get(reverse('user-clusters'), {'bbox': '-180,-90,180,90', 'zoom': 21})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_invalid_parameters(self):
+        """Test malformed viewports and zooms are rejected."""
+        for params in (
+            {'bbox': '1,2,3'}, {'bbox': '0,10,1,5'}, {'bbox': '0,0,1,1', 'zoom': 'x'},
+            {'bbox': '0,0,1,1', 'zoom': 17}, {'bbox': '-180,-90,180,90', 'zoom': 12},
+        ):
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+
+    def test_staff_only(self):
+        """Test that the heatmap is only available to staff."""
+        self.client.force_authenticate(User.objects.get(email='user0@example.com'))
+        response = self.client.get(self.url, {'bbox': '0,0,1,1'})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class GeofenceTest(APITestCase):
+    """Test cases for polygon containment and the geofence endpoint."""
+
+    square_with_hole = {
+        'type': 'Polygon',
+        'coordinates': [
+            [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]],
+            [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]],
+        ],
+    }
+
+    def test_contains(self):
+        """Test the even-odd test with holes, concave outlines and vertices."""
+        polygon, = geofence.parse_geometry(self.square_with_hole)
+        latitudes = np.array([5.0, 2.0, 2.0, 11.0, 5.0, 0.0])
+        longitudes = np.array([5.0, 2.0, 8.0, 5.0, 10.5, 5.0])
+        self.assertEqual(
+            polygon.contains(latitudes, longitudes).tolist(),
+            [False, True, True, False, False, True]
+        )
+
+        # A concave "C" shape, with rays passing through its vertices
+        shape, = geofence.parse_geometry({'type': 'Polygon', 'coordinates': [[
+            [0, 0], [3, 0], [3, 1], [1, 1], [1, 2], [3, 2], [3, 3], [0, 3], [0, 0]
+        ]]})
+        latitudes = np.array([0.5, 1.5, 1.5, 2.5, 1.0])
+        longitudes = np.array([2.0, 0.5, 2.0, 2.0, 0.5])
+        self.assertEqual(shape.contains(latitudes, longitudes).tolist(), [True, True, False, True, True])
+
+    def test_multipolygon_across_antimeridian(self):
+        """Test a MultiPolygon split at the antimeridian."""
+        polygons = geofence.parse_geometry({
+            'type': 'Feature',
+            'geometry': {'type': 'MultiPolygon', 'coordinates': [
+                [[[170, -10], [180, -10], [180, 10], [170, 10], [170, -10]]],
+                [[[-180, -10], [-170, -10], [-170, 10], [-180, 10], [-180, -10]]],
+            ]},
+        })
+        inside = geofence.contains(polygons, np.array([0.0, 0.0, 0.0]), np.array([179.0, -179.0, 0.0]))
+        self.assertEqual(inside.tolist(), [True, True, False])
+
+    def test_invalid_geometries(self):
+        """Test malformed geometries are rejected."""
+        for geometry in (
+            {'type': 'Point', 'coordinates': [0, 0]},
+            {'type': 'Polygon', 'coordinates': []},
+            {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [0, 0]]]},
+            {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 1]]]},
+            {'type': 'Polygon', 'coordinates': [[[0, 0], [200, 0], [1, 1], [0, 0]]]},
+            {'type': 'Polygon', 'coordinates': [[[0, 0], ['1', 0], [1, 1], [0, 0]]]},
+        ):
+            with self.assertRaises(ValueError):
+                geofence.parse_geometry(geometry)
+
+    def test_geofence_endpoint(self):
+        """Test paging through the active users inside a polygon."""
+        staff = User.objects.create_user('ops@example.com', name='Ops', password='pass123', is_staff=True)
+        inside = set()
+        for i in range(7):
+            user = User.objects.create_user(
+                f'in{i}@example.com', name=f'In {i}', password='pass123',
+                latitude=1 + i, longitude=2,
+            )
+            inside.add(str(user.id))
+        for i, (latitude, longitude) in enumerate([(5, 5), (5, 11), (20, 20)]):
+            User.objects.create_user(
+                f'out{i}@example.com', name=f'Out {i}', password='pass123',
+                latitude=latitude, longitude=longitude,
+            )
+        User.objects.create_user(
+            'inactive@example.com', name='Inactive', password='pass123',
+            latitude=2, longitude=2, is_active=False,
+        )
+
+        client = APIClient()
+        client.force_authenticate(staff)
+        url = reverse('user-geofence')
+        found = []
+        cursor = None
+        while True:
+            query = f'?page_size=3&cursor={cursor}' if cursor else '?page_size=3'
+            response = client.post(url + query, self.square_with_hole, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(response.data['count'], 3)
+            found.extend(user['id'] for user in response.data['users'])
+            cursor = response.data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(found, sorted(inside))
+        self.assertEqual(response.data['bbox'], [0, 0, 10, 10])
+
+        response = client.post(url, {'type': 'Polygon'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        client.force_authenticate(User.objects.get(email='in0@example.com'))
+        response = client.post(url, self.square_with_hole, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
@@ -5,12 +5,21 @@ This module provides utility functions and helpers for the user management syste
 """
 
 import logging
+import math
+
+import numpy as np
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
 from rest_framework.views import exception_handler
 from rest_framework.response import Response
 from rest_framework import status
 
 logger = logging.getLogger(__name__)
 
+# Mean radius of the earth in kilometers
+EARTH_RADIUS_KM = 6371.0
+
 
 def custom_exception_handler(exc, context):
     """
@@ -49,6 +58,22 @@ def custom_exception_handler(exc, context):
     return response
 
 
+def cache_is_shared(alias='default'):
+    """
+    Whether a cache is shared by every process of the deployment.
+
+    LocMemCache keeps its entries in the memory of one process and DummyCache
+    keeps none, so state written there by one worker is never seen by another.
+
+    Args:
+        alias: Alias of the cache in CACHES
+
+    Returns:
+        bool: False for process-local backends, True otherwise
+    """
+    return not isinstance(caches[alias], (LocMemCache, DummyCache))
+
+
 def validate_coordinates(latitude, longitude):
     """
     Validate geographic coordinates.
@@ -102,10 +127,173 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
     c = 2 * asin(sqrt(a))
 
-    # Radius of earth in kilometers
-    r = 6371
+    return c * EARTH_RADIUS_KM
+
+
+def haversine_distances(latitude, longitude, latitudes, longitudes):
+    """
+    Calculate distances from one origin to many points in a single pass.
+
+    This is the vectorized counterpart of calculate_distance.
+
+    Args:
+        latitude: Latitude of the origin
+        longitude: Longitude of the origin
+        latitudes: Array-like of point latitudes
+        longitudes: Array-like of point longitudes
+
+    Returns:
+        numpy.ndarray: Distances in kilometers, aligned with the input points
+    """
+    lat1 = math.radians(float(latitude))
+    lon1 = math.radians(float(longitude))
+    lat2 = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon2 = np.radians(np.asarray(longitudes, dtype=np.float64))
+
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def radius_mask(distances, radius_km=None):
+    """
+    Build a boolean mask of distances inside a radius.
+
+    Args:
+        distances: Array of distances in kilometers
+        radius_km: Radius in kilometers, or None to keep every point
+
+    Returns:
+        numpy.ndarray: Boolean mask aligned with distances
+    """
+    distances = np.asarray(distances)
+    if radius_km is None:
+        return np.ones(distances.shape, dtype=bool)
+    return distances <= radius_km
+
+
+def argsort_by_distance(distances, mask=None, tiebreak=None):
+    """
+    Return the indices of distances ordered from closest to farthest.
+
+    Args:
+        distances: Array of distances in kilometers
+        mask: Optional boolean mask; only masked-in indices are returned
+        tiebreak: Optional array ordering points at equal distances
+
+    Returns:
+        numpy.ndarray: Indices into distances, closest first
+    """
+    distances = np.asarray(distances)
+    indices = np.flatnonzero(mask) if mask is not None else np.arange(distances.size)
+    if tiebreak is not None:
+        return indices[np.lexsort((np.asarray(tiebreak)[indices], distances[indices]))]
+    return indices[np.argsort(distances[indices], kind='stable')]
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """
+    Calculate the latitude/longitude box enclosing a circle on the earth.
+
+    The box is used as a cheap SQL prefilter before exact distances are
+    computed. When the circle reaches a pole every longitude is covered, and
+    when it crosses the antimeridian the longitude span is split in two.
+
+    Args:
+        latitude: Latitude of the circle center in degrees
+        longitude: Longitude of the circle center in degrees
+        radius_km: Radius of the circle in kilometers
+
+    Returns:
+        tuple: (min_lat, max_lat, lon_ranges) where lon_ranges is a list of
+        one or two (min_lon, max_lon) tuples in degrees
+    """
+    lat = math.radians(float(latitude))
+    lon = math.radians(float(longitude))
+    angular_radius = max(float(radius_km), 0.0) / EARTH_RADIUS_KM
+
+    min_lat = lat - angular_radius
+    max_lat = lat + angular_radius
+
+    if min_lat <= -math.pi / 2 or max_lat >= math.pi / 2:
+        # The circle contains a pole, so every longitude is in range
+        min_lat = max(min_lat, -math.pi / 2)
+        max_lat = min(max_lat, math.pi / 2)
+        return math.degrees(min_lat), math.degrees(max_lat), [(-180.0, 180.0)]
+
+    delta_lon = math.asin(min(1.0, math.sin(angular_radius) / math.cos(lat)))
+    min_lon = lon - delta_lon
+    max_lon = lon + delta_lon
+
+    if max_lon - min_lon >= 2 * math.pi:
+        lon_ranges = [(-180.0, 180.0)]
+    elif min_lon < -math.pi:
+        # Crosses the antimeridian on the western side
+        lon_ranges = [
+            (math.degrees(min_lon + 2 * math.pi), 180.0),
+            (-180.0, math.degrees(max_lon)),
+        ]
+    elif max_lon > math.pi:
+        # Crosses the antimeridian on the eastern side
+        lon_ranges = [
+            (math.degrees(min_lon), 180.0),
+            (-180.0, math.degrees(max_lon - 2 * math.pi)),
+        ]
+    else:
+        lon_ranges = [(math.degrees(min_lon), math.degrees(max_lon))]
+
+    return math.degrees(min_lat), math.degrees(max_lat), lon_ranges
+
+
+def unit_vector(latitude, longitude):
+    """
+    Convert coordinates to a point on the unit sphere.
+
+    Args:
+        latitude: Latitude in degrees
+        longitude: Longitude in degrees
+
+    Returns:
+        tuple: (x, y, z) Cartesian components of the point
+    """
+    lat = math.radians(float(latitude))
+    lon = math.radians(float(longitude))
+    return math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat)
+
+
+def chord_threshold(radius_km):
+    """
+    Get the squared chord length between unit vectors a radius apart.
+
+    Two points are within the radius exactly when their dot product is at
+    least cos(radius / R), i.e. when their squared chord 2 - 2 * dot is at
+    most this threshold. The chord form avoids the cancellation the dot
+    product suffers at short distances.
 
-    return c * r
+    Args:
+        radius_km: Radius in kilometers
+
+    Returns:
+        float: Squared chord length on the unit sphere
+    """
+    angle = min(max(float(radius_km), 0.0) / EARTH_RADIUS_KM, math.pi)
+    return (2 * math.sin(angle / 2)) ** 2
+
+
+def chord_distances(chords):
+    """
+    Convert squared chord lengths on the unit sphere to great-circle distances.
+
+    Args:
+        chords: Array-like of squared chord lengths
+
+    Returns:
+        numpy.ndarray: Distances in kilometers
+    """
+    chords = np.clip(np.asarray(chords, dtype=np.float64), 0.0, 4.0)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(chords) / 2)
 
 
 def format_user_data(user, include_sensitive=False):
@@ -132,8 +320,8 @@ def format_user_data(user, include_sensitive=False):
             'dob': user.dob.isoformat() if user.dob else None,
             'address': user.address,
             'description': user.description,
-            'latitude': float(user.latitude) if user.latitude else None,
-            'longitude': float(user.longitude) if user.longitude else None,
+            'latitude': user.latitude,
+            'longitude': user.longitude,
             'updated_at': user.updated_at.isoformat(),
         })
 
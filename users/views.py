@@ -6,23 +6,29 @@ CRUD operations, authentication, and location-based features.
 """
 
 import logging
+from datetime import timedelta
 from django.contrib.auth import login, logout
 from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import status, filters
 from rest_framework.decorators import action
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.authtoken.models import Token
-from geopy.distance import geodesic
 
 from .models import User
+from . import density, geofence, history, nearby_cache, spatial
+from .nearby import nearby_user_ids, iter_ranked, find_nearest_users, NEAREST_DEFAULT_K, NEAREST_MAX_K
+from .distance import DEFAULT_DISTANCE_MODE, get_distance_backend
+from .pagination import DistanceCursorPagination, FilteredCursorPagination, TrackCursorPagination
 from .serializers import (
     UserSerializer, UserCreateSerializer, UserUpdateSerializer,
     UserLoginSerializer, PasswordChangeSerializer, UserListSerializer
 )
-from .permissions import IsOwnerOrReadOnly
+from .permissions import IsOwnerOrReadOnly, IsOwnerOrAdmin
 
 logger = logging.getLogger(__name__)
 
@@ -65,6 +71,10 @@ class UserViewSet(ModelViewSet):
             permission_classes = [AllowAny]
         elif self.action in ['update', 'partial_update', 'destroy', 'change_password']:
             permission_classes = [IsAuthenticated, IsOwnerOrReadOnly]
+        elif self.action in ['spatial_index', 'nearby_cache', 'heatmap', 'geofence']:
+            permission_classes = [IsAuthenticated, IsAdminUser]
+        elif self.action == 'track':
+            permission_classes = [IsAuthenticated, IsOwnerOrAdmin]
         else:
             permission_classes = [IsAuthenticated]
         return [permission() for permission in permission_classes]
@@ -163,48 +173,262 @@ class UserViewSet(ModelViewSet):
         """
         Find nearby friends based on geographic coordinates.
 
-        Returns friends within a specified radius (default 10km) of the requesting user.
+        Returns friends within a specified radius (default 10km) of the requesting user,
+        closest first. Results are paginated with the `cursor` and `page_size` query
+        parameters; pass `stream=1` to receive them as NDJSON instead. The
+        `distance_mode` parameter (fast, haversine or exact) selects how
+        distances are measured for the radius, the ordering and the response.
         """
         user = request.user
         radius = float(request.query_params.get('radius', 10))  # Default 10km
 
+        distance_mode = request.query_params.get('distance_mode', DEFAULT_DISTANCE_MODE)
+        try:
+            get_distance_backend(distance_mode)
+        except ValueError as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
         if not user.has_location:
             return Response(
                 {'error': 'User location not available'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Get all users with location data
-        users_with_location = User.objects.filter(
-            latitude__isnull=False,
-            longitude__isnull=False,
-            is_active=True
-        ).exclude(id=user.id)
-
-        nearby_users = []
         user_location = user.get_location_tuple()
 
-        for other_user in users_with_location:
-            other_location = other_user.get_location_tuple()
-            if other_location:
-                distance = geodesic(user_location, other_location).kilometers
-                if distance <= radius:
-                    user_data = UserListSerializer(other_user, context={'request': request}).data
-                    user_data['distance_km'] = round(distance, 2)
-                    nearby_users.append(user_data)
+        paginator = DistanceCursorPagination()
+        ids, distances = paginator.paginate_ranked(
+            *nearby_user_ids(user, radius, distance_mode), request
+        )
+        rows = (
+            {
+                **UserListSerializer(other_user, context={'request': request}).data,
+                'distance_km': round(distance, 2),
+            }
+            for other_user, distance in iter_ranked(User.objects.filter(is_active=True), ids, distances)
+        )
+
+        if paginator.streaming:
+            logger.info(f"Streaming {len(ids)} nearby users for user {user.email} within {radius}km")
+            return paginator.get_streaming_response(rows)
 
-        # Sort by distance
-        nearby_users.sort(key=lambda x: x['distance_km'])
+        nearby_users = list(rows)
 
         logger.info(f"Nearby friends query for user {user.email}: {len(nearby_users)} found within {radius}km")
 
         return Response({
             'user_location': user_location,
             'radius_km': radius,
+            'distance_mode': distance_mode,
             'nearby_users': nearby_users,
-            'count': len(nearby_users)
+            'count': len(nearby_users),
+            'next_cursor': paginator.next_cursor
         })
 
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    def nearest(self, request):
+        """
+        Find the users closest to the requesting user.
+
+        Returns the k (default 20) nearest active users ordered by distance. The
+        `distance_mode` parameter selects how distances are measured and ranked.
+        """
+        user = request.user
+
+        try:
+            k = int(request.query_params.get('k', NEAREST_DEFAULT_K))
+        except ValueError:
+            return Response(
+                {'error': 'k must be an integer'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if not 1 <= k <= NEAREST_MAX_K:
+            return Response(
+                {'error': f'k must be between 1 and {NEAREST_MAX_K}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        distance_mode = request.query_params.get('distance_mode', DEFAULT_DISTANCE_MODE)
+        try:
+            get_distance_backend(distance_mode)
+        except ValueError as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if not user.has_location:
+            return Response(
+                {'error': 'User location not available'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        nearest_users = []
+        for other_user, distance in find_nearest_users(user, k, distance_mode):
+            user_data = UserListSerializer(other_user, context={'request': request}).data
+            user_data['distance_km'] = round(distance, 2)
+            nearest_users.append(user_data)
+
+        logger.info(f"Nearest users query for user {user.email}: {len(nearest_users)} of k={k} found")
+
+        return Response({
+            'user_location': user.get_location_tuple(),
+            'k': k,
+            'distance_mode': distance_mode,
+            'nearest_users': nearest_users,
+            'count': len(nearest_users)
+        })
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated, IsAdminUser])
+    def heatmap(self, request):
+        """
+        Get active user counts per grid cell over a map viewport.
+
+        The viewport is given as `bbox=min_lon,min_lat,max_lon,max_lat` and
+        cells are 360 / 2**`zoom` degrees on a side. Only non-empty cells are
+        returned. Only available to staff users.
+        """
+        try:
+            bbox = density.parse_bbox(request.query_params.get('bbox', ''))
+        except ValueError as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            zoom = int(request.query_params.get('zoom', density.DEFAULT_ZOOM))
+        except ValueError:
+            return Response(
+                {'error': 'zoom must be an integer'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            cells = density.cell_counts(bbox, zoom)
+        except ValueError as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        return Response({
+            'bbox': bbox,
+            'zoom': zoom,
+            'cell_size_deg': density.cell_size(zoom),
+            'cells': cells,
+            'count': len(cells),
+            'total': sum(cell['count'] for cell in cells)
+        })
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    def clusters(self, request):
+        """
+        Get clustered active users over a map viewport.
+
+        The viewport is given as `bbox=min_lon,min_lat,max_lon,max_lat` with
+        the map `zoom`. Each cluster has its centroid, user count and a few
+        sample user ids; individual users are not returned.
+        """
+        try:
+            bbox = density.parse_bbox(request.query_params.get('bbox', ''))
+        except ValueError as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            zoom = int(request.query_params.get('zoom', density.CLUSTER_DEFAULT_ZOOM))
+        except ValueError:
+            return Response(
+                {'error': 'zoom must be an integer'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            clusters = density.clusters(bbox, zoom)
+        except ValueError as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        return Response({
+            'bbox': bbox,
+            'zoom': zoom,
+            'clusters': clusters,
+            'count': len(clusters),
+            'total': sum(cluster['count'] for cluster in clusters)
+        })
+
+    @action(detail=False, methods=['post'], permission_classes=[IsAuthenticated, IsAdminUser])
+    def geofence(self, request):
+        """
+        Find the active users inside a polygon.
+
+        The request body is a GeoJSON Polygon or MultiPolygon, or a Feature
+        holding one. Users are returned in id order, paginated with the
+        `cursor` and `page_size` query parameters. Only available to staff
+        users.
+        """
+        try:
+            polygons = geofence.parse_geometry(request.data)
+        except ValueError as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        paginator = FilteredCursorPagination()
+        ids = paginator.paginate_filtered(
+            geofence.within_bounds(User.objects.filter(is_active=True), polygons),
+            lambda latitudes, longitudes: geofence.contains(polygons, latitudes, longitudes),
+            request
+        )
+        users = User.objects.filter(id__in=ids).order_by('id')
+        serializer = UserListSerializer(users, many=True, context={'request': request})
+
+        logger.info(f"Geofence query by {request.user.email}: {len(ids)} users on this page")
+
+        return Response({
+            'bbox': geofence.bounds(polygons),
+            'users': serializer.data,
+            'count': len(ids),
+            'next_cursor': paginator.next_cursor
+        })
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated, IsAdminUser])
+    def spatial_index(self, request):
+        """
+        Get spatial index statistics.
+
+        Returns the size and staleness of this process's index of user locations.
+        Only available to staff users.
+        """
+        if not spatial.is_enabled():
+            return Response({'enabled': False})
+
+        return Response({'enabled': True, **spatial.get_index().stats()})
+
+    @action(detail=False, methods=['get', 'delete'], permission_classes=[IsAuthenticated, IsAdminUser])
+    def nearby_cache(self, request):
+        """
+        Get nearby result cache statistics.
+
+        Returns hit and miss counts per endpoint kind, shared by all processes.
+        DELETE resets the counters. Only available to staff users.
+        """
+        if request.method == 'DELETE':
+            nearby_cache.reset_stats()
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        return Response(nearby_cache.stats())
+
     @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
     def search_by_name(self, request):
         """
@@ -250,3 +474,60 @@ class UserViewSet(ModelViewSet):
                 {'error': 'User not found'},
                 status=status.HTTP_404_NOT_FOUND
             )
+
+    @action(detail=True, methods=['get'], permission_classes=[IsAuthenticated, IsOwnerOrAdmin])
+    def track(self, request, pk=None):
+        """
+        Get a user's location track over a time range.
+
+        Points between the ISO 8601 `start` (default: a day before `end`)
+        and `end` (default: now) are returned oldest first, paginated with
+        the `cursor` and `page_size` query parameters. Only available to the
+        user and to staff.
+        """
+        user = self.get_object()
+
+        try:
+            end = self._parse_time(request.query_params.get('end')) or timezone.now()
+            start = self._parse_time(request.query_params.get('start')) or end - timedelta(days=1)
+        except ValueError:
+            return Response(
+                {'error': 'start and end must be ISO 8601 datetimes'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if start >= end:
+            return Response(
+                {'error': 'start must be before end'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        paginator = TrackCursorPagination()
+        points = [
+            {'latitude': latitude, 'longitude': longitude, 'recorded_at': recorded_at}
+            for _, latitude, longitude, recorded_at in paginator.paginate_queryset(
+                history.track(user, start, end), request
+            )
+        ]
+
+        return Response({
+            'user_id': str(user.id),
+            'start': start,
+            'end': end,
+            'points': points,
+            'count': len(points),
+            'next_cursor': paginator.next_cursor
+        })
+
+    @staticmethod
+    def _parse_time(value):
+        """Parse an optional ISO 8601 query parameter into an aware datetime."""
+        if not value:
+            return None
+
+        moment = parse_datetime(value)
+        if moment is None:
+            raise ValueError(value)
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+        return moment